@@ -0,0 +1,253 @@
+'''
+MIT License
+
+Copyright (c) 2018 Riya Dulepet <riyadulepet123@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Thanks to the entire Columbia INCITE team for suggestions/recommendations,
+collaboration, critic, advice, and mentoring. This code was generated as part
+of summer internship @INCITE Columbia.
+'''
+
+
+# coding: utf-8
+
+# In[ ]:
+'''
+The main objective of this code is the QA of findAllDuplicatesInLitIndex2.py: how many
+true duplicates the LSH banding throws away, how many candidates it wastes, and how well
+the final accuracy_score separates duplicates, so speed/accuracy trade-offs rest on numbers
+
+The process:
+    1) sample groups (grid_name, year, field_name) with at most --max-records records, from the
+       database or (--input) from the raw JSONL files / Parquet snapshot without the database
+    2) ground truth: the exact shingle Jaccard of all pairs of the group (on the same preprocessed
+       text the LSH sees), a pair with Jaccard >= --min-jaccard is a true duplicate
+    3) run the stages of the dedup pipeline with its production parameters (and the --idf-scope and
+       --feature-hashing of the dedup job), timing every stage:
+            preprocess - word counts and common words
+            fingerprint - MinHash signature matrix (STEP 1)
+            banding - band hashes and candidate pairs (STEP 1)
+            signatures - TF-IDF top words (STEP 2)
+            scoring - accuracy_score of the candidates (STEP 3)
+    4) report per group and summed over the groups:
+            candidate recall - true pairs among the candidates / true pairs
+            candidate precision - true pairs among the candidates / candidates
+            candidates per true pair
+            confusion matrix of the final pairs (accuracy_score >= --min-score) over all pairs
+            of the group: true/false positives and negatives, recall and precision
+
+Running the code
+================
+    python benchmarkLitIndexDuplicates.py [--groups 20] [--max-records 5000] [--min-jaccard 0.5] [--min-score 97]
+                                          [--scorer token_set_ratio] [--idf-scope group] [--feature-hashing N]
+                                          [--input rawdata/*.json] [--report benchmark.csv]
+'''
+
+import argparse
+import random
+import sys
+import time
+import numpy as np
+import pandas as pd
+import findAllDuplicatesInLitIndex2 as dedup
+
+BENCHMARK_GROUPS = 20
+BENCHMARK_MAX_RECORDS = 5000
+BENCHMARK_MIN_JACCARD = 0.5
+BENCHMARK_MIN_SCORE = 97
+BENCHMARK_SEED = 20180601
+STAGES = ['preprocess', 'fingerprint', 'banding', 'signatures', 'scoring', 'ground_truth']
+
+
+# In[ ]:
+
+
+def sample_file_groups(paths, num_groups=BENCHMARK_GROUPS, max_records=BENCHMARK_MAX_RECORDS, seed=BENCHMARK_SEED):
+    # reservoir sample (algorithm R) of the groups of the raw files small enough for the ground truth
+    rng = random.Random(seed)
+    sample = []
+    seen = 0
+    for grid_name, year, field_name, group in dedup.stream_file_groups(paths):
+        if len(group) > max_records:
+            continue
+        seen += 1
+        if len(sample) < num_groups:
+            sample.append((grid_name, year, field_name, group))
+        else:
+            slot = rng.randrange(seen)
+            if slot < num_groups:
+                sample[slot] = (grid_name, year, field_name, group)
+    return sample
+
+
+def sample_database_groups(num_groups=BENCHMARK_GROUPS, max_records=BENCHMARK_MAX_RECORDS, seed=BENCHMARK_SEED):
+    df_sample = dedup.sample_sweep_groups(dedup.fetch_all_grid_name__year__field_names(), num_groups, max_records, seed)
+    for index, row in df_sample.iterrows():
+        records = pd.concat(list(dedup.stream_group_syllabi(row['grid_name'], row['year'], row['field_name'])), ignore_index=True)
+        yield row['grid_name'], row['year'], row['field_name'], records
+
+
+def benchmark_group(documents, min_jaccard=BENCHMARK_MIN_JACCARD, min_score=BENCHMARK_MIN_SCORE, scorer='token_set_ratio',
+                    idf_model=None, feature_hashing=None):
+    # metrics and stage seconds of one group, the stages are those of find_duplicate_pairs()
+    num_docs = len(documents.ids)
+    seconds = {}
+
+    started = time.time()
+    word_counts = dedup.document_word_counts(documents)
+    texts = dedup.DocumentTexts(documents, dedup.common_word_ids(documents, word_counts))
+    seconds['preprocess'] = time.time() - started
+
+    started = time.time()
+    signature_matrix = dedup.fingerprint_matrix(texts, dedup.make_minhasher())
+    seconds['fingerprint'] = time.time() - started
+
+    started = time.time()
+    rows1, rows2 = dedup.candidate_pairs_from_band_hashes(dedup.band_hashes(signature_matrix, dedup.LSH_BANDS))
+    seconds['banding'] = time.time() - started
+
+    started = time.time()
+    signatures = dedup.group_signatures(documents, word_counts, idf_model, feature_hashing)
+    seconds['signatures'] = time.time() - started
+
+    started = time.time()
+    scores = dedup.score_candidate_pairs(signatures, rows1, rows2, scorer=scorer)
+    seconds['scoring'] = time.time() - started
+
+    started = time.time()
+    true_rows1, true_rows2, _ = dedup.exact_jaccard_pairs(texts, min_jaccard, dedup.LSH_CHAR_NGRAM)
+    seconds['ground_truth'] = time.time() - started
+
+    # pairs as codes row1 * num_docs + row2 (row1 < row2), same encoding as bucket_pair_codes()
+    true_codes = true_rows1 * num_docs + true_rows2
+    candidate_codes = rows1 * num_docs + rows2
+    is_true = np.isin(candidate_codes, true_codes, assume_unique=True)
+    is_final = np.asarray(scores) >= min_score
+    all_pairs = num_docs * (num_docs - 1) // 2
+    true_positives = int((is_final & is_true).sum())
+    false_positives = int((is_final & ~is_true).sum())
+    false_negatives = len(true_codes) - true_positives
+    result = {'documents': num_docs, 'all_pairs': all_pairs, 'true_pairs': len(true_codes), 'candidates': len(candidate_codes),
+              'true_candidates': int(is_true.sum()), 'true_positives': true_positives, 'false_positives': false_positives,
+              'false_negatives': false_negatives, 'true_negatives': all_pairs - true_positives - false_positives - false_negatives}
+    for stage in STAGES:
+        result[stage + '_seconds'] = seconds[stage]
+    return result
+
+
+def add_rates(report):
+    # recall, precision and candidates per true pair of per group or summed counts
+    true_pairs = report['true_pairs'].clip(lower=1)
+    report['candidate_recall'] = report['true_candidates'] / true_pairs
+    report['candidate_precision'] = report['true_candidates'] / report['candidates'].clip(lower=1)
+    report['candidates_per_true_pair'] = report['candidates'] / true_pairs
+    report['recall'] = report['true_positives'] / true_pairs
+    report['precision'] = report['true_positives'] / (report['true_positives'] + report['false_positives']).clip(lower=1)
+    return report
+
+
+def benchmark_groups(groups, min_jaccard=BENCHMARK_MIN_JACCARD, min_score=BENCHMARK_MIN_SCORE, scorer='token_set_ratio',
+                     idf_scope='group', idf_model_dir=dedup.IDF_MODEL_DIR, feature_hashing=None):
+    # groups yields (grid_name, year, field_name, DataFrame of id and text), returns one row per group and the total row
+    # (None, None if no group was sampled); the IDF model of every group is loaded for its key as in the dedup job
+    results = []
+    for grid_name, year, field_name, records in groups:
+        print("BENCHMARKING GRID_NAME = ", grid_name, ", YEAR = ", str(year), ", FIELD_NAME = ", field_name)
+        started = time.time()
+        documents = dedup.tokenize_group_documents([records])
+        tokenize_seconds = time.time() - started
+        idf_model = dedup.group_idf_model(idf_scope, grid_name, field_name, idf_model_dir)
+        result = benchmark_group(documents, min_jaccard, min_score, scorer, idf_model, feature_hashing)
+        result.update(grid_name=grid_name, year=year, field_name=field_name, tokenize_seconds=tokenize_seconds)
+        results.append(result)
+    if not results:
+        return None, None
+    report = pd.DataFrame(results)
+    total = report.drop(columns=['grid_name', 'year', 'field_name']).sum().to_frame().T
+    total['grid_name'] = 'TOTAL'
+    return add_rates(report), add_rates(total)
+
+
+# In[ ]:
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='LSH recall/precision benchmark against the exact Jaccard of all pairs')
+    parser.add_argument('--groups', type=int, default=BENCHMARK_GROUPS,
+                        help='number of sampled groups')
+    parser.add_argument('--max-records', type=int, default=BENCHMARK_MAX_RECORDS,
+                        help='only groups with at most this many records are sampled')
+    parser.add_argument('--min-jaccard', type=float, default=BENCHMARK_MIN_JACCARD,
+                        help='exact shingle Jaccard from which a pair counts as a true duplicate')
+    parser.add_argument('--min-score', type=int, default=BENCHMARK_MIN_SCORE,
+                        help='accuracy_score from which a pair counts as a found duplicate')
+    parser.add_argument('--scorer', default='token_set_ratio', choices=sorted(dedup.SIMILARITY_SCORERS),
+                        help='STEP 3 scorer')
+    parser.add_argument('--idf-scope', default='group', choices=['group'] + sorted(dedup.IDF_SCOPE_COLUMNS),
+                        help='fit the idf per group or use the saved institution, field or global IDF model, as the dedup job')
+    parser.add_argument('--idf-model-dir', default=dedup.IDF_MODEL_DIR,
+                        help='directory of the saved IDF models')
+    parser.add_argument('--token-dictionary', default=dedup.TOKEN_DICTIONARY_PATH,
+                        help='token dictionary the IDF models were fitted with')
+    parser.add_argument('--feature-hashing', type=int, default=None, metavar='N_FEATURES',
+                        help='hash the TF-IDF terms into N_FEATURES columns instead of building a vocabulary')
+    parser.add_argument('--signed-hashing', action='store_true',
+                        help='alternate the sign of the hashed features to cancel out collisions')
+    parser.add_argument('--seed', type=int, default=BENCHMARK_SEED,
+                        help='seed of the group sample')
+    parser.add_argument('--input', nargs='+', default=None, metavar='PATH',
+                        help='sample the groups of raw JSONL (or .parquet) files or snapshot directories instead of the database')
+    parser.add_argument('--report', default=None,
+                        help='also write the per group report to this CSV file')
+    args = parser.parse_args(argv)
+    if args.feature_hashing and args.idf_scope != 'group':
+        parser.error('--feature-hashing can not be used with the IDF models of --idf-scope {}'.format(args.idf_scope))
+    return args
+
+
+# main program
+def main():
+    args = parse_arguments()
+    print("START")
+    # the IDF models refer to the token ids of the dictionary they were fitted with
+    dedup.load_token_dictionary(args.token_dictionary)
+    feature_hashing = dedup.FeatureHashing(args.feature_hashing, args.signed_hashing) if args.feature_hashing else None
+    if args.input:
+        groups = sample_file_groups(args.input, args.groups, args.max_records, args.seed)
+    else:
+        groups = sample_database_groups(args.groups, args.max_records, args.seed)
+    report, total = benchmark_groups(groups, args.min_jaccard, args.min_score, args.scorer, args.idf_scope, args.idf_model_dir, feature_hashing)
+    if report is None:
+        print("NO GROUP WITH AT MOST {} RECORDS TO BENCHMARK".format(args.max_records))
+        sys.exit(1)
+    print(report.to_string(index=False))
+    print("CANDIDATE RECALL = {:.4f}, CANDIDATE PRECISION = {:.4f}, CANDIDATES PER TRUE PAIR = {:.2f}".format(
+        total['candidate_recall'][0], total['candidate_precision'][0], total['candidates_per_true_pair'][0]))
+    print("ACCURACY_SCORE >= {}: TP = {}, FP = {}, FN = {}, TN = {}, RECALL = {:.4f}, PRECISION = {:.4f}".format(
+        args.min_score, int(total['true_positives'][0]), int(total['false_positives'][0]), int(total['false_negatives'][0]),
+        int(total['true_negatives'][0]), total['recall'][0], total['precision'][0]))
+    print("SECONDS: " + ", ".join("{} = {:.2f}".format(stage.upper(), total[stage + '_seconds'][0]) for stage in ['tokenize'] + STAGES))
+    if args.report:
+        report.to_csv(args.report, index=False)
+    print("END")
+
+if __name__== "__main__":
+    main()
@@ -0,0 +1,300 @@
+'''
+MIT License
+
+Copyright (c) 2018 Riya Dulepet <riyadulepet123@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Thanks to the entire Columbia INCITE team for suggestions/recommendations,
+collaboration, critic, advice, and mentoring. This code was generated as part
+of summer internship @INCITE Columbia.
+'''
+
+
+# coding: utf-8
+
+# In[ ]:
+'''
+The main objective of this code is to collapse the duplicate pairs found by
+findAllDuplicatesInLitIndex2.py into clusters of syllabi, so the cluster level
+questions (how many records have duplicates, which records are copies of which)
+are answered from one row per record instead of scanning tens of millions of pairs
+
+The process:
+    1) stream the pairs with an accuracy score of at least --min-score from similar_syllabi
+       (optionally also similar_syllabi_cross_year and similar_syllabi_corpus, or syllabus_pairs
+       instead of the similar_syllabi view with the normalized storage) through a
+       server side cursor, never holding the pairs in memory (streamed twice: the sorted unique
+       ids of the pairs first, then the pairs again for the unions)
+    2) union the pairs chunk by chunk in a numpy union-find over the indices of the sorted ids
+       (searchsorted, no id dictionary; roots hooked to the smaller index, path compression)
+    3) write one row per clustered record into syllabus_clusters with COPY:
+            id - id of the record
+            cluster_id - dense cluster number, clusters numbered in order of their canonical id
+            canonical_id - smallest (first ingested) id of the cluster
+    4) with --flag-duplicates, set open_syllabi.duplicate_entry for every clustered record except
+       the canonical one (and reset it for records no longer in a cluster): the ids are loaded with
+       COPY into a temp table and joined by two set based updates in one transaction, only the
+       rows whose flag changes are written
+
+data definition (also in populateLitIndexDatabase.py):
+CREATE TABLE syllabus_clusters (
+    id BIGINT PRIMARY KEY,
+    cluster_id BIGINT DEFAULT 0,
+    canonical_id BIGINT DEFAULT 0
+);
+
+CREATE INDEX idxk1 ON syllabus_clusters (cluster_id);
+CREATE INDEX idxk2 ON syllabus_clusters (canonical_id);
+
+the follow up queries of findAllDuplicatesInLitIndex2.py become:
+    1) "select count(*) from syllabus_clusters" - records with duplicates
+    2) "select cluster_id, count(*) as cnt from syllabus_clusters group by cluster_id order by cnt desc" - largest clusters
+    3) "select canonical_id, array_agg(id) from syllabus_clusters group by canonical_id" - every record and its copies
+
+Running the code
+================
+    python clusterLitIndexDuplicates.py --min-score 97 [--pair-table similar_syllabi_cross_year ...] [--flag-duplicates]
+    (syllabus_clusters is replaced on every run)
+'''
+
+import argparse
+import io
+import numpy as np
+import psycopg2
+import sys
+
+PAIR_TABLES = ['similar_syllabi', 'syllabus_pairs', 'similar_syllabi_cross_year', 'similar_syllabi_corpus']
+PAIR_FETCH_SIZE = 100000
+CLUSTER_COPY_SIZE = 100000
+
+
+# In[ ]:
+
+
+class UnionFind(object):
+    # union-find over the sorted unique document ids, backed by one numpy parent array of
+    # their indices; a root is always the smallest index of its set (parent[index] <= index),
+    # so the root of a cluster is the index of its canonical (smallest) id
+    def __init__(self, ids):
+        self.ids = ids
+        self.parent = np.arange(len(ids), dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, indices):
+        roots = self.parent[indices]
+        while True:
+            next_roots = self.parent[roots]
+            if np.array_equal(next_roots, roots):
+                break
+            roots = next_roots
+        # path compression of the looked up indices
+        self.parent[indices] = roots
+        return roots
+
+    def union(self, ids1, ids2):
+        # unions a chunk of pairs at once, returns the number of pairs of ids missing from self.ids
+        indices1 = np.minimum(np.searchsorted(self.ids, ids1), max(len(self.ids) - 1, 0))
+        indices2 = np.minimum(np.searchsorted(self.ids, ids2), max(len(self.ids) - 1, 0))
+        found = (self.ids[indices1] == ids1) & (self.ids[indices2] == ids2) if len(self.ids) else np.zeros(len(ids1), dtype=bool)
+        indices1, indices2 = indices1[found], indices2[found]
+        while len(indices1) > 0:
+            roots1 = self.find(indices1)
+            roots2 = self.find(indices2)
+            differ = roots1 != roots2
+            indices1, indices2, roots1, roots2 = indices1[differ], indices2[differ], roots1[differ], roots2[differ]
+            # every larger root is hooked to the smallest root it is paired with in this round
+            np.minimum.at(self.parent, np.maximum(roots1, roots2), np.minimum(roots1, roots2))
+        return int((~found).sum())
+
+    def clusters(self):
+        # (ids, cluster_ids, canonical_ids) arrays, one entry per id
+        canonical_ids = self.ids[self.find(np.arange(len(self.ids)))]
+        # clusters numbered 1, 2, ... in order of their canonical id
+        _, cluster_ids = np.unique(canonical_ids, return_inverse=True)
+        return self.ids, cluster_ids.ravel().astype(np.int64) + 1, canonical_ids
+
+
+def unique_pair_ids(pair_chunks):
+    # sorted unique ids of the pairs; the chunk ids are merged into the result whenever they
+    # outgrow it, so at most about twice the unique ids are held
+    ids = np.zeros(0, dtype=np.int64)
+    pending = []
+    num_pending = 0
+    for ids1, ids2 in pair_chunks:
+        pending.append(np.unique(np.concatenate((ids1, ids2))))
+        num_pending += len(pending[-1])
+        if num_pending > max(len(ids), CLUSTER_COPY_SIZE):
+            ids = np.unique(np.concatenate([ids] + pending))
+            pending = []
+            num_pending = 0
+    return np.unique(np.concatenate([ids] + pending))
+
+
+# In[ ]:
+
+
+def stream_duplicate_pairs(pair_table, min_score):
+    # yields (id1, id2) arrays of the pairs of pair_table with accuracy_score >= min_score
+    if pair_table not in PAIR_TABLES:
+        raise ValueError('unknown pair table {}'.format(pair_table))
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        # named cursor, so the pairs stay on the server until fetched
+        cur = conn.cursor(name='stream_duplicate_pairs')
+        cur.itersize = PAIR_FETCH_SIZE
+        cur.execute("SELECT id1, id2 from " + pair_table + " where accuracy_score >= %s", (min_score,))
+        while True:
+            records = cur.fetchmany(PAIR_FETCH_SIZE)
+            if not records:
+                break
+            pairs = np.array(records, dtype=np.int64)
+            yield pairs[:, 0], pairs[:, 1]
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def cluster_duplicate_pairs(pair_chunks):
+    # pair_chunks() returns a new iterator of the (id1, id2) chunks, the pairs are streamed twice:
+    # once for the ids, once for the unions
+    union_find = UnionFind(unique_pair_ids(pair_chunks()))
+    num_pairs = 0
+    num_missing = 0
+    for ids1, ids2 in pair_chunks():
+        num_missing += union_find.union(ids1, ids2)
+        num_pairs += len(ids1)
+    if num_missing:
+        # pairs stored between the two passes, left to the next run
+        print("\tPAIRS STORED WHILE CLUSTERING, SKIPPED = {}".format(num_missing))
+    print("\tPAIRS = {}, RECORDS = {}".format(num_pairs, len(union_find)))
+    return union_find.clusters()
+
+
+def store_syllabus_clusters(ids, cluster_ids, canonical_ids):
+    # replaces syllabus_clusters in one transaction, rows written with COPY
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("TRUNCATE syllabus_clusters")
+        for start in range(0, len(ids), CLUSTER_COPY_SIZE):
+            end = start + CLUSTER_COPY_SIZE
+            buffer = io.StringIO()
+            for id, cluster_id, canonical_id in zip(ids[start:end].tolist(), cluster_ids[start:end].tolist(), canonical_ids[start:end].tolist()):
+                buffer.write('{}\t{}\t{}\n'.format(id, cluster_id, canonical_id))
+            buffer.seek(0)
+            cur.copy_expert("COPY syllabus_clusters (id, cluster_id, canonical_id) FROM STDIN", buffer)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def copy_ids(cur, table, ids):
+    for start in range(0, len(ids), CLUSTER_COPY_SIZE):
+        buffer = io.StringIO('\n'.join(str(id) for id in ids[start:start + CLUSTER_COPY_SIZE].tolist()) + '\n')
+        cur.copy_expert("COPY " + table + " (id) FROM STDIN", buffer)
+
+
+def flag_duplicate_entries(ids, canonical_ids):
+    # duplicate_entry = true for the non canonical records of the clusters, false for all others
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("CREATE TEMP TABLE duplicate_ids (id BIGINT PRIMARY KEY) ON COMMIT DROP")
+        copy_ids(cur, 'duplicate_ids', ids[ids != canonical_ids])
+        cur.execute("ANALYZE duplicate_ids")
+        # reset first (idx6 finds the flagged records), then set, so only changed rows are written
+        cur.execute("""UPDATE open_syllabi s set duplicate_entry = false where s.duplicate_entry
+                       and not exists (select 1 from duplicate_ids d where d.id = s.id)""")
+        reset = cur.rowcount
+        cur.execute("UPDATE open_syllabi s set duplicate_entry = true from duplicate_ids d where s.id = d.id and not s.duplicate_entry")
+        flagged = cur.rowcount
+        conn.commit()
+        return flagged, reset
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+# In[ ]:
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='cluster the duplicate pairs into syllabus_clusters')
+    parser.add_argument('--min-score', type=int, default=97,
+                        help='only pairs with at least this accuracy score are clustered')
+    parser.add_argument('--pair-table', action='append', choices=PAIR_TABLES, default=None,
+                        help='pair tables to cluster (repeatable, default similar_syllabi)')
+    parser.add_argument('--flag-duplicates', action='store_true',
+                        help='also set open_syllabi.duplicate_entry for every non canonical record of a cluster')
+    return parser.parse_args(argv)
+
+
+# main program
+def main():
+    args = parse_arguments()
+    print("START")
+    pair_tables = args.pair_table or ['similar_syllabi']
+
+    def pair_chunks():
+        for pair_table in pair_tables:
+            print("STREAMING {} WITH ACCURACY_SCORE >= {}".format(pair_table, args.min_score))
+            for chunk in stream_duplicate_pairs(pair_table, args.min_score):
+                yield chunk
+
+    ids, cluster_ids, canonical_ids = cluster_duplicate_pairs(pair_chunks)
+    print("NO OF CLUSTERS = {}".format(int(cluster_ids.max()) if len(cluster_ids) else 0))
+    store_syllabus_clusters(ids, cluster_ids, canonical_ids)
+    if args.flag_duplicates:
+        flagged, reset = flag_duplicate_entries(ids, canonical_ids)
+        print("DUPLICATE_ENTRY SET = {}, RESET = {}".format(flagged, reset))
+    print("END")
+
+if __name__== "__main__":
+    main()
@@ -0,0 +1,337 @@
+'''
+MIT License
+
+Copyright (c) 2018 Riya Dulepet <riyadulepet123@gmail.com>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+Thanks to the entire Columbia INCITE team for suggestions/recommendations,
+collaboration, critic, advice, and mentoring. This code was generated as part
+of summer internship @INCITE Columbia.
+'''
+
+
+# coding: utf-8
+
+# In[ ]:
+'''
+The main objective of this code is to export open_syllabi into a columnar Parquet
+snapshot, so analysts and offline experiments (e.g. findAllDuplicatesInLitIndex2.py --input)
+read only the columns they need instead of querying the database row by row
+
+The process:
+    1) stream "COPY (SELECT ...) TO STDOUT" of open_syllabi (text format, one line per row)
+       and parse it in batches of --batch-size rows, never holding the table in memory
+    2) split every batch by (grid_country_code, year) and append it to the Parquet file of
+       that partition, the snapshot directory is hive partitioned:
+            <snapshot>/grid_country_code=US/year=2011/part-00000.parquet
+       the low cardinality string columns (grid_name, field_name, ...) are dictionary
+       encoded; the rows are exported ordered by (grid_country_code, year), so every
+       partition is one part file (--max-open-files only matters for unordered input:
+       the least recently used file is closed, the partition continues in a new part file);
+       an empty ('') or NULL grid_country_code (or NULL year) is written to the hive default
+       partition __HIVE_DEFAULT_PARTITION__ and reads back as NULL, the two are not kept apart
+    3) load_snapshot() reads selected columns (and partitions) back with memory mapping,
+       the dictionary encoded columns stay dictionary encoded (categoricals in pandas), e.g.
+       all US text of one field:
+            load_snapshot('./litindex_snapshot', ['id', 'grid_name', 'year', 'text'],
+                          country='US', field_name='Mathematics')
+
+The array columns (grid_links, extra_match_urls) are not exported. With --zstd-texts the texts are
+read from the compressed text store of findAllDuplicatesInLitIndex2.py --compress-texts (much
+less to read from the database) and decompressed on the fly, the records not compressed yet
+come with their open_syllabi.text.
+
+Running the code
+================
+    python exportLitIndexParquet.py [--snapshot-dir ./litindex_snapshot] [--country US ...] [--zstd-texts]
+    (needs the pyarrow package, the snapshot directory must not exist yet)
+'''
+
+import argparse
+import collections
+import os
+import re
+import psycopg2
+import sys
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+try:
+    import zstandard as zstd # only for reading the compressed text store (--zstd-texts)
+except ImportError:
+    zstd = None
+
+SNAPSHOT_DIR = './litindex_snapshot'
+EXPORT_BATCH_SIZE = 50000
+MAX_OPEN_FILES = 64
+PARTITION_COLUMNS = ['grid_country_code', 'year']
+# open_syllabi columns (as lower case postgres names) and their Parquet types
+SNAPSHOT_COLUMNS = [
+    ('id', pa.int64()), ('corpus', pa.string()), ('corpus_id', pa.string()), ('url', pa.string()),
+    ('source_url', pa.string()), ('source_anchor', pa.string()), ('retrieved', pa.string()),
+    ('mime_type', pa.string()), ('text_md5', pa.string()), ('syllabus_probability', pa.float64()),
+    ('year', pa.int32()), ('field_code', pa.string()), ('field_score', pa.float64()),
+    ('field_name', pa.string()), ('institution_id', pa.string()), ('grid_id', pa.string()),
+    ('grid_name', pa.string()), ('grid_city', pa.string()), ('grid_country_code', pa.string()),
+    ('grid_state_code', pa.string()), ('wikidata_id', pa.string()), ('wikidata_unitid', pa.string()),
+    ('p856', pa.string()), ('applcn', pa.float64()), ('instnm', pa.string()), ('ipeds_unitid', pa.string()),
+    ('webaddr', pa.string()), ('basic2015', pa.string()), ('city', pa.string()), ('control', pa.string()),
+    ('hbcu', pa.bool_()), ('name', pa.string()), ('stabbr', pa.string()), ('tribal', pa.bool_()),
+    ('ugprofile2015', pa.string()), ('carnegie_unitid', pa.string()), ('womens', pa.bool_()),
+    ('element', pa.string()), ('text', pa.string()), ('duplicate_entry', pa.bool_())
+]
+# string columns with (nearly) one value per row are not dictionary encoded
+PLAIN_COLUMNS = ['corpus_id', 'url', 'source_url', 'source_anchor', 'retrieved', 'text_md5', 'text']
+DICTIONARY_COLUMNS = [name for name, type in SNAPSHOT_COLUMNS
+                      if type == pa.string() and name not in PLAIN_COLUMNS and name not in PARTITION_COLUMNS]
+# hive name of the partition of NULL and '' values
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+# with --zstd-texts the text comes from syllabus_text_zstd (see findAllDuplicatesInLitIndex2.py --compress-texts)
+ZSTD_TEXT_COLUMNS = [('dictionary_id', pa.int32()), ('blob', pa.binary())]
+
+
+# In[ ]:
+
+
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+COPY_ESCAPE_PATTERN = re.compile(r'\\(.)')
+
+
+def copy_text_field(field):
+    # value of a field in the text format of COPY, None for NULL
+    if field == '\\N':
+        return None
+    if '\\' not in field:
+        return field
+    return COPY_ESCAPE_PATTERN.sub(lambda match: COPY_ESCAPES.get(match.group(1), match.group(1)), field)
+
+
+def convert_copy_values(values, type):
+    if type == pa.int64() or type == pa.int32():
+        return [None if value is None else int(value) for value in values]
+    if type == pa.float64():
+        return [None if value is None else float(value) for value in values]
+    if type == pa.bool_():
+        return [None if value is None else value == 't' for value in values]
+    if type == pa.binary():
+        # bytea in hex format, \\x... (the backslash is already unescaped)
+        return [None if value is None else bytes.fromhex(value[2:]) for value in values]
+    return values
+
+
+class CopyBatchReader(object):
+    # file object for copy_expert(): collects the COPY output and hands every
+    # batch_size complete rows to on_batch as a pyarrow Table
+    def __init__(self, columns, on_batch, batch_size=EXPORT_BATCH_SIZE):
+        self.columns = columns
+        self.schema = pa.schema(columns)
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.pending = b''
+        self.lines = []
+        self.num_rows = 0
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # rows never contain a raw newline in the text format, split on bytes so a
+        # multi byte character cut by the chunk boundary stays whole
+        lines = (self.pending + data).split(b'\n')
+        self.pending = lines.pop()
+        self.lines.extend(lines)
+        if len(self.lines) >= self.batch_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.lines:
+            return
+        rows = [[copy_text_field(field) for field in line.decode('utf-8').split('\t')] for line in self.lines]
+        self.lines = []
+        arrays = [pa.array(convert_copy_values([row[index] for row in rows], type), type=type)
+                  for index, (name, type) in enumerate(self.columns)]
+        self.num_rows += len(rows)
+        self.on_batch(pa.Table.from_arrays(arrays, schema=self.schema))
+
+
+# In[ ]:
+
+
+class PartitionedParquetWriter(object):
+    # appends tables to <snapshot_dir>/grid_country_code=<c>/year=<y>/part-<n>.parquet,
+    # with at most max_open_files writers open at a time
+    def __init__(self, snapshot_dir, schema, compression='zstd', max_open_files=MAX_OPEN_FILES):
+        self.snapshot_dir = snapshot_dir
+        self.schema = pa.schema([field for field in schema if field.name not in PARTITION_COLUMNS])
+        self.compression = compression
+        self.max_open_files = max_open_files
+        self.writers = collections.OrderedDict()
+        self.parts = collections.Counter()
+
+    def partition_dir(self, country, year):
+        country = country if country else NULL_PARTITION
+        year = year if year is not None else NULL_PARTITION
+        return os.path.join(self.snapshot_dir, 'grid_country_code={}'.format(country), 'year={}'.format(year))
+
+    def writer(self, key):
+        # writers and part numbers are kept per directory, '' and NULL countries share the default partition
+        directory = self.partition_dir(*key)
+        writer = self.writers.get(directory)
+        if writer is not None:
+            self.writers.move_to_end(directory)
+            return writer
+        if len(self.writers) >= self.max_open_files:
+            _, least_recent = self.writers.popitem(last=False)
+            least_recent.close()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'part-{:05d}.parquet'.format(self.parts[directory]))
+        self.parts[directory] += 1
+        writer = self.writers[directory] = pq.ParquetWriter(path, self.schema, compression=self.compression,
+                                                      use_dictionary=DICTIONARY_COLUMNS)
+        return writer
+
+    def write(self, table):
+        rows_of_partition = collections.defaultdict(list)
+        for row, key in enumerate(zip(table.column('grid_country_code').to_pylist(), table.column('year').to_pylist())):
+            rows_of_partition[key].append(row)
+        table = table.select([name for name in table.column_names if name not in PARTITION_COLUMNS])
+        for key, rows in rows_of_partition.items():
+            self.writer(key).write_table(table.take(rows))
+
+    def close(self):
+        while self.writers:
+            _, writer = self.writers.popitem(last=False)
+            writer.close()
+
+
+def load_text_decompressors(cur):
+    # {dictionary_id: ZstdDecompressor} of all text dictionaries, None for the texts compressed without one
+    decompressors = {None: zstd.ZstdDecompressor()}
+    cur.execute("SELECT dictionary_id, dictionary from text_dictionaries")
+    for dictionary_id, dictionary in cur.fetchall():
+        decompressors[dictionary_id] = zstd.ZstdDecompressor(dict_data=zstd.ZstdCompressionDict(bytes(dictionary)))
+    return decompressors
+
+
+def decompress_text_column(table, decompressors):
+    # table with ZSTD_TEXT_COLUMNS to the table of SNAPSHOT_COLUMNS, the text of the records
+    # without a blob (not compressed yet) is the open_syllabi.text of the query
+    texts = [text if blob is None else decompressors[dictionary_id].decompress(blob).decode('utf-8')
+             for text, dictionary_id, blob in zip(table.column('text').to_pylist(), table.column('dictionary_id').to_pylist(),
+                                                  table.column('blob').to_pylist())]
+    table = table.drop_columns([name for name, type in ZSTD_TEXT_COLUMNS])
+    return table.set_column(table.schema.get_field_index('text'), 'text', pa.array(texts, type=pa.string()))
+
+
+def export_open_syllabi(snapshot_dir=SNAPSHOT_DIR, countries=None, batch_size=EXPORT_BATCH_SIZE, compression='zstd',
+                        max_open_files=MAX_OPEN_FILES, zstd_texts=False):
+    # returns the number of exported rows
+    conn = None
+    cur = None
+    writer = PartitionedParquetWriter(snapshot_dir, pa.schema(SNAPSHOT_COLUMNS), compression, max_open_files)
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        columns = SNAPSHOT_COLUMNS
+        on_batch = writer.write
+        if zstd_texts:
+            # the blobs are read instead of the raw text and decompressed on the fly
+            decompressors = load_text_decompressors(cur)
+            columns = SNAPSHOT_COLUMNS + ZSTD_TEXT_COLUMNS
+            on_batch = lambda table: writer.write(decompress_text_column(table, decompressors))
+            query = ("SELECT " + ', '.join('case when z.id is null then s.text end' if name == 'text' else 's.' + name
+                                           for name, type in SNAPSHOT_COLUMNS) +
+                     ", z.dictionary_id, z.blob from open_syllabi s left join syllabus_text_zstd z on z.id = s.id")
+        else:
+            query = "SELECT " + ', '.join('s.' + name for name, type in SNAPSHOT_COLUMNS) + " from open_syllabi s"
+        if countries:
+            query = cur.mogrify(query + " where s.grid_country_code = any(%s)", (list(countries),)).decode('utf-8')
+        # rows of a partition arrive together, every partition is written by one writer into one part file
+        query += " order by s.grid_country_code, s.year"
+        reader = CopyBatchReader(columns, on_batch, batch_size)
+        cur.copy_expert("COPY (" + query + ") TO STDOUT", reader, size=1 << 20)
+        reader.flush()
+        return reader.num_rows
+    except Exception as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        writer.close()
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+# In[ ]:
+
+
+def load_snapshot(snapshot_dir=SNAPSHOT_DIR, columns=None, country=None, year=None, field_name=None):
+    # pyarrow Table of the selected columns (None for all) of the snapshot, read with memory
+    # mapping, country and year prune the partition directories, field_name filters the rows
+    filters = []
+    if country is not None:
+        filters.append(('grid_country_code', '=', country))
+    if year is not None:
+        filters.append(('year', '=', year))
+    if field_name is not None:
+        filters.append(('field_name', '=', field_name))
+    read_dictionary = [name for name in DICTIONARY_COLUMNS if columns is None or name in columns]
+    return pq.read_table(snapshot_dir, columns=columns, filters=filters or None, memory_map=True,
+                         partitioning='hive', read_dictionary=read_dictionary)
+
+
+# In[ ]:
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='export open_syllabi into a partitioned Parquet snapshot')
+    parser.add_argument('--snapshot-dir', default=SNAPSHOT_DIR,
+                        help='directory of the snapshot, must not exist yet')
+    parser.add_argument('--country', action='append', default=None,
+                        help='only export these grid_country_code values (repeatable, default all)')
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE,
+                        help='rows of the COPY stream parsed and written at a time')
+    parser.add_argument('--compression', default='zstd', choices=['zstd', 'snappy', 'gzip', 'none'],
+                        help='Parquet compression codec')
+    parser.add_argument('--zstd-texts', action='store_true',
+                        help='read the texts from the compressed text store and decompress them on the fly')
+    parser.add_argument('--max-open-files', type=int, default=MAX_OPEN_FILES,
+                        help='partition files open at the same time')
+    return parser.parse_args(argv)
+
+
+# main program
+def main():
+    args = parse_arguments()
+    print("START")
+    if os.path.exists(args.snapshot_dir):
+        print("SNAPSHOT DIR {} ALREADY EXISTS".format(args.snapshot_dir))
+        sys.exit(1)
+    if args.zstd_texts and zstd is None:
+        print("--zstd-texts NEEDS THE zstandard PACKAGE")
+        sys.exit(1)
+    num_rows = export_open_syllabi(args.snapshot_dir, args.country, args.batch_size, args.compression, args.max_open_files,
+                                   args.zstd_texts)
+    print("ROWS EXPORTED = {}".format(num_rows))
+    print("END")
+
+if __name__== "__main__":
+    main()
@@ -71,6 +71,11 @@ we use POSTGRES SQL database as the transactional database to retrieve and store
                 id1_top_10_significant_words - contains top 10 most significant words for first record
                 id2_top_10_significant_words - contains top 10 most significant words for second record
                 accuracy_score - confidence of match for the two records
+                jaccard_score - exact 5-gram shingle Jaccard of the two records (only with --verify-jaccard)
+            2.2) every pair is stored once with id1 < id2 (unique key), reruns update the stored pairs,
+                 the view similar_syllabi_symmetric lists every pair in both directions (id, other_id)
+        3) similar_syllabi_cross_year has the same fields, with year1 and year2 instead of year (--cross-year)
+        4) similar_syllabi_corpus has grid_name1, grid_name2, id1, id2, the top 10 words and the scores (--corpus)
     Each of the tables has several indices to make the process of retrieval speedy
     Database Stats:
         open_syllabi has 5,800,477 (5.8M) records, and 2,755,745 (2.75M) US records
@@ -94,13 +99,17 @@ We can take this a step further (but not part of current code to get to final st
         yields records with most duplicates of high confidence
     3) the query "select id1,array_agg(id2) from similar_syllabi where accuracy_score >= 97 group by id1;" yields
         each record and its list of corresponding duplicate record IDs
+    4) clusterLitIndexDuplicates.py collapses the pairs above a score into syllabus_clusters (one row per
+        record with its cluster and canonical id), which answers the queries above without scanning the pairs;
+        with --flag-duplicates it also sets open_syllabi.duplicate_entry for all but the canonical record
 
 Room for code improvement
 =========================
     1) lot of tasks are highly parallelizable using Spark
     2) better use of Python idioms that might have led to improved use of multicore machine
     3) better factoring or modularization of code
-    4) producing confusion matrix for QA
+    4) producing confusion matrix for QA (benchmarkLitIndexDuplicates.py reports it on sampled groups against
+       the exact Jaccard of all pairs, --sweep the recall of other LSH parameters)
     5) test harness or unit testing code
     
 Running the code
@@ -108,9 +117,74 @@ Running the code
     1) it assumes a Postgres database with course description records (uploading data is separate script)
     2) python findAllDuplicatesInLitIndex2.py
         2.1) but since this is computationally intensive, would recommend running as background process
+        2.2) --scorer selects the STEP 3 scorer: token_set_ratio (default, original fuzzy scores),
+             jaccard (vectorized overlap of the top 10 word ids) or cosine (on the TF-IDF rows)
+        2.3) --verify-jaccard adds the exact shingle Jaccard of every candidate pair as a second signal
+        2.4) --workers N --shard-threshold M splits fingerprinting, band hashing and scoring of every
+             group with at least M records across N processes (signature matrix in shared memory)
+        2.5) --memory-budget-mb B processes every group estimated to need more than B MB out-of-core:
+             streamed in --chunk-size chunks with signatures and band tables spilled to --spill-dir
+        2.6) groups are held as a compact document store (int64 ids, one flat int32 token buffer with
+             offsets, no raw text); --memory-benchmark N compares its memory peak on the N largest
+             groups against the original DataFrame preprocessing
+        2.7) words are interned as int32 ids in a token dictionary persisted to --token-dictionary
+             (default ./token_dictionary.txt), ids are stable across runs as long as the file is kept
+        2.8) --idf-scope institution|field|global --fit-idf-models fits the IDF models once (saved under
+             --idf-model-dir), later runs with the same --idf-scope look the idf up instead of fitting
+             it on every group (the default --idf-scope group keeps the original per-group idf)
+        2.9) --feature-hashing N [--signed-hashing] hashes the TF-IDF terms into N columns (vocabulary
+             free, bounded memory); words are only looked up for the columns in a top 10
+        2.10) --incremental keeps the band hashes of every processed record in lsh_band_index, a run
+             only fingerprints the records not indexed yet and probes them against the stored buckets
+             (the first incremental run on a group indexes it and stores the same pairs as a full run; the
+             common words and the document frequencies of the group idf are frozen in lsh_index_scopes,
+             so the scores of a batch are those of a full run, not available with --feature-hashing)
+        2.11) --watermark saves max id, row count and id sum of every processed group in dedup_watermarks,
+             later runs skip unchanged groups, only pair the records appended after the saved max id
+             and recompute (replacing the stored pairs of) groups whose older records changed
+        2.12) --cross-year builds one LSH index per (grid_name, field_name) over all years and stores
+             the pairs of records from different years in similar_syllabi_cross_year (year1, year2)
+        2.13) --corpus [--all-countries] streams the whole corpus once and stores the pairs of records of
+             different institutions in similar_syllabi_corpus; band and pair tables are spilled to
+             --partitions disk partitions under --spill-dir and joined one partition at a time (needs the
+             global IDF model, see 2.8)
+        2.14) --normalized-storage writes every top 10 signature once to syllabus_signatures and the pairs
+             (group keys, ids, scores) to syllabus_pairs; --migrate-storage moves an existing similar_syllabi
+             there and replaces it by a view with the same columns (run it once before the first
+             --normalized-storage run, so similar_syllabi shows the new pairs), --storage-report prints the sizes
+        2.15) --min-score S stores only the pairs of similar_syllabi scoring at least S, a uniform random
+             sample of --low-score-sample of the pairs below S is kept in similar_syllabi_low_score_sample
+             (with --input or --cache-only in a .low_score_sample file next to --output)
+        2.16) --compute-minhash stores the MinHash signature (bytea) and band hashes of every record not signed
+             yet in syllabus_minhash and syllabus_band_hashes; --db-candidates then takes the candidate pairs
+             of every group from one GROUP BY band_hash query instead of fingerprinting the texts (the stored
+             signatures keep the common words, so the candidates can differ slightly from STEP 1)
+        2.17) --compute-tokens stores the normalized token stream of every record not tokenized yet as int32
+             token ids (bytea) in syllabus_tokens, --db-tokens reads the groups from that column instead of
+             the raw text (run --compute-tokens after every import, the ids are those of --token-dictionary)
+        2.18) --compress-texts institution|field stores every text zstd compressed with a dictionary trained per
+             institution or field (syllabus_text_zstd, text_dictionaries), --zstd-texts reads the groups from
+             there; every group prints the bytes read against its raw text bytes and its dedup time
+        2.19) --input rawdata/*.json [--output pairs.csv|pairs.parquet] runs without the database (also on the
+             snapshot directory of exportLitIndexParquet.py): the records are external sorted by group (--sort-chunk-size records per sorted run under --spill-dir) and
+             the pairs written to --output (--idf-scope global uses the saved global IDF model)
+        2.20) --group-cache DIR keeps every fetched group as a Feather file (LRU evicted above --group-cache-mb,
+             dropped when the row count of the group changed), repeated runs of the in-memory path read the
+             cached groups; with --cache-only the cached groups are deduped without any database access
+             and the pairs written to --output
+        2.21) --sweep fingerprints --sweep-groups sampled groups once with the largest swept number of seeds and
+             reports candidates, runtime and recall (against the exact shingle Jaccard of all pairs) of every
+             --sweep-bands x --sweep-rows x --sweep-char-ngrams configuration and --sweep-thresholds score
 '''
 
+import argparse
+import array
+import collections
+import csv
 import glob
+import hashlib
+import heapq
+import io
 import pandas as pd
 import psycopg2
 import sys
@@ -120,15 +194,112 @@ import numpy as np
 import itertools
 from psycopg2.extras import execute_values
 import math
+import multiprocessing
+import os
+from multiprocessing import shared_memory
 import random
+import shutil
 from fuzzywuzzy import fuzz
 import string
+import tempfile
+import time
+import tracemalloc
 from nltk.corpus import stopwords
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.utils import murmurhash3_32
 
 from lsh import cache, minhash # https://github.com/mattilyra/lsh
+try:
+    import zstandard as zstd # only for the compressed text store (--compress-texts, --zstd-texts)
+except ImportError:
+    zstd = None
+try:
+    import pyarrow as pa # only for Parquet files in the file backed mode (--input, --output)
+    import pyarrow.dataset as pads
+    import pyarrow.feather as feather # also the group cache (--group-cache)
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pads = None
+    feather = None
+    pq = None
 stop = stopwords.words('english')
 
+# the analyzer of the TfidfVectorizer of STEP 2, applied once per distinct word
+TFIDF_ANALYZER = TfidfVectorizer(analyzer='word', ngram_range=(1,1), min_df = 1, stop_words = 'english').build_analyzer()
+
+
+# In[ ]:
+
+
+# process wide token dictionary: every normalized word (and every TF-IDF term) is
+# interned once as an int32 id, all of STEP 1-3 works on id arrays and the words are
+# only looked up again when the top 10 significant words are written out; the
+# dictionary is persisted between runs as a text file with one word per line
+# (the line number is the id), new words are appended on save
+TOKEN_DICTIONARY_PATH = './token_dictionary.txt'
+token_ids = {}
+token_words = []
+_saved_token_count = 0
+_word_terms = {}
+
+
+def intern_word(word):
+    token_id = token_ids.get(word)
+    if token_id is None:
+        token_id = token_ids[word] = len(token_words)
+        token_words.append(word)
+    return token_id
+
+
+def load_token_dictionary(path=TOKEN_DICTIONARY_PATH):
+    global _saved_token_count
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding='utf-8', newline='\n') as dictionary_file:
+        for line in dictionary_file:
+            intern_word(line.rstrip('\n'))
+    _saved_token_count = len(token_words)
+    return _saved_token_count
+
+
+def save_token_dictionary(path=TOKEN_DICTIONARY_PATH):
+    # appends the words interned since the last load or save
+    global _saved_token_count
+    if _saved_token_count == len(token_words):
+        return 0
+    with open(path, 'a', encoding='utf-8', newline='\n') as dictionary_file:
+        for word in token_words[_saved_token_count:]:
+            dictionary_file.write(word + '\n')
+    new_words = len(token_words) - _saved_token_count
+    _saved_token_count = len(token_words)
+    return new_words
+
+
+def tokenize_text(text, punctuation_translator=str.maketrans('', '', string.punctuation)):
+    # normalize by lowering the case, removing punctuations and english stop words (digits are kept,
+    # text_without_common_words keeps them), one token id per remaining word
+    global stop
+    return [intern_word(word) for word in text.lower().translate(punctuation_translator).split() if word not in stop]
+
+
+def word_terms(word_id):
+    # token ids of the TF-IDF terms of a word, as text_lower_case_words + the TfidfVectorizer analyzer
+    # would produce them (digits are dropped, english stop words and single characters too)
+    terms = _word_terms.get(word_id)
+    if terms is None:
+        word = token_words[word_id]
+        terms = () if word.isdigit() else tuple(intern_word(term) for term in TFIDF_ANALYZER(word))
+        _word_terms[word_id] = terms
+    return terms
+
+
+def alphabetical_columns(term_ids):
+    # TfidfVectorizer orders its feature columns alphabetically, and the column order breaks the ties
+    # between equal TF-IDF scores, so the group terms are sorted by their words again
+    return np.array(sorted(term_ids, key=token_words.__getitem__), dtype=np.int64)
+
 
 # In[10]:
 
@@ -145,6 +316,52 @@ def jaccard(set_a, set_b):
     return len(intersection) / len(union)
 
 
+# integer version of shingles() for the exact Jaccard verification stage: every
+# char_ngram window (same windows as shingles()) is hashed with a 64 bit polynomial
+# hash over the unicode code points, and the result is a sorted array of unique hashes
+SHINGLE_HASH_BASE = np.uint64(1000003)
+
+
+def hashed_shingles(text, char_ngram=5):
+    code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    num_shingles = len(code_points) - char_ngram
+    if num_shingles <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    powers = SHINGLE_HASH_BASE ** np.arange(char_ngram - 1, -1, -1, dtype=np.uint64)
+    windows = np.lib.stride_tricks.sliding_window_view(code_points, char_ngram)[:num_shingles]
+    return np.unique((windows * powers).sum(axis=1, dtype=np.uint64))
+
+
+def sorted_jaccard(sorted_a, sorted_b):
+    # jaccard() for two sorted unique integer shingle arrays
+    intersection = len(np.intersect1d(sorted_a, sorted_b, assume_unique=True))
+    union = len(sorted_a) + len(sorted_b) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def exact_jaccard_scores(texts, rows1, rows2, char_ngram=5):
+    # true shingle Jaccard of every candidate pair, the shingle array of a document is
+    # hashed once no matter in how many candidate pairs it shows up
+    shingle_cache = {}
+    scores = np.zeros(len(rows1), dtype=np.float64)
+    for pos, (row1, row2) in enumerate(zip(rows1, rows2)):
+        for row in (row1, row2):
+            if row not in shingle_cache:
+                shingle_cache[row] = hashed_shingles(texts[row], char_ngram=char_ngram)
+        scores[pos] = sorted_jaccard(shingle_cache[row1], shingle_cache[row2])
+    return scores
+
+
+def stored_exact_jaccard_scores(shingle_buffer, shingle_offsets, rows1, rows2):
+    # exact_jaccard_scores() on shingle arrays spilled to a flat buffer, the shingles of
+    # row are shingle_buffer[shingle_offsets[row]:shingle_offsets[row + 1]]
+    scores = np.zeros(len(rows1), dtype=np.float64)
+    for pos, (row1, row2) in enumerate(zip(rows1, rows2)):
+        scores[pos] = sorted_jaccard(shingle_buffer[shingle_offsets[row1]:shingle_offsets[row1 + 1]],
+                                     shingle_buffer[shingle_offsets[row2]:shingle_offsets[row2 + 1]])
+    return scores
+
+
 def candidate_duplicates(document_feed, char_ngram=5, seeds=100, bands=5, hashbytes=4):
     char_ngram = 5
     sims = []
@@ -172,6 +389,187 @@ def candidate_duplicates(document_feed, char_ngram=5, seeds=100, bands=5, hashby
     return candidate_pairs
 
 
+# In[ ]:
+
+
+# STEP 3 scorers: every scorer takes a whole batch of candidate pairs, given as
+# two arrays of row positions into the group, and returns an integer array of
+# accuracy scores in the range 0-100 (same scale as fuzz.token_set_ratio)
+# the documents are represented by their top significant words as integer
+# token ids, padded with -1, words[token_id] is the word of a token id
+GroupSignatures = collections.namedtuple('GroupSignatures', ['top_word_ids', 'tfidf_matrix', 'words'])
+
+SCORER_BATCH_SIZE = 100000
+
+
+def top_word_ids_of_row(word_ids, scores, top_n=10):
+    # ids of the top_n highest scoring words of one document padded with -1, ties are
+    # broken by feature column so the order matches a stable sort on the dense row
+    top_word_ids = np.full(top_n, -1, dtype=np.int64)
+    keep = scores > 0
+    word_ids, scores = word_ids[keep], scores[keep]
+    order = np.lexsort((word_ids, -scores))[:top_n]
+    top_word_ids[:len(order)] = word_ids[order]
+    return top_word_ids
+
+
+def top_significant_word_ids(tfidf_matrix, top_n=10):
+    # top_word_ids_of_row() for every row of the sparse TF-IDF matrix
+    tfidf_matrix = tfidf_matrix.tocsr()
+    top_word_ids = np.full((tfidf_matrix.shape[0], top_n), -1, dtype=np.int64)
+    for row in range(tfidf_matrix.shape[0]):
+        start, end = tfidf_matrix.indptr[row], tfidf_matrix.indptr[row + 1]
+        top_word_ids[row] = top_word_ids_of_row(tfidf_matrix.indices[start:end], tfidf_matrix.data[start:end], top_n)
+    return top_word_ids
+
+
+def signature_text(word_ids, words):
+    # rebuild the space separated signature text (as stored in similar_syllabi) from token ids
+    return ' '.join(words[word_id] for word_id in word_ids if word_id >= 0)
+
+
+def score_pairs_jaccard(signatures, rows1, rows2):
+    # vectorized set overlap of the two top word id sets, |A & B| / |A | B|
+    ids1 = signatures.top_word_ids[rows1]
+    ids2 = signatures.top_word_ids[rows2]
+    valid1 = ids1 >= 0
+    valid2 = ids2 >= 0
+    overlap = ((ids1[:, :, None] == ids2[:, None, :]) & valid1[:, :, None] & valid2[:, None, :]).any(axis=2).sum(axis=1)
+    union = valid1.sum(axis=1) + valid2.sum(axis=1) - overlap
+    scores = np.zeros(len(rows1), dtype=np.float64)
+    np.divide(100.0 * overlap, union, out=scores, where=union > 0)
+    return np.rint(scores).astype(np.int64)
+
+
+def score_pairs_cosine(signatures, rows1, rows2):
+    # cosine similarity of the full TF-IDF rows (TfidfVectorizer rows are already l2 normalized)
+    if signatures.tfidf_matrix is None:
+        raise ValueError('the cosine scorer needs the TF-IDF matrix of the group')
+    tfidf_matrix = signatures.tfidf_matrix.tocsr()
+    similarity = np.asarray(tfidf_matrix[rows1].multiply(tfidf_matrix[rows2]).sum(axis=1)).ravel()
+    return np.rint(100.0 * np.clip(similarity, 0.0, 1.0)).astype(np.int64)
+
+
+def score_pairs_token_set_ratio(signatures, rows1, rows2):
+    # compatibility mode, reproduces the original fuzz.token_set_ratio scores on the signature texts,
+    # every signature text is only built once per document
+    texts = {}
+    scores = np.zeros(len(rows1), dtype=np.int64)
+    for pos, (row1, row2) in enumerate(zip(rows1, rows2)):
+        for row in (row1, row2):
+            if row not in texts:
+                texts[row] = signature_text(signatures.top_word_ids[row], signatures.words)
+        scores[pos] = fuzz.token_set_ratio(texts[row1], texts[row2])
+    return scores
+
+
+SIMILARITY_SCORERS = {
+    'token_set_ratio': score_pairs_token_set_ratio,
+    'jaccard': score_pairs_jaccard,
+    'cosine': score_pairs_cosine,
+}
+
+
+def score_candidate_pairs(signatures, rows1, rows2, scorer='token_set_ratio'):
+    # run the selected scorer over the candidate pairs in batches of SCORER_BATCH_SIZE
+    if scorer not in SIMILARITY_SCORERS:
+        raise ValueError('Unknown scorer {}, expected one of {}'.format(scorer, sorted(SIMILARITY_SCORERS)))
+    score_fn = SIMILARITY_SCORERS[scorer]
+    rows1 = np.asarray(rows1, dtype=np.int64)
+    rows2 = np.asarray(rows2, dtype=np.int64)
+    scores = np.zeros(len(rows1), dtype=np.int64)
+    for start in range(0, len(rows1), SCORER_BATCH_SIZE):
+        end = start + SCORER_BATCH_SIZE
+        scores[start:end] = score_fn(signatures, rows1[start:end], rows2[start:end])
+    return scores
+
+
+# In[ ]:
+
+
+# STEP 1 building blocks: the MinHash fingerprints of a group are kept as one
+# (documents x seeds) signature matrix, every band of the matrix is reduced to a
+# single 64 bit hash per document, and documents sharing a band hash are candidates
+LSH_SEEDS = 100
+LSH_BANDS = 10
+LSH_CHAR_NGRAM = 5
+LSH_HASHBYTES = 4
+# fixed so that every process (and every run) fingerprints with the same hash functions
+LSH_RANDOM_STATE = 20180601
+
+BAND_HASH_OFFSET = np.uint64(14695981039346656037)
+BAND_HASH_PRIME = np.uint64(1099511628211)
+
+
+def make_minhasher(seeds=LSH_SEEDS, char_ngram=LSH_CHAR_NGRAM, hashbytes=LSH_HASHBYTES, random_state=LSH_RANDOM_STATE):
+    return minhash.MinHasher(seeds=seeds, char_ngram=char_ngram, hashbytes=hashbytes, random_state=random_state)
+
+
+def fingerprint_matrix(texts, hasher, out=None):
+    # fill (or allocate) the signature matrix with one fingerprint per row
+    if out is None:
+        out = np.zeros((len(texts), hasher.num_seeds), dtype=np.uint64)
+    for row, text in enumerate(texts):
+        out[row] = hasher.fingerprint(text)
+    return out
+
+
+def band_hashes(signatures, bands=LSH_BANDS):
+    # FNV-1a style hash of the rows of every band, one column per band
+    num_docs, num_seeds = signatures.shape
+    if num_seeds % bands != 0:
+        raise ValueError('Seeds has to be a multiple of bands. {} % {} != 0'.format(num_seeds, bands))
+    rows_per_band = num_seeds // bands
+    banded = signatures.reshape(num_docs, bands, rows_per_band)
+    hashes = np.full((num_docs, bands), BAND_HASH_OFFSET, dtype=np.uint64)
+    for column in range(rows_per_band):
+        hashes = (hashes ^ banded[:, :, column].astype(np.uint64)) * BAND_HASH_PRIME
+    return hashes
+
+
+def bucket_pair_codes(band_column, max_bucket_size=None):
+    # all pairs of rows sharing a bucket in one band, encoded as row1 * num_docs + row2 with row1 < row2,
+    # buckets with more than max_bucket_size rows are skipped (and logged)
+    num_docs = len(band_column)
+    order = np.argsort(band_column, kind='stable')
+    sorted_hashes = band_column[order]
+    boundaries = np.flatnonzero(sorted_hashes[1:] != sorted_hashes[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [num_docs]))
+    codes = []
+    for start, end in zip(starts, ends):
+        if max_bucket_size is not None and end - start > max_bucket_size:
+            print("\tSKIPPED BUCKET OF {} RECORDS (more than {})".format(end - start, max_bucket_size))
+            continue
+        if end - start > 1: # if the bucket contains more than a single document
+            bucket = np.sort(order[start:end])
+            first, second = np.triu_indices(len(bucket), k=1)
+            codes.append(bucket[first].astype(np.int64) * num_docs + bucket[second])
+    if not codes:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(codes)
+
+
+def decode_pair_codes(codes, num_docs):
+    codes = np.unique(codes)
+    return codes // num_docs, codes % num_docs
+
+
+def candidate_pairs_from_band_hashes(hashes):
+    # unique candidate row pairs over all bands
+    num_docs = hashes.shape[0]
+    codes = [bucket_pair_codes(hashes[:, band]) for band in range(hashes.shape[1])]
+    return decode_pair_codes(np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64), num_docs)
+
+
+def pairs_with_new_documents(ids, rows1, rows2, new_after_id=None):
+    # only the candidate pairs with at least one document added after the watermark id
+    if new_after_id is None:
+        return rows1, rows2
+    is_new = (ids[rows1] > new_after_id) | (ids[rows2] > new_after_id)
+    return rows1[is_new], rows2[is_new]
+
+
 # In[11]:
 
 
@@ -181,8 +579,9 @@ def fetch_all_grid_name__year__field_names():
         cur = conn.cursor()
         
         # consider only if valid grid_name and year
-        cur.execute("""SELECT grid_name, year, field_name, count(*) as cnt from open_syllabi where grid_name != 'NaN' and year > 0 and grid_country_code='US' group by grid_name, year, field_name having count(*) > 1 order by cnt desc""")
-        df_grid_name__year__field_name = pd.DataFrame(cur.fetchall(), columns=['grid_name', 'year', 'field_name', 'cnt'])
+        # (octet_length is answered from the TOAST header, the text itself is not read)
+        cur.execute("""SELECT grid_name, year, field_name, count(*) as cnt, sum(octet_length(text)) as text_bytes, max(id) as max_id, sum(id) as id_sum from open_syllabi where grid_name != 'NaN' and year > 0 and grid_country_code='US' group by grid_name, year, field_name having count(*) > 1 order by cnt desc""")
+        df_grid_name__year__field_name = pd.DataFrame(cur.fetchall(), columns=['grid_name', 'year', 'field_name', 'cnt', 'text_bytes', 'max_id', 'id_sum'])
         
         return df_grid_name__year__field_name # finally block will run before this return automatically
     except Exception as e:
@@ -203,17 +602,111 @@ def fetch_all_grid_name__year__field_names():
 # In[12]:
 
 
+# pairs are always stored with id1 < id2 and every pair table has a unique (id1, id2) key:
+# the rows are copied into a staging temp table and upserted from there in one statement,
+# so rerunning a group updates its pairs instead of appending them again
+SIMILAR_SYLLABI_COLUMNS = ['grid_name', 'field_name', 'year', 'id1', 'id2', 'id1_top_10_significant_words', 'id2_top_10_significant_words',
+                           'accuracy_score', 'jaccard_score']
+
+
+def copy_text_value(value):
+    # value in the text format of COPY
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def upsert_duplicate_pairs(cur, pair_table, columns, list_duplicate_pairs):
+    # staged bulk upsert of rows (in the order of columns) on the (id1, id2) key of pair_table; the
+    # staging table of pair_table is reused (emptied) by further upserts in the same transaction
+    stage_table = pair_table + '_stage'
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS " + stage_table + " (LIKE " + pair_table + " INCLUDING DEFAULTS) ON COMMIT DROP")
+    cur.execute("TRUNCATE " + stage_table)
+    buffer = io.StringIO()
+    for pair in list_duplicate_pairs:
+        buffer.write('\t'.join([copy_text_value(value) for value in pair]) + '\n')
+    buffer.seek(0)
+    cur.copy_expert("COPY " + stage_table + " (" + ', '.join(columns) + ") FROM STDIN", buffer)
+    updates = ', '.join(['{0} = excluded.{0}'.format(column) for column in columns if column not in ('id1', 'id2')])
+    cur.execute("INSERT into " + pair_table + " (" + ', '.join(columns) + ") SELECT distinct on (id1, id2) " + ', '.join(columns) +
+                " from " + stage_table + " order by id1, id2 on conflict (id1, id2) do update set " + updates)
+
+
+# retention policy: with --min-score only the pairs scoring at least min_accuracy_score are
+# stored, the pairs below it are offered to a reservoir that keeps a uniform random sample
+# of them for QA, written to similar_syllabi_low_score_sample at the end of the run
+min_accuracy_score = None
+low_score_reservoir = None
+LOW_SCORE_SAMPLE_SIZE = 10000
+LOW_SCORE_SAMPLE_SEED = 20180601
+
+
+class PairReservoir(object):
+    # uniform random sample of at most size of all the rows offered (reservoir sampling, algorithm R)
+    def __init__(self, size=LOW_SCORE_SAMPLE_SIZE, seed=LOW_SCORE_SAMPLE_SEED):
+        self.size = size
+        self.rows = []
+        self.seen = 0
+        self.random = random.Random(seed)
+
+    def offer(self, rows):
+        for row in rows:
+            self.seen += 1
+            if len(self.rows) < self.size:
+                self.rows.append(row)
+            else:
+                position = self.random.randrange(self.seen)
+                if position < self.size:
+                    self.rows[position] = row
+
+
+def retain_duplicate_pairs(list_duplicate_pairs):
+    # the rows to store, the rows scoring below min_accuracy_score go to the reservoir
+    if min_accuracy_score is None:
+        return list_duplicate_pairs
+    retained = [pair for pair in list_duplicate_pairs if pair[7] >= min_accuracy_score]
+    if low_score_reservoir is not None and len(retained) < len(list_duplicate_pairs):
+        low_score_reservoir.offer(pair for pair in list_duplicate_pairs if pair[7] < min_accuracy_score)
+    return retained
+
+
+def store_low_score_sample(reservoir):
+    # replaces the sample of the previous run
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("TRUNCATE similar_syllabi_low_score_sample")
+        upsert_duplicate_pairs(cur, 'similar_syllabi_low_score_sample', SIMILAR_SYLLABI_COLUMNS, reservoir.rows)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
 def insert_duplicate_pairs(list_duplicate_pairs):
     # insert duplicate pairs with accuracy score and associated evidence
+    list_duplicate_pairs = retain_duplicate_pairs(list_duplicate_pairs)
+    if not list_duplicate_pairs:
+        return
+    if normalized_pair_storage:
+        return insert_normalized_duplicate_pairs(list_duplicate_pairs)
     try:
         # connect to existing database
         conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
-        conn.autocommit = True
         
         # Open a cursor to perform database operations
         cur = conn.cursor()
-        insert_query = 'insert into similar_syllabi (grid_name, field_name, year, id1, id2, id1_top_10_significant_words, id2_top_10_significant_words, accuracy_score) values %s'
-        psycopg2.extras.execute_values (cur, insert_query, list_duplicate_pairs, template=None, page_size=100)
+        upsert_duplicate_pairs(cur, 'similar_syllabi', SIMILAR_SYLLABI_COLUMNS, list_duplicate_pairs)
+        conn.commit()
     except Exception as e:
         if conn:
             conn.rollback()
@@ -228,13 +721,130 @@ def insert_duplicate_pairs(list_duplicate_pairs):
             conn.close()
 
 
+# In[ ]:
+
+
+# normalized pair storage: the signature of a document never changes between the pairs it
+# is in, so with --normalized-storage every signature is written once to syllabus_signatures
+# and the pair rows of syllabus_pairs only hold group keys, ids and scores; the view below
+# (created by --migrate-storage in place of the similar_syllabi table) keeps the existing
+# queries on similar_syllabi working
+normalized_pair_storage = False
+
+SIMILAR_SYLLABI_VIEW = """CREATE VIEW similar_syllabi AS
+    SELECT p.grid_name, p.field_name, p.year, p.id1, p.id2,
+           s1.top_words as id1_top_10_significant_words, s2.top_words as id2_top_10_significant_words,
+           p.accuracy_score, p.jaccard_score
+    from syllabus_pairs p join syllabus_signatures s1 on s1.id = p.id1 join syllabus_signatures s2 on s2.id = p.id2"""
+
+SIMILAR_SYLLABI_SYMMETRIC_VIEW = """CREATE OR REPLACE VIEW similar_syllabi_symmetric AS
+    SELECT grid_name, field_name, year, id1 as id, id2 as other_id, id1_top_10_significant_words as top_10_significant_words,
+           id2_top_10_significant_words as other_top_10_significant_words, accuracy_score, jaccard_score from similar_syllabi
+    union all
+    SELECT grid_name, field_name, year, id2, id1, id2_top_10_significant_words, id1_top_10_significant_words, accuracy_score, jaccard_score
+    from similar_syllabi"""
+
+
+def insert_normalized_duplicate_pairs(list_duplicate_pairs):
+    # similar_syllabi rows split into syllabus_signatures (once per document) and syllabus_pairs
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        top_words = {}
+        for pair in list_duplicate_pairs:
+            top_words[pair[3]] = pair[5]
+            top_words[pair[4]] = pair[6]
+        psycopg2.extras.execute_values(cur, """insert into syllabus_signatures (id, top_words) values %s
+                                               on conflict (id) do update set top_words = excluded.top_words""",
+                                       sorted(top_words.items()), template=None, page_size=1000)
+        upsert_duplicate_pairs(cur, 'syllabus_pairs', ['grid_name', 'field_name', 'year', 'id1', 'id2', 'accuracy_score', 'jaccard_score'],
+                               [pair[:5] + pair[7:] for pair in list_duplicate_pairs])
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def migrate_to_normalized_storage():
+    # moves the similar_syllabi rows to the normalized tables and replaces the table by the view,
+    # the old table is kept as similar_syllabi_wide until it is dropped by hand
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("""INSERT into syllabus_signatures (id, top_words)
+                       SELECT distinct on (id) id, top_words from (
+                           SELECT id1 as id, id1_top_10_significant_words as top_words from similar_syllabi
+                           union all
+                           SELECT id2, id2_top_10_significant_words from similar_syllabi) as words
+                       on conflict (id) do nothing""")
+        cur.execute("""INSERT into syllabus_pairs (grid_name, field_name, year, id1, id2, accuracy_score, jaccard_score)
+                       SELECT grid_name, field_name, year, least(id1, id2), greatest(id1, id2), accuracy_score, jaccard_score from similar_syllabi
+                       on conflict (id1, id2) do nothing""")
+        cur.execute("ALTER TABLE similar_syllabi RENAME TO similar_syllabi_wide")
+        cur.execute(SIMILAR_SYLLABI_VIEW)
+        # the symmetric view followed the renamed table, point it to the compatibility view
+        cur.execute(SIMILAR_SYLLABI_SYMMETRIC_VIEW)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def storage_report():
+    # on-disk size (with indexes and TOAST) of the wide and the normalized pair storage
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        sizes = {}
+        for table in ['similar_syllabi', 'similar_syllabi_wide', 'syllabus_pairs', 'syllabus_signatures']:
+            # views (similar_syllabi after the migration) have no storage of their own
+            cur.execute("SELECT c.relkind, pg_total_relation_size(c.oid), c.reltuples from pg_class c where c.oid = to_regclass(%s)", (table,))
+            record = cur.fetchone()
+            if record is not None and record[0] == 'r':
+                sizes[table] = int(record[1])
+                print("\t{} = {:.1f} MB, ~{} rows".format(table, record[1] / 1024.0 / 1024.0, int(record[2])))
+        wide = sizes.get('similar_syllabi', sizes.get('similar_syllabi_wide'))
+        normalized = sizes.get('syllabus_pairs', 0) + sizes.get('syllabus_signatures', 0)
+        if wide and normalized:
+            print("\tnormalized storage = {:.1f}% of the wide storage".format(100.0 * normalized / wide))
+        return sizes
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
 # In[13]:
 
 
-def find_and_store_duplicate_syllabi(grid_name, year, field_name):
-    global stop
+def fetch_group_syllabi(grid_name, year, field_name):
     try:
-        # connect to existing database
         conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
         # Open a cursor to perform database operations
         cur = conn.cursor()
@@ -244,76 +854,6 @@ def find_and_store_duplicate_syllabi(grid_name, year, field_name):
         cur.execute(select_query)
         df = pd.DataFrame(cur.fetchall(), columns=['id', 'text_md5', 'text'])
         print("\tNO OF RECORDS = {}", len(df))
-
-        punctuation_translator = str.maketrans('', '', string.punctuation)
-
-
-        # PRE-PROCESSING REQUIRED:
-        # normalize by lowering the case, removing punctuations, removing numbers and english stop words
-        df['text_lower_case_words'] = df['text'].apply(lambda x: ' '.join([word for word in x.lower().translate(punctuation_translator).split() if not word.isdigit() and word not in stop]))
-        # the following pre-processing is required to improve quality of LSH results
-        # especially considering highly templated text in course descriptions
-        df['text_unique_words'] = df['text'].apply(lambda x: ' '.join([word for word in list(set(x.lower().translate(punctuation_translator).split())) if not word.isdigit() and word not in stop]))
-        common_words_series = pd.Series(' '.join(df['text_unique_words']).lower().strip(string.punctuation).split()).value_counts()
-        most_common_words_series = common_words_series[common_words_series > (0.5 * len(df))].dropna()
-        most_common_words_list = most_common_words_series.index.tolist()
-        df['text_without_common_words'] = df['text'].apply(lambda x: ' '.join([word for word in x.lower().translate(punctuation_translator).split() if word not in (most_common_words_list) and word not in stop]))
-        
-        # STEP 1: use LSH algorithm to find candidate duplicates
-        # find duplicates
-        # run through adding documents to the LSH cache
-        hasher = minhash.MinHasher(seeds=100, char_ngram=5, hashbytes=4)
-        lshcache = cache.Cache(bands=10, hasher=hasher)
-        
-        for idx in range(0, (len(df) - 1)):
-            lshcache.add_fingerprint(hasher.fingerprint(df.loc[idx, 'text_without_common_words']), df.loc[idx, 'id'])
-        
-        # for every bucket in the LSH cache get the candidate duplicates
-        # note this fast way to get candidate pairs with reasonable accuracy, that will be filtered later
-        candidate_pairs = set()
-        for b in lshcache.bins:
-            for bucket_id in b:
-                if len(b[bucket_id]) > 1: # if the bucket contains more than a single document
-                    pairs_ = set(itertools.combinations(b[bucket_id], r=2))
-                    candidate_pairs.update(pairs_)
-        list_candidate_pairs = list(candidate_pairs)
-        tsl = []
-        # df = df.set_index('id')
-        print("\tcandidate pairs found = {}", len(list_candidate_pairs))
-        
-        # STEP 2: use TFIDF to process the records associated with the candidate duplicates and generate signature text
-        tf = TfidfVectorizer(analyzer='word', ngram_range=(1,1), min_df = 0, stop_words = 'english')
-        tfidf_matrix =  tf.fit_transform(df['text_lower_case_words'])
-        feature_names = tf.get_feature_names()
-        dense = tfidf_matrix.todense()
-
-        for item in list_candidate_pairs:
-            idx1 = df.index[df['id'] == int(item[0])]
-            idx2 = df.index[df['id'] == int(item[1])]
-            episode1 = dense[idx1].tolist()[0]
-            episode2 = dense[idx2].tolist()[0]
-            phrase_scores1 = [pair for pair in zip(range(0, len(episode1)), episode1) if pair[1] > 0]
-            sorted_phrase_scores1 = sorted(phrase_scores1, key=lambda t: t[1] * -1)
-            phrase_scores2 = [pair for pair in zip(range(0, len(episode2)), episode2) if pair[1] > 0]
-            sorted_phrase_scores2 = sorted(phrase_scores2, key=lambda t: t[1] * -1)
-            list_summarized_text1 = []
-            list_summarized_text2 = []
-            for phrase, score in [(feature_names[word_id], score) for (word_id, score) in sorted_phrase_scores1][:10]:
-                # print('{0: <20} {1}'.format(phrase, score))
-                list_summarized_text1.append(phrase)
-            for phrase, score in [(feature_names[word_id], score) for (word_id, score) in sorted_phrase_scores2][:10]:
-                # print('{0: <20} {1}'.format(phrase, score))
-                list_summarized_text2.append(phrase)
-            
-            summarized_text1 = ' '.join(list_summarized_text1)
-            summarized_text2 = ' '.join(list_summarized_text2)
-            # STEP 3: apply fuzzy match for the two signature texts to generate accuracy score
-            fuzz_ratio = fuzz.token_set_ratio(summarized_text1, summarized_text2)
-            tsl.append((grid_name, field_name, int(year), int(item[0]), int(item[1]), summarized_text1, summarized_text2, fuzz_ratio))
-        # for item in list_candidate_pairs:
-        insert_duplicate_pairs(tsl)
-        
-        df = df.set_index('id')
         return df
     except Exception as e:
         if conn:
@@ -329,29 +869,2411 @@ def find_and_store_duplicate_syllabi(grid_name, year, field_name):
             conn.close()
 
 
+def preprocess_group_syllabi(df):
+    global stop
+    punctuation_translator = str.maketrans('', '', string.punctuation)
+
+    # PRE-PROCESSING REQUIRED:
+    # normalize by lowering the case, removing punctuations, removing numbers and english stop words
+    df['text_lower_case_words'] = df['text'].apply(lambda x: ' '.join([word for word in x.lower().translate(punctuation_translator).split() if not word.isdigit() and word not in stop]))
+    # the following pre-processing is required to improve quality of LSH results
+    # especially considering highly templated text in course descriptions
+    df['text_unique_words'] = df['text'].apply(lambda x: ' '.join([word for word in list(set(x.lower().translate(punctuation_translator).split())) if not word.isdigit() and word not in stop]))
+    common_words_series = pd.Series(' '.join(df['text_unique_words']).lower().strip(string.punctuation).split()).value_counts()
+    most_common_words_series = common_words_series[common_words_series > (0.5 * len(df))].dropna()
+    most_common_words_list = most_common_words_series.index.tolist()
+    df['text_without_common_words'] = df['text'].apply(lambda x: ' '.join([word for word in x.lower().translate(punctuation_translator).split() if word not in (most_common_words_list) and word not in stop]))
+    return df
+
+
+def group_signatures(documents, word_counts=None, idf_model=None, feature_hashing=None):
+    # STEP 2: use TFIDF to process the records and generate signature text
+    if feature_hashing is not None:
+        if idf_model is not None:
+            raise ValueError('the IDF models are fitted on terms and can not be used with feature hashing')
+        return group_hashed_signatures(documents, word_counts or document_word_counts(documents), feature_hashing)
+    tfidf_matrix, column_term_ids = group_tfidf(documents, word_counts, idf_model)
+    # top words as global token ids, so they are only turned into words when written out
+    top_word_ids = column_token_ids(top_significant_word_ids(tfidf_matrix), column_term_ids)
+    return GroupSignatures(top_word_ids, tfidf_matrix, token_words)
+
+
+def build_duplicate_pairs(grid_name, year, field_name, ids, signatures, rows1, rows2, scores, jaccard_scores=None):
+    # rows as stored in similar_syllabi
+    tsl = []
+    if jaccard_scores is None:
+        jaccard_scores = [None] * len(rows1)
+    for row1, row2, score, jaccard_score in zip(rows1, rows2, scores, jaccard_scores):
+        if ids[row1] > ids[row2]:
+            # canonical order id1 < id2
+            row1, row2 = row2, row1
+        summarized_text1 = signature_text(signatures.top_word_ids[row1], signatures.words)
+        summarized_text2 = signature_text(signatures.top_word_ids[row2], signatures.words)
+        if jaccard_score is not None:
+            jaccard_score = float(jaccard_score)
+        tsl.append((grid_name, field_name, int(year), int(ids[row1]), int(ids[row2]), summarized_text1, summarized_text2, int(score), jaccard_score))
+    return tsl
+
+
+def find_duplicate_pairs(documents, grid_name, year, field_name, scorer='token_set_ratio', verify_jaccard=False, workers=1, shard_threshold=None,
+                         idf_model=None, feature_hashing=None, new_after_id=None, db_candidates=False):
+    # runs STEP 1-3 on the document store of one group, returns the similar_syllabi rows
+    # (with new_after_id only the pairs involving a document with a larger id, with
+    # db_candidates STEP 1 is the band join on the stored MinHash signatures)
+    if not db_candidates and workers > 1 and shard_threshold is not None and len(documents.ids) >= shard_threshold:
+        return find_duplicate_pairs_sharded(documents, grid_name, year, field_name, scorer=scorer, verify_jaccard=verify_jaccard, workers=workers,
+                                            idf_model=idf_model, feature_hashing=feature_hashing, new_after_id=new_after_id)
+
+    # the following pre-processing is required to improve quality of LSH results
+    # especially considering highly templated text in course descriptions
+    word_counts = document_word_counts(documents)
+    texts = DocumentTexts(documents, common_word_ids(documents, word_counts))
+
+    # STEP 1: use LSH algorithm to find candidate duplicates
+    # fingerprint every document and hash the bands of the signature matrix,
+    # note this fast way to get candidate pairs with reasonable accuracy, that will be filtered later
+    if db_candidates:
+        sign_missing_documents(documents, 'triplet', (grid_name, year, field_name))
+        rows1, rows2 = id_pairs_to_rows(documents.ids, *candidate_id_pairs(fetch_candidate_buckets('triplet', (grid_name, year, field_name))))
+    else:
+        signature_matrix = fingerprint_matrix(texts, make_minhasher())
+        rows1, rows2 = candidate_pairs_from_band_hashes(band_hashes(signature_matrix, LSH_BANDS))
+    rows1, rows2 = pairs_with_new_documents(documents.ids, rows1, rows2, new_after_id)
+    print("\tcandidate pairs found = {}".format(len(rows1)))
+
+    # STEP 2: use TFIDF to process the records associated with the candidate duplicates and generate signature text
+    signatures = group_signatures(documents, word_counts, idf_model, feature_hashing)
+
+    # STEP 3: score the two signatures of every candidate pair to generate accuracy score
+    scores = score_candidate_pairs(signatures, rows1, rows2, scorer=scorer)
+    # optional verification: true Jaccard of the same 5-gram shingles the LSH estimates
+    jaccard_scores = None
+    if verify_jaccard:
+        jaccard_scores = exact_jaccard_scores(texts, rows1, rows2)
+    return build_duplicate_pairs(grid_name, year, field_name, documents.ids, signatures, rows1, rows2, scores, jaccard_scores)
+
+
+def find_and_store_duplicate_syllabi(grid_name, year, field_name, scorer='token_set_ratio', verify_jaccard=False, workers=1, shard_threshold=None,
+                                     idf_model=None, feature_hashing=None, new_after_id=None, db_candidates=False, db_tokens=False, zstd_texts=False,
+                                     group_cache=None, row_count=None):
+    documents = fetch_group_documents(grid_name, year, field_name, db_tokens=db_tokens, zstd_texts=zstd_texts, group_cache=group_cache,
+                                      row_count=row_count)
+    tsl = find_duplicate_pairs(documents, grid_name, year, field_name, scorer=scorer, verify_jaccard=verify_jaccard, workers=workers, shard_threshold=shard_threshold,
+                               idf_model=idf_model, feature_hashing=feature_hashing, new_after_id=new_after_id, db_candidates=db_candidates)
+    insert_duplicate_pairs(tsl)
+    return documents
+
+
 # In[ ]:
 
 
-'''
-# sample test
-%%time
-row = {'grid_name':"University of Michigan–Ann Arbor", \
-      'year':2011, \
-      'field_name':"Social Work."}
-df = find_and_store_duplicate_syllabi(row['grid_name'], row['year'], row['field_name'])
-'''
+# sharded path for a single oversized group: the signature matrix lives in shared
+# memory, worker processes fingerprint row ranges into it, hash and bucket a subset
+# of the bands each, and score chunks of the merged candidate pairs; the workers are
+# forked after STEP 2 so they inherit the group texts and signatures without pickling
+_shard_state = {}
 
 
-# In[12]:
+def _init_shard_worker(shm_name, shape, texts, signatures, scorer, verify_jaccard):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shard_state.update(shm=shm, signature_matrix=np.ndarray(shape, dtype=np.uint64, buffer=shm.buf),
+                        texts=texts, signatures=signatures, scorer=scorer, verify_jaccard=verify_jaccard)
+
+
+def _shard_fingerprint(row_range):
+    start, end = row_range
+    fingerprint_matrix(_shard_state['texts'][start:end], make_minhasher(), out=_shard_state['signature_matrix'][start:end])
+    return end - start
+
+
+def _shard_band_pairs(band_range):
+    # bucket the bands [first_band, last_band) of the shared signature matrix
+    first_band, last_band = band_range
+    signature_matrix = _shard_state['signature_matrix']
+    rows_per_band = signature_matrix.shape[1] // LSH_BANDS
+    hashes = band_hashes(signature_matrix[:, first_band * rows_per_band:last_band * rows_per_band], last_band - first_band)
+    codes = [bucket_pair_codes(hashes[:, band]) for band in range(hashes.shape[1])]
+    return np.unique(np.concatenate(codes)) if codes else np.zeros(0, dtype=np.int64)
+
+
+def _shard_score(pair_chunk):
+    rows1, rows2 = pair_chunk
+    scores = score_candidate_pairs(_shard_state['signatures'], rows1, rows2, scorer=_shard_state['scorer'])
+    jaccard_scores = None
+    if _shard_state['verify_jaccard']:
+        jaccard_scores = exact_jaccard_scores(_shard_state['texts'], rows1, rows2)
+    return scores, jaccard_scores
+
+
+def split_ranges(total, num_chunks):
+    bounds = np.linspace(0, total, num=min(max(num_chunks, 1), max(total, 1)) + 1).astype(np.int64)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def find_duplicate_pairs_sharded(documents, grid_name, year, field_name, scorer='token_set_ratio', verify_jaccard=False, workers=2, idf_model=None,
+                                 feature_hashing=None, new_after_id=None):
+    num_docs = len(documents.ids)
+    print("\tSHARDED over {} workers".format(workers))
+
+    # STEP 2 first, so that the forked workers inherit the signatures
+    word_counts = document_word_counts(documents)
+    texts = DocumentTexts(documents, common_word_ids(documents, word_counts))
+    signatures = group_signatures(documents, word_counts, idf_model, feature_hashing)
+
+    shape = (num_docs, LSH_SEEDS)
+    shm = shared_memory.SharedMemory(create=True, size=max(num_docs * LSH_SEEDS * 8, 1))
+    try:
+        with multiprocessing.get_context('fork').Pool(workers, initializer=_init_shard_worker,
+                                                      initargs=(shm.name, shape, texts, signatures, scorer, verify_jaccard)) as pool:
+            # STEP 1: fingerprint row ranges into the shared matrix, then bucket the bands in parallel
+            pool.map(_shard_fingerprint, split_ranges(num_docs, workers * 4))
+            band_codes = pool.map(_shard_band_pairs, split_ranges(LSH_BANDS, workers))
+            rows1, rows2 = decode_pair_codes(np.concatenate(band_codes), num_docs)
+            rows1, rows2 = pairs_with_new_documents(documents.ids, rows1, rows2, new_after_id)
+            print("\tcandidate pairs found = {}".format(len(rows1)))
+
+            # STEP 3: score chunks of the merged candidate pairs
+            chunks = [(rows1[start:end], rows2[start:end]) for start, end in split_ranges(len(rows1), workers * 4)]
+            results = pool.map(_shard_score, chunks)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    scores = np.concatenate([result[0] for result in results]) if results else np.zeros(0, dtype=np.int64)
+    jaccard_scores = None
+    if verify_jaccard:
+        jaccard_scores = np.concatenate([result[1] for result in results]) if results else np.zeros(0)
+    return build_duplicate_pairs(grid_name, year, field_name, documents.ids, signatures, rows1, rows2, scores, jaccard_scores)
+
+
+# In[ ]:
+
+
+# memory budgeted (out-of-core) mode: a group whose estimated in-memory footprint is
+# larger than the budget is streamed twice through a server side cursor in chunks,
+# the first pass counts document frequencies (common words and TF-IDF vocabulary),
+# the second pass spills signatures, band tables, top words and shingles to memory
+# mapped files; candidate pairs are then generated, scored and inserted band by band
+GROUP_TEXT_COPIES = 8 # raw text, the three derived text columns and their split word lists
+OUT_OF_CORE_CHUNK_SIZE = 5000
+
+
+def estimate_group_footprint(num_docs, text_bytes):
+    # rough number of bytes find_and_store_duplicate_syllabi needs for the group
+    return int(text_bytes * GROUP_TEXT_COPIES + num_docs * (LSH_SEEDS + LSH_BANDS + 10) * 8)
+
+
+def stream_group_syllabi(grid_name, year, field_name, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # yields the group as DataFrames of at most chunk_size records, always in id order
+    return stream_syllabi("SELECT id, text from open_syllabi where grid_name=%s and year=%s and field_name=%s order by id",
+                          (grid_name, year, field_name), chunk_size)
+
+
+def stream_syllabi(query, param_list, chunk_size=OUT_OF_CORE_CHUNK_SIZE, cursor_name='stream_syllabi', columns=['id', 'text']):
+    # yields the (id, text) records of the query as DataFrames of at most chunk_size records
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        # named cursor, so the records stay on the server until fetched
+        cur = conn.cursor(name=cursor_name)
+        cur.itersize = chunk_size
+        cur.execute(query, param_list)
+        while True:
+            records = cur.fetchmany(chunk_size)
+            if not records:
+                break
+            yield pd.DataFrame(records, columns=columns)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def find_and_store_duplicate_syllabi_out_of_core(grid_name, year, field_name, scorer='token_set_ratio', verify_jaccard=False,
+                                                 chunk_size=OUT_OF_CORE_CHUNK_SIZE, spill_dir=None, idf_model=None, feature_hashing=None,
+                                                 new_after_id=None):
+    # returns False (nothing stored) if the group changed between the two passes, the caller
+    # leaves it to the next run instead of aborting every group still to come
+    if scorer == 'cosine':
+        raise ValueError('the cosine scorer needs the full TF-IDF matrix of the group and is not available out-of-core')
+    if feature_hashing is not None and idf_model is not None:
+        raise ValueError('the IDF models are fitted on terms and can not be used with feature hashing')
+    spill_path = tempfile.mkdtemp(prefix='litindex_', dir=spill_dir)
+    try:
+        # PASS 1: document frequencies of the unique words (common words) and of the TF-IDF terms
+        ids = []
+        word_document_counts = collections.Counter()
+        term_document_counts = collections.Counter()
+        column_document_counts = collections.Counter()
+        for chunk in stream_group_syllabi(grid_name, year, field_name, chunk_size):
+            ids.append(chunk['id'].values.astype(np.int64))
+            for text in chunk['text']:
+                document_word_ids = set(tokenize_text(text))
+                word_document_counts.update(document_word_ids)
+                document_term_ids = set(term_id for word_id in document_word_ids for term_id in word_terms(word_id))
+                if feature_hashing is None:
+                    term_document_counts.update(document_term_ids)
+                else:
+                    column_document_counts.update(set(term_column(term_id, feature_hashing)[0] for term_id in document_term_ids))
+        ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+        num_docs = len(ids)
+        print("\tNO OF RECORDS = {}".format(num_docs))
+        most_common_word_ids = np.array(sorted(word_id for word_id, count in word_document_counts.items()
+                                               if count > (0.5 * num_docs) and not token_words[word_id].isdigit()), dtype=np.int64)
+        column_term_ids = alphabetical_columns(term_document_counts)
+        column_of_term = {term_id: column for column, term_id in enumerate(column_term_ids)}
+        if feature_hashing is not None:
+            idf = hashed_column_idf(column_document_counts, num_docs, feature_hashing)
+        elif idf_model is None:
+            # smooth idf, as computed by TfidfVectorizer
+            document_counts = np.array([term_document_counts[term_id] for term_id in column_term_ids], dtype=np.float64)
+            idf = np.log((1.0 + num_docs) / (1.0 + document_counts)) + 1.0
+        else:
+            idf = idf_lookup(idf_model, column_term_ids)
+        del word_document_counts, term_document_counts, column_document_counts
+
+        # PASS 2: spill signatures, band table, top words (and shingles) to memory mapped files
+        signature_matrix = np.lib.format.open_memmap(os.path.join(spill_path, 'signatures.npy'), mode='w+', dtype=np.uint64, shape=(num_docs, LSH_SEEDS))
+        band_table = np.lib.format.open_memmap(os.path.join(spill_path, 'bands.npy'), mode='w+', dtype=np.uint64, shape=(num_docs, LSH_BANDS))
+        top_word_ids = np.lib.format.open_memmap(os.path.join(spill_path, 'top_words.npy'), mode='w+', dtype=np.int64, shape=(num_docs, 10))
+        shingle_offsets = np.zeros(num_docs + 1, dtype=np.int64)
+        hasher = make_minhasher()
+        row = 0
+        with open(os.path.join(spill_path, 'shingles.bin'), 'wb') as shingle_file:
+            for chunk in stream_group_syllabi(grid_name, year, field_name, chunk_size):
+                end = row + len(chunk)
+                if end > num_docs or not np.array_equal(chunk['id'].values.astype(np.int64), ids[row:end]):
+                    print("\tGROUP CHANGED WHILE IT WAS PROCESSED, SKIPPED")
+                    return False
+                texts_without_common_words = []
+                for pos, text in enumerate(chunk['text']):
+                    document_word_ids = np.array(tokenize_text(text), dtype=np.int64)
+                    kept_word_ids = document_word_ids[~np.isin(document_word_ids, most_common_word_ids)]
+                    texts_without_common_words.append(' '.join([token_words[word_id] for word_id in kept_word_ids]))
+                    term_counts = document_term_counts(document_word_ids.tolist())
+                    if feature_hashing is not None:
+                        top_word_ids[row + pos] = hashed_document_top_word_ids(term_counts, idf, feature_hashing)
+                        continue
+                    columns = np.fromiter((column_of_term[term_id] for term_id in term_counts), dtype=np.int64, count=len(term_counts))
+                    term_frequencies = np.fromiter(term_counts.values(), dtype=np.float64, count=len(term_counts))
+                    top_word_ids[row + pos] = column_token_ids(top_word_ids_of_row(columns, term_frequencies * idf[columns]), column_term_ids)
+                fingerprint_matrix(texts_without_common_words, hasher, out=signature_matrix[row:end])
+                band_table[row:end] = band_hashes(signature_matrix[row:end], LSH_BANDS)
+                if verify_jaccard:
+                    for pos, text in enumerate(texts_without_common_words):
+                        text_shingles = hashed_shingles(text)
+                        shingle_file.write(text_shingles.tobytes())
+                        shingle_offsets[row + pos + 1] = shingle_offsets[row + pos] + len(text_shingles)
+                row = end
+        if row != num_docs:
+            print("\tGROUP CHANGED WHILE IT WAS PROCESSED, SKIPPED")
+            return False
+        signature_matrix.flush()
+        del signature_matrix
+        shingle_buffer = np.zeros(0, dtype=np.uint64)
+        if verify_jaccard and shingle_offsets[-1] > 0:
+            shingle_buffer = np.memmap(os.path.join(spill_path, 'shingles.bin'), dtype=np.uint64, mode='r')
+
+        # STEP 1 + 3 band by band: a pair is kept only in the first band it collides in,
+        # so every candidate pair is scored and inserted exactly once
+        signatures = GroupSignatures(top_word_ids, None, token_words)
+        total_pairs = 0
+        for band in range(LSH_BANDS):
+            rows1, rows2 = decode_pair_codes(bucket_pair_codes(np.asarray(band_table[:, band])), num_docs)
+            for start in range(0, len(rows1), SCORER_BATCH_SIZE):
+                batch1 = rows1[start:start + SCORER_BATCH_SIZE]
+                batch2 = rows2[start:start + SCORER_BATCH_SIZE]
+                if band > 0:
+                    first_collision = ~(band_table[batch1, :band] == band_table[batch2, :band]).any(axis=1)
+                    batch1, batch2 = batch1[first_collision], batch2[first_collision]
+                batch1, batch2 = pairs_with_new_documents(ids, batch1, batch2, new_after_id)
+                if len(batch1) == 0:
+                    continue
+                scores = score_candidate_pairs(signatures, batch1, batch2, scorer=scorer)
+                jaccard_scores = None
+                if verify_jaccard:
+                    jaccard_scores = stored_exact_jaccard_scores(shingle_buffer, shingle_offsets, batch1, batch2)
+                insert_duplicate_pairs(build_duplicate_pairs(grid_name, year, field_name, ids, signatures, batch1, batch2, scores, jaccard_scores))
+                total_pairs += len(batch1)
+        print("\tcandidate pairs found = {}".format(total_pairs))
+        del band_table, top_word_ids, shingle_buffer, signatures
+        return True
+    finally:
+        shutil.rmtree(spill_path, ignore_errors=True)
+
+
+# In[ ]:
+
+
+# compact per-group document store: the ids of the group as an int64 array and the
+# normalized words of every document (lower case, no punctuation, no english stop
+# words) as global token ids in one flat int32 buffer, document row spans
+# token_ids[offsets[row]:offsets[row + 1]]; the raw text is dropped chunk by chunk
+# as soon as it is tokenized, and the derived texts are rebuilt only on access
+GroupDocuments = collections.namedtuple('GroupDocuments', ['ids', 'token_ids', 'offsets'])
+
+
+def tokenize_group_documents(chunks):
+    # chunks are DataFrames with id and text columns, e.g. from stream_group_syllabi()
+    ids = []
+    document_token_ids = array.array('i')
+    offsets = array.array('q', [0])
+    for chunk in chunks:
+        ids.append(chunk['id'].values.astype(np.int64))
+        for text in chunk['text']:
+            document_token_ids.extend(tokenize_text(text))
+            offsets.append(len(document_token_ids))
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    return GroupDocuments(ids, np.frombuffer(document_token_ids, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64))
+
+
+def document_tokens(documents, row):
+    return documents.token_ids[documents.offsets[row]:documents.offsets[row + 1]]
+
+
+def document_word_counts(documents):
+    # sparse (documents x group words) matrix of word counts, and the token id of every column
+    num_docs = len(documents.ids)
+    group_word_ids, columns = np.unique(documents.token_ids, return_inverse=True)
+    counts = sparse.csr_matrix((np.ones(len(columns), dtype=np.float64), columns.ravel(), documents.offsets),
+                               shape=(num_docs, len(group_word_ids)))
+    counts.sum_duplicates()
+    return counts, group_word_ids
+
+
+def common_word_ids(documents, word_counts=None):
+    # token ids of the words (never digits) that are in more than half of the documents,
+    # as computed from text_unique_words
+    if word_counts is None:
+        word_counts = document_word_counts(documents)
+    counts, group_word_ids = word_counts
+    document_frequency = np.bincount(counts.indices, minlength=len(group_word_ids))
+    is_digit = np.array([token_words[word_id].isdigit() for word_id in group_word_ids], dtype=bool)
+    return group_word_ids[(document_frequency > (0.5 * len(documents.ids))) & ~is_digit]
+
+
+class DocumentTexts(object):
+    # read only sequence of the space joined words of every document (text_without_common_words
+    # without the dropped common words), rebuilt on access instead of kept in memory
+    def __init__(self, documents, dropped_word_ids=None):
+        self.documents = documents
+        self.dropped_word_ids = dropped_word_ids
+
+    def __len__(self):
+        return len(self.documents.ids)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return [self[pos] for pos in range(*row.indices(len(self)))]
+        tokens = document_tokens(self.documents, row)
+        if self.dropped_word_ids is not None and len(self.dropped_word_ids):
+            tokens = tokens[~np.isin(tokens, self.dropped_word_ids)]
+        return ' '.join([token_words[token_id] for token_id in tokens])
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+
+def group_tfidf(documents, word_counts=None, idf_model=None):
+    # the TfidfVectorizer matrix of text_lower_case_words (same terms, smooth idf, l2 norm,
+    # alphabetical feature columns) computed from the word counts of the document store,
+    # returned with the token id of the term of every column; with an idf_model the idf
+    # is looked up in the model instead of fitted on the group
+    if word_counts is None:
+        word_counts = document_word_counts(documents)
+    counts, group_word_ids = word_counts
+    word_rows = []
+    word_term_ids = []
+    for row, word_id in enumerate(group_word_ids):
+        for term_id in word_terms(word_id):
+            word_rows.append(row)
+            word_term_ids.append(term_id)
+    column_term_ids = alphabetical_columns(set(word_term_ids))
+    word_columns = np.searchsorted(np.sort(column_term_ids), word_term_ids)
+    column_of_sorted = np.argsort(column_term_ids)
+    word_terms_matrix = sparse.csr_matrix((np.ones(len(word_rows), dtype=np.float64), (word_rows, column_of_sorted[word_columns])),
+                                          shape=(len(group_word_ids), len(column_term_ids)))
+    term_counts = (counts @ word_terms_matrix).tocsr()
+    term_counts.eliminate_zeros()
+    if idf_model is None:
+        document_frequency = np.bincount(term_counts.indices, minlength=len(column_term_ids))
+        idf = np.log((1.0 + len(documents.ids)) / (1.0 + document_frequency)) + 1.0
+    else:
+        idf = idf_lookup(idf_model, column_term_ids)
+    tfidf_matrix = term_counts.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(tfidf_matrix.multiply(tfidf_matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    tfidf_matrix = sparse.diags(1.0 / norms) @ tfidf_matrix
+    return tfidf_matrix.tocsr(), column_term_ids
+
+
+def column_token_ids(top_columns, column_term_ids):
+    # maps (-1 padded) TF-IDF columns to the token ids of their terms
+    top_word_ids = np.full(np.shape(top_columns), -1, dtype=np.int64)
+    found = top_columns >= 0
+    top_word_ids[found] = column_term_ids[top_columns[found]]
+    return top_word_ids
+
+
+def fetch_group_documents(grid_name, year, field_name, chunk_size=OUT_OF_CORE_CHUNK_SIZE, db_tokens=False, zstd_texts=False,
+                          group_cache=None, row_count=None):
+    if db_tokens:
+        # the precomputed token column, see compute_syllabus_tokens()
+        documents = stored_group_documents(stream_group_tokens(grid_name, year, field_name, chunk_size))
+    else:
+        if zstd_texts:
+            # the compressed text store, see compress_syllabus_texts()
+            chunks = stream_group_compressed_texts(grid_name, year, field_name, chunk_size)
+        else:
+            chunks = stream_group_syllabi(grid_name, year, field_name, chunk_size)
+        if group_cache is not None:
+            # the local copy of the group, see GroupCache
+            chunks = group_cache.fetch((grid_name, year, field_name), row_count, chunks)
+        documents = tokenize_group_documents(chunks)
+    print("\tNO OF RECORDS = {}".format(len(documents.ids)))
+    return documents
+
+
+def benchmark_group_memory(grid_name, year, field_name):
+    # peak and retained traced memory of the DataFrame preprocessing + TfidfVectorizer of the
+    # original job against the document store + group_tfidf(), both from the same fetched records
+    records = fetch_group_syllabi(grid_name, year, field_name)[['id', 'text']]
+    tracemalloc.start()
+    df = preprocess_group_syllabi(records.copy())
+    tf = TfidfVectorizer(analyzer='word', ngram_range=(1,1), min_df = 1, stop_words = 'english')
+    tfidf_matrix = tf.fit_transform(df['text_lower_case_words'])
+    dataframe_retained, dataframe_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del df, tf, tfidf_matrix
+
+    tracemalloc.start()
+    documents = tokenize_group_documents([records])
+    tfidf_matrix, column_term_ids = group_tfidf(documents)
+    store_retained, store_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del documents, tfidf_matrix, column_term_ids
+
+    megabyte = 1024.0 * 1024.0
+    print("\tDATAFRAME      peak = {:.1f} MB, retained = {:.1f} MB".format(dataframe_peak / megabyte, dataframe_retained / megabyte))
+    print("\tDOCUMENT STORE peak = {:.1f} MB, retained = {:.1f} MB".format(store_peak / megabyte, store_retained / megabyte))
+    return dataframe_peak, store_peak
+
+
+# In[ ]:
+
+
+# reusable IDF models: instead of fitting the idf on every (grid_name, year, field_name)
+# group, the idf can come from a model fitted once per institution (grid_name), per
+# field (field_name) or over the whole corpus, in a single streaming pass over the
+# same records the dedup job considers; every model is saved as an .npz file of sorted
+# term token ids and their smooth idf, and loaded lazily by the dedup job (and workers)
+IdfModel = collections.namedtuple('IdfModel', ['num_docs', 'term_ids', 'idf'])
+
+IDF_MODEL_DIR = './idf_models'
+IDF_SCOPE_COLUMNS = {'institution': 'grid_name', 'field': 'field_name', 'global': None}
+IDF_MODEL_CACHE_SIZE = 64
+_idf_models = collections.OrderedDict()
+
+
+def idf_model_key(idf_scope, grid_name, field_name):
+    return {'institution': grid_name, 'field': field_name, 'global': ''}[idf_scope]
+
+
+def idf_model_path(idf_scope, key, idf_model_dir=IDF_MODEL_DIR):
+    return os.path.join(idf_model_dir, idf_scope, hashlib.md5(key.encode('utf-8')).hexdigest() + '.npz')
+
+
+def save_idf_model(idf_scope, key, num_docs, term_document_counts, idf_model_dir=IDF_MODEL_DIR):
+    term_ids = np.array(sorted(term_document_counts), dtype=np.int64)
+    document_frequency = np.array([term_document_counts[term_id] for term_id in term_ids], dtype=np.float64)
+    idf = np.log((1.0 + num_docs) / (1.0 + document_frequency)) + 1.0
+    path = idf_model_path(idf_scope, key, idf_model_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, key=np.array(key), num_docs=np.array(num_docs), term_ids=term_ids.astype(np.int32), idf=idf)
+
+
+def load_idf_model(idf_scope, key, idf_model_dir=IDF_MODEL_DIR):
+    # lazily loaded, the IDF_MODEL_CACHE_SIZE most recently used models stay in memory
+    cache_key = (idf_model_dir, idf_scope, key)
+    if cache_key in _idf_models:
+        _idf_models.move_to_end(cache_key)
+        return _idf_models[cache_key]
+    path = idf_model_path(idf_scope, key, idf_model_dir)
+    if not os.path.exists(path):
+        raise ValueError('no {} IDF model for {}, fit the models first with --fit-idf-models'.format(idf_scope, repr(key)))
+    with np.load(path) as model_file:
+        idf_model = IdfModel(int(model_file['num_docs']), model_file['term_ids'].astype(np.int64), model_file['idf'])
+    _idf_models[cache_key] = idf_model
+    if len(_idf_models) > IDF_MODEL_CACHE_SIZE:
+        _idf_models.popitem(last=False)
+    return idf_model
+
+
+def group_idf_model(idf_scope, grid_name, field_name, idf_model_dir=IDF_MODEL_DIR):
+    # None (the idf of the group itself) for the group scope, else the model of the group's institution, field or corpus
+    if idf_scope == 'group':
+        return None
+    return load_idf_model(idf_scope, idf_model_key(idf_scope, grid_name, field_name), idf_model_dir)
+
+
+def idf_lookup(idf_model, term_ids):
+    # idf of every term id, terms the model has never seen get the idf of a document frequency of 0
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    idf = np.full(len(term_ids), np.log(1.0 + idf_model.num_docs) + 1.0)
+    if len(idf_model.term_ids) == 0:
+        return idf
+    positions = np.minimum(np.searchsorted(idf_model.term_ids, term_ids), len(idf_model.term_ids) - 1)
+    found = idf_model.term_ids[positions] == term_ids
+    idf[found] = idf_model.idf[positions[found]]
+    return idf
+
+
+def fit_idf_models(idf_scope, idf_model_dir=IDF_MODEL_DIR, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # one pass over the records ordered by the scope column, so that every model is saved
+    # (and its counts dropped) as soon as the records of its key are counted
+    column = IDF_SCOPE_COLUMNS[idf_scope]
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor(name='fit_idf_models')
+        cur.itersize = chunk_size
+        if column is None:
+            cur.execute("SELECT '' as key, text from open_syllabi where grid_name != 'NaN' and year > 0 and grid_country_code='US'")
+        else:
+            cur.execute("SELECT {0} as key, text from open_syllabi where grid_name != 'NaN' and year > 0 and grid_country_code='US' order by {0}".format(column))
+        current_key = None
+        num_docs = 0
+        num_models = 0
+        term_document_counts = collections.Counter()
+        while True:
+            records = cur.fetchmany(chunk_size)
+            if not records:
+                break
+            for key, text in records:
+                if key != current_key:
+                    if num_docs > 0:
+                        save_idf_model(idf_scope, current_key, num_docs, term_document_counts, idf_model_dir)
+                        num_models += 1
+                    current_key = key
+                    num_docs = 0
+                    term_document_counts = collections.Counter()
+                document_word_ids = set(tokenize_text(text))
+                term_document_counts.update(set(term_id for word_id in document_word_ids for term_id in word_terms(word_id)))
+                num_docs += 1
+        if num_docs > 0:
+            save_idf_model(idf_scope, current_key, num_docs, term_document_counts, idf_model_dir)
+            num_models += 1
+        return num_models
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+# In[ ]:
+
+
+# hashing feature mode for STEP 2: the TF-IDF terms are hashed into a fixed number of
+# columns (murmurhash3 with an optional alternating sign, as HashingVectorizer does),
+# so the feature space does not depend on a vocabulary and is the same in every process;
+# the word of a column is only looked up for the columns that made it into a top 10
+FeatureHashing = collections.namedtuple('FeatureHashing', ['n_features', 'alternate_sign'])
+_term_hashes = {}
+
+
+def term_column(term_id, feature_hashing):
+    term_hash = _term_hashes.get(term_id)
+    if term_hash is None:
+        term_hash = _term_hashes[term_id] = murmurhash3_32(token_words[term_id], seed=0)
+    sign = -1.0 if (feature_hashing.alternate_sign and term_hash < 0) else 1.0
+    return abs(term_hash) % feature_hashing.n_features, sign
+
+
+def hashed_column_idf(column_document_counts, num_docs, feature_hashing):
+    # smooth idf of every hashed column, column_document_counts maps columns to document frequencies
+    idf = np.ones(feature_hashing.n_features, dtype=np.float64)
+    columns = np.fromiter(column_document_counts.keys(), dtype=np.int64, count=len(column_document_counts))
+    document_frequency = np.fromiter(column_document_counts.values(), dtype=np.float64, count=len(column_document_counts))
+    idf[columns] = np.log((1.0 + num_docs) / (1.0 + document_frequency)) + 1.0
+    return idf
+
+
+def hashed_document_top_word_ids(term_counts, column_idf, feature_hashing, top_n=10):
+    # top_n columns of one document by TF-IDF magnitude, term_counts maps the term ids of the document
+    # to their counts; the reverse map is only kept for the document's columns, the term of a
+    # colliding column is its most frequent term in the document
+    hashed_counts = collections.defaultdict(float)
+    column_terms = {}
+    for term_id, count in term_counts.items():
+        column, sign = term_column(term_id, feature_hashing)
+        hashed_counts[column] += sign * count
+        best_term_id = column_terms.get(column)
+        if best_term_id is None or (count, -term_id) > (term_counts[best_term_id], -best_term_id):
+            column_terms[column] = term_id
+    columns = np.fromiter(hashed_counts.keys(), dtype=np.int64, count=len(hashed_counts))
+    values = np.fromiter(hashed_counts.values(), dtype=np.float64, count=len(hashed_counts))
+    top_columns = top_word_ids_of_row(columns, np.abs(values * column_idf[columns]), top_n)
+    return np.array([column_terms[column] if column >= 0 else -1 for column in top_columns], dtype=np.int64)
+
+
+def document_term_counts(word_ids):
+    return collections.Counter(term_id for word_id in word_ids for term_id in word_terms(word_id))
+
+
+def group_hashed_signatures(documents, word_counts, feature_hashing):
+    counts, group_word_ids = word_counts
+    word_rows = []
+    columns = []
+    signs = []
+    for row, word_id in enumerate(group_word_ids):
+        for term_id in word_terms(word_id):
+            column, sign = term_column(term_id, feature_hashing)
+            word_rows.append(row)
+            columns.append(column)
+            signs.append(sign)
+    word_columns = sparse.csr_matrix((np.array(signs, dtype=np.float64), (word_rows, columns)),
+                                     shape=(len(group_word_ids), feature_hashing.n_features))
+    hashed_counts = (counts @ word_columns).tocsr()
+    # a column is in a document even when the signs of its terms cancel out
+    document_columns = (counts @ abs(word_columns)).tocsr()
+    document_columns.eliminate_zeros()
+    used_columns, document_frequency = np.unique(document_columns.indices, return_counts=True)
+    idf = hashed_column_idf(dict(zip(used_columns.tolist(), document_frequency.tolist())), len(documents.ids), feature_hashing)
+    tfidf_matrix = hashed_counts.multiply(idf).tocsr()
+    norms = np.sqrt(np.asarray(tfidf_matrix.multiply(tfidf_matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    tfidf_matrix = (sparse.diags(1.0 / norms) @ tfidf_matrix).tocsr()
+
+    top_word_ids = np.full((len(documents.ids), 10), -1, dtype=np.int64)
+    for row in range(len(documents.ids)):
+        top_word_ids[row] = hashed_document_top_word_ids(document_term_counts(document_tokens(documents, row).tolist()), idf, feature_hashing)
+    return GroupSignatures(top_word_ids, tfidf_matrix, token_words)
+
+
+# In[ ]:
+
+
+# persistent LSH band index: the band hashes of every processed document are kept in
+# lsh_band_index keyed by (grid_name, field_name, year, band, bucket_hash), so a new batch
+# of records is only fingerprinted and probed against the stored buckets instead of
+# recomputing the whole group; the common words dropped before fingerprinting are frozen
+# in lsh_index_scopes when the group is first indexed, so old and new fingerprints agree,
+# and the document frequencies of the indexed records are kept there too, so the group
+# idf of a batch is the idf a full run of the group would fit
+LSH_INDEX_PAGE_SIZE = 1000
+
+
+def load_lsh_index_scope(grid_name, year, field_name):
+    # (frozen common words, number of indexed records, {term token id: document frequency})
+    # of an indexed group, None if the group was never indexed
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT common_words, num_docs, idf_terms, idf_document_counts from lsh_index_scopes where grid_name=%s and year=%s and field_name=%s",
+                    (grid_name, year, field_name))
+        record = cur.fetchone()
+        if record is None:
+            return None
+        term_document_counts = collections.Counter({intern_word(term): int(count) for term, count in zip(record[2] or [], record[3] or [])})
+        return list(record[0] or []), int(record[1] or 0), term_document_counts
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def update_lsh_index_scope(grid_name, year, field_name, common_words, num_docs, term_document_counts):
+    # num_docs and term_document_counts replace the stored ones, they cover every indexed record
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        conn.autocommit = True
+        cur = conn.cursor()
+        term_ids = sorted(term_document_counts)
+        idf_terms = [token_words[term_id] for term_id in term_ids]
+        idf_document_counts = [term_document_counts[term_id] for term_id in term_ids]
+        cur.execute("""UPDATE lsh_index_scopes set num_docs = %s, idf_terms = %s, idf_document_counts = %s
+                       where grid_name=%s and year=%s and field_name=%s""",
+                    (num_docs, idf_terms, idf_document_counts, grid_name, year, field_name))
+        if cur.rowcount == 0:
+            cur.execute("""INSERT into lsh_index_scopes (grid_name, field_name, year, common_words, num_docs, idf_terms, idf_document_counts)
+                           values (%s, %s, %s, %s, %s, %s, %s)""",
+                        (grid_name, field_name, year, common_words, num_docs, idf_terms, idf_document_counts))
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def stream_new_group_syllabi(grid_name, year, field_name, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # records of the group that are not in the band index yet, in id order
+    return stream_syllabi("""SELECT s.id, s.text from open_syllabi s where s.grid_name=%s and s.year=%s and s.field_name=%s
+                             and not exists (select 1 from lsh_band_index l where l.grid_name=s.grid_name and l.year=s.year
+                                             and l.field_name=s.field_name and l.band=0 and l.id=s.id) order by s.id""",
+                          (grid_name, year, field_name), chunk_size, cursor_name='stream_new_group_syllabi')
+
+
+def stream_group_syllabi_by_ids(grid_name, year, field_name, ids, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # the records of ids still in the group, in id order
+    return stream_syllabi("SELECT id, text from open_syllabi where grid_name=%s and year=%s and field_name=%s and id = ANY(%s) order by id",
+                          (grid_name, year, field_name, [int(id) for id in ids]), chunk_size, cursor_name='stream_group_syllabi_by_ids')
+
+
+def indexed_band_ids(grid_name, year, field_name):
+    # ids of the indexed records of the group
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT id from lsh_band_index where grid_name=%s and year=%s and field_name=%s and band=0 order by id",
+                    (grid_name, year, field_name))
+        return np.array([record[0] for record in cur.fetchall()], dtype=np.int64)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def purge_lsh_band_index(grid_name, year, field_name):
+    # drops the index rows of records deleted from or moved out of the group, returns the number of records
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("""DELETE from lsh_band_index l where l.grid_name=%s and l.year=%s and l.field_name=%s
+                       and not exists (select 1 from open_syllabi s where s.id=l.id and s.grid_name=l.grid_name
+                                       and s.year=l.year and s.field_name=l.field_name) returning l.band""",
+                    (grid_name, year, field_name))
+        purged = sum(1 for record in cur.fetchall() if record[0] == 0)
+        cur.execute("UPDATE lsh_index_scopes set num_docs = greatest(num_docs - %s, 0) where grid_name=%s and year=%s and field_name=%s",
+                    (purged, grid_name, year, field_name))
+        conn.commit()
+        return purged
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def probe_lsh_band_index(grid_name, year, field_name, hashes):
+    # the indexed (band, bucket_hash, id) rows sharing a bucket with any row of hashes
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        bands = np.tile(np.arange(hashes.shape[1]), hashes.shape[0])
+        # bucket hashes are stored as signed bigint
+        bucket_hashes = hashes.view(np.int64).ravel()
+        cur.execute("""SELECT l.band, l.bucket_hash, l.id from lsh_band_index l
+                       join (select distinct * from unnest(%s::smallint[], %s::bigint[])) as p(band, bucket_hash)
+                       on l.band = p.band and l.bucket_hash = p.bucket_hash
+                       where l.grid_name=%s and l.year=%s and l.field_name=%s""",
+                    (bands.tolist(), bucket_hashes.tolist(), grid_name, year, field_name))
+        records = cur.fetchall()
+        return (np.array([record[0] for record in records], dtype=np.int64),
+                np.array([record[1] for record in records], dtype=np.int64),
+                np.array([record[2] for record in records], dtype=np.int64))
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def insert_lsh_band_index(grid_name, year, field_name, ids, hashes):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        conn.autocommit = True
+        cur = conn.cursor()
+        bucket_hashes = hashes.view(np.int64)
+        index_rows = ((grid_name, field_name, int(year), band, int(bucket_hashes[row, band]), int(ids[row]))
+                      for row in range(len(ids)) for band in range(hashes.shape[1]))
+        insert_query = 'insert into lsh_band_index (grid_name, field_name, year, band, bucket_hash, id) values %s'
+        psycopg2.extras.execute_values(cur, insert_query, index_rows, template=None, page_size=LSH_INDEX_PAGE_SIZE)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def index_probe_pairs(hashes, index_bands, index_hashes, index_ids):
+    # unique (row of hashes, indexed id) pairs sharing a bucket in at least one band
+    bucket_rows = collections.defaultdict(list)
+    signed_hashes = hashes.view(np.int64)
+    for row in range(hashes.shape[0]):
+        for band in range(hashes.shape[1]):
+            bucket_rows[(band, int(signed_hashes[row, band]))].append(row)
+    pairs = set()
+    for band, bucket_hash, id in zip(index_bands.tolist(), index_hashes.tolist(), index_ids.tolist()):
+        for row in bucket_rows.get((band, bucket_hash), ()):
+            pairs.add((row, id))
+    pairs = sorted(pairs)
+    return np.array([pair[0] for pair in pairs], dtype=np.int64), np.array([pair[1] for pair in pairs], dtype=np.int64)
+
+
+def term_document_counts(documents, counts=None):
+    # {term token id: number of documents containing it}, the document frequency group_tfidf() fits
+    if counts is None:
+        counts = collections.Counter()
+    for row in range(len(documents.ids)):
+        document_word_ids = set(documents.token_ids[documents.offsets[row]:documents.offsets[row + 1]].tolist())
+        counts.update(set(term_id for word_id in document_word_ids for term_id in word_terms(word_id)))
+    return counts
+
+
+def frozen_idf_model(num_docs, term_document_counts):
+    # the group idf of the indexed records as an IdfModel, same smooth idf as group_tfidf()
+    term_ids = np.array(sorted(term_document_counts), dtype=np.int64)
+    document_frequency = np.array([term_document_counts[term_id] for term_id in term_ids], dtype=np.float64)
+    return IdfModel(num_docs, term_ids, np.log((1.0 + num_docs) / (1.0 + document_frequency)) + 1.0)
+
+
+def concatenate_group_documents(first, second):
+    offsets = np.concatenate((first.offsets, second.offsets[1:] + first.offsets[-1]))
+    return GroupDocuments(np.concatenate((first.ids, second.ids)), np.concatenate((first.token_ids, second.token_ids)), offsets)
+
+
+def find_and_store_new_duplicate_syllabi(grid_name, year, field_name, scorer='token_set_ratio', verify_jaccard=False,
+                                         chunk_size=OUT_OF_CORE_CHUNK_SIZE, idf_model=None, feature_hashing=None):
+    # incremental STEP 1-3: only the records of the group missing from the band index are
+    # fingerprinted, paired with each other and with the indexed records sharing a bucket
+    scope = load_lsh_index_scope(grid_name, year, field_name)
+    new_documents = tokenize_group_documents(stream_new_group_syllabi(grid_name, year, field_name, chunk_size))
+    num_new = len(new_documents.ids)
+    print("\tNEW RECORDS = {}".format(num_new))
+    if num_new == 0:
+        return 0
+    if scope is None:
+        # first run on the group: every record is new, same as find_and_store_duplicate_syllabi
+        dropped_word_ids = common_word_ids(new_documents)
+        common_words = [token_words[word_id] for word_id in dropped_word_ids]
+        indexed_docs, indexed_document_counts = 0, collections.Counter()
+    else:
+        common_words, indexed_docs, indexed_document_counts = scope
+        dropped_word_ids = np.array([intern_word(word) for word in common_words], dtype=np.int64)
+        # records deleted from or moved out of the group since they were indexed: their rows are
+        # dropped and the frozen document frequencies refitted on the records still in the group
+        # (also when the group was indexed before the document frequencies were kept)
+        purged = purge_lsh_band_index(grid_name, year, field_name)
+        if purged > 0 or (indexed_docs > 0 and not indexed_document_counts):
+            print("\tSTALE INDEXED RECORDS PURGED = {}".format(purged))
+            indexed_documents = tokenize_group_documents(stream_group_syllabi_by_ids(grid_name, year, field_name, indexed_band_ids(grid_name, year, field_name),
+                                                                                     chunk_size))
+            indexed_docs, indexed_document_counts = len(indexed_documents.ids), term_document_counts(indexed_documents)
+    num_docs = indexed_docs + num_new
+    document_counts = term_document_counts(new_documents, indexed_document_counts)
+
+    # STEP 1: pairs among the new records, and between new and indexed records
+    hashes = band_hashes(fingerprint_matrix(DocumentTexts(new_documents, dropped_word_ids), make_minhasher()), LSH_BANDS)
+    rows1, rows2 = candidate_pairs_from_band_hashes(hashes)
+    probe_rows, indexed_ids = index_probe_pairs(hashes, *probe_lsh_band_index(grid_name, year, field_name, hashes))
+    print("\tcandidate pairs found = {}".format(len(rows1) + len(probe_rows)))
+    indexed_documents = tokenize_group_documents(stream_group_syllabi_by_ids(grid_name, year, field_name, np.unique(indexed_ids), chunk_size))
+    # indexed records deleted from the group since the purge above have no row
+    is_stale = ~np.isin(indexed_ids, indexed_documents.ids)
+    probe_rows, indexed_ids = probe_rows[~is_stale], indexed_ids[~is_stale]
+    documents = concatenate_group_documents(new_documents, indexed_documents)
+    rows1 = np.concatenate((rows1, probe_rows))
+    rows2 = np.concatenate((rows2, num_new + id_pairs_to_rows(indexed_documents.ids, indexed_ids, indexed_ids)[0]))
+    # id1 < id2, as in the pairs of a whole group
+    swap = documents.ids[rows1] > documents.ids[rows2]
+    rows1, rows2 = np.where(swap, rows2, rows1), np.where(swap, rows1, rows2)
+
+    # STEP 2 on the new and the colliding indexed records, the group scope idf is the frozen
+    # one of all the indexed and new records, as a full run of the group would fit it
+    if idf_model is None and feature_hashing is None:
+        idf_model = frozen_idf_model(num_docs, document_counts)
+    signatures = group_signatures(documents, None, idf_model, feature_hashing)
+
+    # STEP 3
+    scores = score_candidate_pairs(signatures, rows1, rows2, scorer=scorer)
+    jaccard_scores = None
+    if verify_jaccard:
+        jaccard_scores = exact_jaccard_scores(DocumentTexts(documents, dropped_word_ids), rows1, rows2)
+    insert_duplicate_pairs(build_duplicate_pairs(grid_name, year, field_name, documents.ids, signatures, rows1, rows2, scores, jaccard_scores))
+    insert_lsh_band_index(grid_name, year, field_name, new_documents.ids, hashes)
+    update_lsh_index_scope(grid_name, year, field_name, common_words, num_docs, document_counts)
+    return num_new
+
+
+# In[ ]:
+
+
+# ingest watermark: after a group is processed its membership (max id, row count and
+# the sum of the ids as checksum) is saved in dedup_watermarks; the next run skips the
+# groups whose membership did not change, only pairs the records appended after the
+# saved max id when the older records are untouched, and recomputes the rest from scratch
+def fetch_dedup_watermarks():
+    # {(grid_name, year, field_name): (max_id, row_count, id_sum)}
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT grid_name, year, field_name, max_id, row_count, id_sum from dedup_watermarks")
+        return {(record[0], record[1], record[2]): (int(record[3]), int(record[4]), int(record[5])) for record in cur.fetchall()}
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def fetch_group_id_checksum(grid_name, year, field_name, max_id):
+    # row count and id sum of the records of the group up to max_id
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT count(*), coalesce(sum(id), 0) from open_syllabi where grid_name=%s and year=%s and field_name=%s and id <= %s",
+                    (grid_name, year, field_name, max_id))
+        row_count, id_sum = cur.fetchone()
+        return int(row_count), int(id_sum)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def save_dedup_watermark(grid_name, year, field_name, max_id, row_count, id_sum):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("UPDATE dedup_watermarks set max_id=%s, row_count=%s, id_sum=%s where grid_name=%s and year=%s and field_name=%s",
+                    (max_id, row_count, id_sum, grid_name, year, field_name))
+        if cur.rowcount == 0:
+            cur.execute("INSERT into dedup_watermarks (grid_name, field_name, year, max_id, row_count, id_sum) values (%s, %s, %s, %s, %s, %s)",
+                        (grid_name, field_name, year, max_id, row_count, id_sum))
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def delete_group_duplicate_pairs(grid_name, year, field_name):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        conn.autocommit = True
+        cur = conn.cursor()
+        pair_table = 'syllabus_pairs' if normalized_pair_storage else 'similar_syllabi'
+        cur.execute("DELETE from " + pair_table + " where grid_name=%s and year=%s and field_name=%s", (grid_name, year, field_name))
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def group_change(row, watermark):
+    # ('unchanged' | 'appended' | 'changed', watermark max id) of a fetch_all_grid_name__year__field_names() row
+    if watermark is None:
+        return 'changed', None
+    max_id, row_count, id_sum = watermark
+    if (int(row['max_id']), int(row['cnt']), int(row['id_sum'])) == (max_id, row_count, id_sum):
+        return 'unchanged', max_id
+    if int(row['max_id']) > max_id and fetch_group_id_checksum(row['grid_name'], row['year'], row['field_name'], max_id) == (row_count, id_sum):
+        return 'appended', max_id
+    return 'changed', None
+
+
+# In[ ]:
+
+
+# cross-year mode: syllabi reused year after year fall into different (grid_name, year,
+# field_name) groups, so the LSH index is built once per (grid_name, field_name) over all
+# years and only the pairs of records from different years are kept; the same-year pairs
+# are left to the per-year groups, the scope costs one pass over the records
+def fetch_all_grid_name__field_names():
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        # same filter as fetch_all_grid_name__year__field_names, only scopes spanning several years
+        cur.execute("""SELECT grid_name, field_name, count(*) as cnt, count(distinct year) as years from open_syllabi where grid_name != 'NaN' and year > 0 and grid_country_code='US' group by grid_name, field_name having count(distinct year) > 1 order by cnt desc""")
+        return pd.DataFrame(cur.fetchall(), columns=['grid_name', 'field_name', 'cnt', 'years'])
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def fetch_institution_field_documents(grid_name, field_name, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # document store of all years of (grid_name, field_name), and the year of every document
+    years = []
+
+    def chunks():
+        for chunk in stream_syllabi("SELECT id, text, year from open_syllabi where grid_name=%s and field_name=%s and grid_name != 'NaN' and year > 0 and grid_country_code='US' order by id",
+                                    (grid_name, field_name), chunk_size, cursor_name='stream_institution_field_syllabi',
+                                    columns=['id', 'text', 'year']):
+            years.append(chunk['year'].values.astype(np.int64))
+            yield chunk
+
+    documents = tokenize_group_documents(chunks())
+    print("\tNO OF RECORDS = {}".format(len(documents.ids)))
+    return documents, (np.concatenate(years) if years else np.zeros(0, dtype=np.int64))
+
+
+def insert_cross_year_duplicate_pairs(list_duplicate_pairs):
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        upsert_duplicate_pairs(cur, 'similar_syllabi_cross_year', ['grid_name', 'field_name', 'year1', 'year2', 'id1', 'id2', 'id1_top_10_significant_words',
+                                                                   'id2_top_10_significant_words', 'accuracy_score', 'jaccard_score'], list_duplicate_pairs)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def find_cross_year_duplicate_pairs(documents, years, grid_name, field_name, scorer='token_set_ratio', verify_jaccard=False,
+                                    idf_model=None, feature_hashing=None):
+    # STEP 1-3 on all years of (grid_name, field_name), returns the similar_syllabi_cross_year rows
+    word_counts = document_word_counts(documents)
+    texts = DocumentTexts(documents, common_word_ids(documents, word_counts))
+
+    # STEP 1, keeping the pairs across years only
+    rows1, rows2 = candidate_pairs_from_band_hashes(band_hashes(fingerprint_matrix(texts, make_minhasher()), LSH_BANDS))
+    cross_year = years[rows1] != years[rows2]
+    rows1, rows2 = rows1[cross_year], rows2[cross_year]
+    print("\tcross-year candidate pairs found = {}".format(len(rows1)))
+
+    # STEP 2 + 3
+    signatures = group_signatures(documents, word_counts, idf_model, feature_hashing)
+    scores = score_candidate_pairs(signatures, rows1, rows2, scorer=scorer)
+    jaccard_scores = None
+    if verify_jaccard:
+        jaccard_scores = exact_jaccard_scores(texts, rows1, rows2)
+    # similar_syllabi rows with the year replaced by the years of both records
+    tsl = build_duplicate_pairs(grid_name, 0, field_name, documents.ids, signatures, rows1, rows2, scores, jaccard_scores)
+    return [pair[:2] + (int(years[row1]), int(years[row2])) + pair[3:] for pair, row1, row2 in zip(tsl, rows1, rows2)]
+
+
+def find_and_store_cross_year_duplicate_syllabi(grid_name, field_name, scorer='token_set_ratio', verify_jaccard=False,
+                                                chunk_size=OUT_OF_CORE_CHUNK_SIZE, idf_model=None, feature_hashing=None):
+    documents, years = fetch_institution_field_documents(grid_name, field_name, chunk_size)
+    tsl = find_cross_year_duplicate_pairs(documents, years, grid_name, field_name, scorer=scorer, verify_jaccard=verify_jaccard,
+                                          idf_model=idf_model, feature_hashing=feature_hashing)
+    insert_cross_year_duplicate_pairs(tsl)
+    return len(tsl)
+
+
+# In[ ]:
+
+
+# corpus-wide mode: copies of a syllabus posted by different institutions are never in the
+# same group, so the whole corpus is streamed once in id order; the band hashes of every
+# chunk are appended to disk partitions (by bucket hash), then every partition is joined
+# on its own and the colliding row pairs are spread over pair partitions (by pair code),
+# so a pair found in several bands is scored and inserted once; memory is bounded by
+# the largest partition, STEP 2 uses the saved global IDF model (a corpus idf can not be
+# fitted in the single pass) and only pairs of different institutions are kept
+CORPUS_PARTITIONS = 64
+# all pairs of a bucket are built at once, corpus wide one bucket of identical boilerplate (or
+# empty) texts can hold tens of thousands of records, such buckets are skipped
+CORPUS_MAX_BUCKET_SIZE = 2000
+BAND_ENTRY_DTYPE = np.dtype([('band', '<u2'), ('bucket_hash', '<u8'), ('row', '<i8')])
+
+
+def corpus_filter(all_countries=False):
+    return "grid_name != 'NaN'" if all_countries else "grid_name != 'NaN' and grid_country_code='US'"
+
+
+def fetch_corpus_size(all_countries=False):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT count(*) from open_syllabi where " + corpus_filter(all_countries))
+        return int(cur.fetchone()[0])
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def stream_corpus_syllabi(all_countries=False, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    return stream_syllabi("SELECT id, text, grid_name from open_syllabi where " + corpus_filter(all_countries) + " order by id", (),
+                          chunk_size, cursor_name='stream_corpus_syllabi', columns=['id', 'text', 'grid_name'])
+
+
+def insert_corpus_duplicate_pairs(list_duplicate_pairs):
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        upsert_duplicate_pairs(cur, 'similar_syllabi_corpus', ['grid_name1', 'grid_name2', 'id1', 'id2', 'id1_top_10_significant_words',
+                                                               'id2_top_10_significant_words', 'accuracy_score', 'jaccard_score'], list_duplicate_pairs)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def write_band_partitions(partition_files, hashes, first_row):
+    # appends the (band, bucket_hash, row) entries of a chunk to the partition of their bucket hash
+    num_docs, bands = hashes.shape
+    entries = np.zeros(num_docs * bands, dtype=BAND_ENTRY_DTYPE)
+    entries['band'] = np.tile(np.arange(bands), num_docs)
+    entries['bucket_hash'] = hashes.ravel()
+    entries['row'] = np.repeat(np.arange(first_row, first_row + num_docs), bands)
+    partitions = entries['bucket_hash'] % np.uint64(len(partition_files))
+    for partition in np.unique(partitions):
+        partition_files[int(partition)].write(entries[partitions == partition].tobytes())
+
+
+def partition_pair_codes(entries, num_docs, max_bucket_size=CORPUS_MAX_BUCKET_SIZE):
+    # pair codes (row1 * num_docs + row2) of the entries of one partition sharing a bucket in the same band,
+    # the entries are in row order as they were appended chunk by chunk
+    codes = []
+    for band in np.unique(entries['band']):
+        band_entries = entries[entries['band'] == band]
+        local1, local2 = decode_pair_codes(bucket_pair_codes(band_entries['bucket_hash'], max_bucket_size), len(band_entries))
+        codes.append(band_entries['row'][local1] * num_docs + band_entries['row'][local2])
+    return np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+
+
+def find_and_store_corpus_duplicate_syllabi(idf_model, scorer='token_set_ratio', verify_jaccard=False, all_countries=False,
+                                            chunk_size=OUT_OF_CORE_CHUNK_SIZE, spill_dir=None, partitions=CORPUS_PARTITIONS,
+                                            max_bucket_size=CORPUS_MAX_BUCKET_SIZE):
+    if idf_model is None:
+        raise ValueError('the corpus-wide mode needs the saved global IDF model (--idf-scope global --fit-idf-models)')
+    if scorer == 'cosine':
+        raise ValueError('the cosine scorer needs the full TF-IDF matrix and is not available in the corpus-wide mode')
+    num_docs = fetch_corpus_size(all_countries)
+    print("\tNO OF RECORDS = {}".format(num_docs))
+    spill_path = tempfile.mkdtemp(prefix='litindex_corpus_', dir=spill_dir)
+    try:
+        # single pass: ids, institutions, top words (and shingles) per row, band entries per partition
+        ids = np.lib.format.open_memmap(os.path.join(spill_path, 'ids.npy'), mode='w+', dtype=np.int64, shape=(num_docs,))
+        institutions = np.lib.format.open_memmap(os.path.join(spill_path, 'institutions.npy'), mode='w+', dtype=np.int32, shape=(num_docs,))
+        top_word_ids = np.lib.format.open_memmap(os.path.join(spill_path, 'top_words.npy'), mode='w+', dtype=np.int64, shape=(num_docs, 10))
+        shingle_offsets = np.zeros(num_docs + 1, dtype=np.int64)
+        institution_codes = {}
+        hasher = make_minhasher()
+        row = 0
+        band_files = [open(os.path.join(spill_path, 'bands_{}.bin'.format(partition)), 'wb') for partition in range(partitions)]
+        try:
+            with open(os.path.join(spill_path, 'shingles.bin'), 'wb') as shingle_file:
+                for chunk in stream_corpus_syllabi(all_countries, chunk_size):
+                    grown = row + len(chunk) > num_docs
+                    if grown:
+                        # records inserted since the corpus was counted are left to the next run
+                        print("\tCORPUS GREW WHILE IT WAS PROCESSED, THE RECORDS AFTER {} ARE SKIPPED".format(num_docs))
+                        chunk = chunk.iloc[:num_docs - row]
+                        if len(chunk) == 0:
+                            break
+                    end = row + len(chunk)
+                    documents = tokenize_group_documents([chunk])
+                    texts = DocumentTexts(documents)
+                    ids[row:end] = documents.ids
+                    institutions[row:end] = [institution_codes.setdefault(grid_name, len(institution_codes)) for grid_name in chunk['grid_name']]
+                    tfidf_matrix, column_term_ids = group_tfidf(documents, idf_model=idf_model)
+                    top_word_ids[row:end] = column_token_ids(top_significant_word_ids(tfidf_matrix), column_term_ids)
+                    write_band_partitions(band_files, band_hashes(fingerprint_matrix(texts, hasher), LSH_BANDS), row)
+                    if verify_jaccard:
+                        for pos, text in enumerate(texts):
+                            text_shingles = hashed_shingles(text)
+                            shingle_file.write(text_shingles.tobytes())
+                            shingle_offsets[row + pos + 1] = shingle_offsets[row + pos] + len(text_shingles)
+                    row = end
+                    print("\tfingerprinted {} of {}".format(row, num_docs))
+                    if grown:
+                        break
+        finally:
+            for band_file in band_files:
+                band_file.close()
+        if row != num_docs:
+            # records deleted since the corpus was counted, the spilled arrays are only used up to row
+            print("\tCORPUS SHRANK WHILE IT WAS PROCESSED, {} OF {} RECORDS".format(row, num_docs))
+            num_docs = row
+        institution_names = sorted(institution_codes, key=institution_codes.get)
+        shingle_buffer = np.zeros(0, dtype=np.uint64)
+        if verify_jaccard and shingle_offsets[-1] > 0:
+            shingle_buffer = np.memmap(os.path.join(spill_path, 'shingles.bin'), dtype=np.uint64, mode='r')
+
+        # join the band partitions one at a time, spreading the pair codes over the pair partitions
+        pair_files = [open(os.path.join(spill_path, 'pairs_{}.bin'.format(partition)), 'wb') for partition in range(partitions)]
+        try:
+            for partition in range(partitions):
+                band_path = os.path.join(spill_path, 'bands_{}.bin'.format(partition))
+                if os.path.getsize(band_path) > 0:
+                    codes = partition_pair_codes(np.fromfile(band_path, dtype=BAND_ENTRY_DTYPE), num_docs, max_bucket_size)
+                    # pairs of the same institution are left to the per-group modes
+                    codes = codes[institutions[codes // num_docs] != institutions[codes % num_docs]]
+                    pair_partitions = codes % partitions
+                    for pair_partition in np.unique(pair_partitions):
+                        pair_files[int(pair_partition)].write(codes[pair_partitions == pair_partition].tobytes())
+                os.remove(band_path)
+        finally:
+            for pair_file in pair_files:
+                pair_file.close()
+
+        # STEP 3 per pair partition, each pair once
+        signatures = GroupSignatures(top_word_ids, None, token_words)
+        total_pairs = 0
+        for partition in range(partitions):
+            rows1, rows2 = decode_pair_codes(np.fromfile(os.path.join(spill_path, 'pairs_{}.bin'.format(partition)), dtype=np.int64), num_docs)
+            for start in range(0, len(rows1), SCORER_BATCH_SIZE):
+                batch1 = rows1[start:start + SCORER_BATCH_SIZE]
+                batch2 = rows2[start:start + SCORER_BATCH_SIZE]
+                scores = score_candidate_pairs(signatures, batch1, batch2, scorer=scorer)
+                jaccard_scores = None
+                if verify_jaccard:
+                    jaccard_scores = stored_exact_jaccard_scores(shingle_buffer, shingle_offsets, batch1, batch2)
+                tsl = build_duplicate_pairs('', 0, '', ids, signatures, batch1, batch2, scores, jaccard_scores)
+                insert_corpus_duplicate_pairs([(institution_names[institutions[row1]], institution_names[institutions[row2]]) + pair[3:]
+                                               for pair, row1, row2 in zip(tsl, batch1, batch2)])
+            total_pairs += len(rows1)
+        print("\tcross-institution candidate pairs found = {}".format(total_pairs))
+        del ids, institutions, top_word_ids, shingle_buffer, signatures
+        return total_pairs
+    finally:
+        shutil.rmtree(spill_path, ignore_errors=True)
+
+
+# In[ ]:
+
+
+# in-database MinHash: the fingerprints of every record are computed once (from the
+# normalized words, without dropping the common words of any scope, so one signature
+# serves every scope) and stored as a bytea of LSH_SEEDS little endian hashes in
+# syllabus_minhash, with the band hashes in the indexed syllabus_band_hashes; the
+# candidate buckets of any scope are then one GROUP BY band, band_hash inside Postgres
+# and a run with --db-candidates only reads the texts for STEP 2 and 3
+MINHASH_DTYPE = np.dtype('<u{}'.format(LSH_HASHBYTES)) # the fingerprints of the MinHasher fit in hashbytes
+MINHASH_FETCH_SIZE = 100000
+MINHASH_SCOPE_FILTERS = {
+    'triplet': "s.grid_name=%s and s.year=%s and s.field_name=%s",
+    'institution': "s.grid_name=%s and s.field_name=%s",
+    'corpus': "s.grid_name != 'NaN'",
+}
+
+
+def stream_unsigned_syllabi(chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # records without a stored MinHash signature, in id order
+    return stream_syllabi("""SELECT s.id, s.text from open_syllabi s
+                             where not exists (select 1 from syllabus_minhash m where m.id = s.id) order by s.id""",
+                          (), chunk_size, cursor_name='stream_unsigned_syllabi')
+
+
+def store_minhash_signatures(ids, signatures, hashes):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        buffer = io.StringIO()
+        for id, signature in zip(ids.tolist(), signatures):
+            buffer.write('{}\t\\\\x{}\n'.format(id, signature.astype(MINHASH_DTYPE).tobytes().hex()))
+        buffer.seek(0)
+        cur.copy_expert("COPY syllabus_minhash (id, signature) FROM STDIN", buffer)
+        signed_hashes = hashes.view(np.int64)
+        buffer = io.StringIO()
+        for row, id in enumerate(ids.tolist()):
+            for band in range(hashes.shape[1]):
+                buffer.write('{}\t{}\t{}\n'.format(id, band, signed_hashes[row, band]))
+        buffer.seek(0)
+        cur.copy_expert("COPY syllabus_band_hashes (id, band, band_hash) FROM STDIN", buffer)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def compute_minhash_signatures(chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # one pass over the records not signed yet
+    hasher = make_minhasher()
+    total = 0
+    for chunk in stream_unsigned_syllabi(chunk_size):
+        documents = tokenize_group_documents([chunk])
+        signatures = fingerprint_matrix(DocumentTexts(documents), hasher)
+        store_minhash_signatures(documents.ids, signatures, band_hashes(signatures, LSH_BANDS))
+        total += len(documents.ids)
+        print("\tsigned {}".format(total))
+    return total
+
+
+def fetch_signed_ids(scope, param_list):
+    # ids of the records of the scope with a stored signature
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT m.id from syllabus_minhash m join open_syllabi s on s.id = m.id where " + MINHASH_SCOPE_FILTERS[scope], param_list)
+        return np.array([record[0] for record in cur.fetchall()], dtype=np.int64)
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def select_group_documents(documents, rows):
+    # document store of the given rows
+    rows = np.asarray(rows, dtype=np.int64)
+    lengths = documents.offsets[rows + 1] - documents.offsets[rows]
+    token_ids = [document_tokens(documents, row) for row in rows.tolist()]
+    return GroupDocuments(documents.ids[rows], np.concatenate(token_ids) if token_ids else documents.token_ids[:0],
+                          np.concatenate(([0], np.cumsum(lengths))).astype(np.int64))
+
+
+def sign_missing_documents(documents, scope, param_list):
+    # fingerprints and stores the records of the document store without a stored signature
+    # (imported since the last --compute-minhash), so the band join sees every record
+    rows = np.flatnonzero(~np.isin(documents.ids, fetch_signed_ids(scope, param_list)))
+    if len(rows) > 0:
+        missing = select_group_documents(documents, rows)
+        signatures = fingerprint_matrix(DocumentTexts(missing), make_minhasher())
+        store_minhash_signatures(missing.ids, signatures, band_hashes(signatures, LSH_BANDS))
+        print("\tRECORDS WITHOUT STORED SIGNATURE = {} (signed now)".format(len(rows)))
+    return len(rows)
+
+
+def fetch_candidate_buckets(scope, param_list):
+    # ids of every bucket with more than one record of the scope, one array per (band, band_hash)
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor(name='fetch_candidate_buckets')
+        cur.itersize = MINHASH_FETCH_SIZE
+        cur.execute("""SELECT array_agg(h.id order by h.id) from syllabus_band_hashes h join open_syllabi s on s.id = h.id
+                       where """ + MINHASH_SCOPE_FILTERS[scope] + """ group by h.band, h.band_hash having count(*) > 1""", param_list)
+        return [np.array(record[0], dtype=np.int64) for record in cur]
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def candidate_id_pairs(buckets):
+    # unique (id1, id2) pairs with id1 < id2 of the buckets
+    ids1 = []
+    ids2 = []
+    for bucket in buckets:
+        first, second = np.triu_indices(len(bucket), k=1)
+        ids1.append(bucket[first])
+        ids2.append(bucket[second])
+    if not ids1:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.stack((np.concatenate(ids1), np.concatenate(ids2)), axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+def id_pairs_to_rows(ids, ids1, ids2):
+    # rows of the id pairs in the (sorted) ids of a document store, pairs of missing ids dropped
+    rows1 = np.searchsorted(ids, ids1)
+    rows2 = np.searchsorted(ids, ids2)
+    found = (rows1 < len(ids)) & (rows2 < len(ids))
+    found[found] = (ids[rows1[found]] == ids1[found]) & (ids[rows2[found]] == ids2[found])
+    return rows1[found], rows2[found]
+
+
+# In[ ]:
+
+
+# precomputed token column: --compute-tokens normalizes every record once (tokenize_text)
+# and stores its token stream as a bytea of little endian int32 token ids in
+# syllabus_tokens, the ids are those of the token dictionary file, which is saved before
+# the tokens referring to it are committed; a run with --db-tokens then reads the token
+# column of a group instead of shipping and normalizing the raw text
+TOKEN_DTYPE = np.dtype('<i4')
+
+
+def stream_untokenized_syllabi(chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    return stream_syllabi("""SELECT s.id, s.text from open_syllabi s
+                             where not exists (select 1 from syllabus_tokens t where t.id = s.id) order by s.id""",
+                          (), chunk_size, cursor_name='stream_untokenized_syllabi')
+
+
+def store_syllabus_tokens(documents):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        buffer = io.StringIO()
+        for row, id in enumerate(documents.ids.tolist()):
+            buffer.write('{}\t\\\\x{}\n'.format(id, document_tokens(documents, row).astype(TOKEN_DTYPE).tobytes().hex()))
+        buffer.seek(0)
+        cur.copy_expert("COPY syllabus_tokens (id, token_ids) FROM STDIN", buffer)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def compute_syllabus_tokens(token_dictionary_path=TOKEN_DICTIONARY_PATH, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # one pass over the records not tokenized yet
+    total = 0
+    for chunk in stream_untokenized_syllabi(chunk_size):
+        documents = tokenize_group_documents([chunk])
+        save_token_dictionary(token_dictionary_path)
+        store_syllabus_tokens(documents)
+        total += len(documents.ids)
+        print("\ttokenized {}".format(total))
+    return total
+
+
+def stream_group_tokens(grid_name, year, field_name, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # every record of the group, the text only for the records imported since the last --compute-tokens
+    return stream_syllabi("""SELECT s.id, t.token_ids, case when t.id is null then s.text end from open_syllabi s
+                             left join syllabus_tokens t on t.id = s.id
+                             where s.grid_name=%s and s.year=%s and s.field_name=%s order by s.id""",
+                          (grid_name, year, field_name), chunk_size, cursor_name='stream_group_tokens', columns=['id', 'token_ids', 'text'])
+
+
+def stored_group_documents(chunks):
+    # document store from (id, token_ids, text) chunks, e.g. from stream_group_tokens(),
+    # the records without stored tokens are tokenized from their text
+    ids = []
+    token_buffers = []
+    lengths = []
+    untokenized = 0
+    for chunk in chunks:
+        ids.append(chunk['id'].values.astype(np.int64))
+        texts = chunk['text'] if 'text' in chunk else [None] * len(chunk)
+        for token_ids, text in zip(chunk['token_ids'], texts):
+            if token_ids is None:
+                token_ids = np.array(tokenize_text(text), dtype=TOKEN_DTYPE).tobytes()
+                untokenized += 1
+            token_buffers.append(bytes(token_ids))
+            lengths.append(len(token_buffers[-1]) // TOKEN_DTYPE.itemsize)
+    if untokenized:
+        print("\tRECORDS WITHOUT STORED TOKENS = {} (tokenized from the text)".format(untokenized))
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64))).astype(np.int64)
+    return GroupDocuments(ids, np.frombuffer(b''.join(token_buffers), dtype=TOKEN_DTYPE).astype(np.int32), offsets)
+
+
+# In[ ]:
+
+
+# dictionary compressed text store: syllabi of one institution (or field) share large
+# templated blocks, so --compress-texts trains a zstd dictionary per institution or field
+# on a random sample of its records, keeps it in text_dictionaries and stores every text
+# compressed with the dictionary of its scope in syllabus_text_zstd; with --zstd-texts a
+# group is read from there and decompressed on the fly (zstandard is only needed for this)
+TEXT_DICTIONARY_SIZE = 112640
+TEXT_DICTIONARY_SAMPLES = 2000
+TEXT_DICTIONARY_MIN_SAMPLES = 8
+TEXT_COMPRESSION_LEVEL = 10
+TEXT_SCOPE_COLUMNS = {'institution': 'grid_name', 'field': 'field_name'}
+_text_decompressors = {}
+
+
+def require_zstd():
+    if zstd is None:
+        raise RuntimeError('the compressed text store needs the zstandard package')
+
+
+def fetch_text_scope_keys(text_scope):
+    # scope keys with records not compressed yet
+    column = TEXT_SCOPE_COLUMNS[text_scope]
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT distinct s." + column + " from open_syllabi s where not exists (select 1 from syllabus_text_zstd z where z.id = s.id)")
+        return sorted(record[0] for record in cur.fetchall())
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def text_dictionary(text_scope, key):
+    # (dictionary_id, zstd dictionary) of the scope key, trained and saved on first use;
+    # keys with too few records are compressed without a dictionary (dictionary_id None)
+    column = TEXT_SCOPE_COLUMNS[text_scope]
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        cur.execute("SELECT dictionary_id, dictionary from text_dictionaries where scope=%s and key=%s", (text_scope, key))
+        record = cur.fetchone()
+        if record is not None:
+            return record[0], zstd.ZstdCompressionDict(bytes(record[1]))
+        cur.execute("SELECT text from open_syllabi where " + column + "=%s and text is not null order by random() limit %s", (key, TEXT_DICTIONARY_SAMPLES))
+        samples = [record[0].encode('utf-8') for record in cur.fetchall()]
+        if len(samples) < TEXT_DICTIONARY_MIN_SAMPLES:
+            return None, None
+        try:
+            dictionary = zstd.train_dictionary(TEXT_DICTIONARY_SIZE, samples)
+        except zstd.ZstdError:
+            return None, None
+        cur.execute("INSERT into text_dictionaries (scope, key, dictionary) values (%s, %s, %s) returning dictionary_id",
+                    (text_scope, key, psycopg2.Binary(dictionary.as_bytes())))
+        dictionary_id = cur.fetchone()[0]
+        conn.commit()
+        return dictionary_id, dictionary
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def store_compressed_texts(ids, blobs, dictionary_id):
+    conn = None
+    cur = None
+    try:
+        conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+        cur = conn.cursor()
+        buffer = io.StringIO()
+        for id, blob in zip(ids, blobs):
+            buffer.write('{}\t{}\t\\\\x{}\n'.format(id, copy_text_value(dictionary_id), blob.hex()))
+        buffer.seek(0)
+        cur.copy_expert("COPY syllabus_text_zstd (id, dictionary_id, blob) FROM STDIN", buffer)
+        conn.commit()
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(e)
+        sys.exit(1)
+    finally:
+        if cur:
+            cur.close()
+        if conn:
+            conn.close()
+
+
+def compress_syllabus_texts(text_scope, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # one pass over the records not compressed yet, scope key by scope key
+    require_zstd()
+    column = TEXT_SCOPE_COLUMNS[text_scope]
+    raw_bytes = 0
+    compressed_bytes = 0
+    for key in fetch_text_scope_keys(text_scope):
+        dictionary_id, dictionary = text_dictionary(text_scope, key)
+        compressor = zstd.ZstdCompressor(level=TEXT_COMPRESSION_LEVEL, dict_data=dictionary)
+        for chunk in stream_syllabi("SELECT s.id, s.text from open_syllabi s where s." + column + """=%s
+                                     and not exists (select 1 from syllabus_text_zstd z where z.id = s.id) order by s.id""",
+                                    (key,), chunk_size, cursor_name='stream_uncompressed_syllabi'):
+            texts = [(text or '').encode('utf-8') for text in chunk['text']]
+            blobs = [compressor.compress(text) for text in texts]
+            store_compressed_texts(chunk['id'].tolist(), blobs, dictionary_id)
+            raw_bytes += sum(len(text) for text in texts)
+            compressed_bytes += sum(len(blob) for blob in blobs)
+        print("\t{} = {}: {} of {} bytes".format(text_scope, key, compressed_bytes, raw_bytes))
+    return raw_bytes, compressed_bytes
+
+
+def text_decompressor(dictionary_id):
+    decompressor = _text_decompressors.get(dictionary_id)
+    if decompressor is None:
+        dictionary = None
+        if dictionary_id is not None:
+            conn = None
+            cur = None
+            try:
+                conn = psycopg2.connect("dbname='litindex' user='litindex' host='0.0.0.0' password='lit123'")
+                cur = conn.cursor()
+                cur.execute("SELECT dictionary from text_dictionaries where dictionary_id=%s", (dictionary_id,))
+                dictionary = zstd.ZstdCompressionDict(bytes(cur.fetchone()[0]))
+            except Exception as e:
+                if conn:
+                    conn.rollback()
+                print(e)
+                sys.exit(1)
+            finally:
+                if cur:
+                    cur.close()
+                if conn:
+                    conn.close()
+        decompressor = _text_decompressors[dictionary_id] = zstd.ZstdDecompressor(dict_data=dictionary)
+    return decompressor
+
+
+def decompress_text_chunks(chunks):
+    # (id, dictionary_id, blob, text) chunks to (id, text) chunks, prints the bytes read,
+    # the text is only used for the records without a blob (not compressed yet)
+    compressed_bytes = 0
+    raw_bytes = 0
+    uncompressed = 0
+    for chunk in chunks:
+        texts = []
+        plain_texts = chunk['text'] if 'text' in chunk else [None] * len(chunk)
+        for dictionary_id, blob, text in zip(chunk['dictionary_id'], chunk['blob'], plain_texts):
+            if blob is None:
+                texts.append(text)
+                uncompressed += 1
+                continue
+            blob = bytes(blob)
+            dictionary_id = None if pd.isnull(dictionary_id) else int(dictionary_id)
+            texts.append(text_decompressor(dictionary_id).decompress(blob).decode('utf-8'))
+            compressed_bytes += len(blob)
+            raw_bytes += len(texts[-1].encode('utf-8'))
+        yield pd.DataFrame({'id': chunk['id'].values, 'text': texts})
+    print("\tTEXT BYTES READ = {} (of {} decompressed)".format(compressed_bytes, raw_bytes))
+    if uncompressed:
+        print("\tRECORDS WITHOUT COMPRESSED TEXT = {} (read from open_syllabi.text)".format(uncompressed))
+
+
+def stream_group_compressed_texts(grid_name, year, field_name, chunk_size=OUT_OF_CORE_CHUNK_SIZE):
+    # same chunks as stream_group_syllabi(), read from the compressed text store, the records
+    # imported since the last --compress-texts come with their open_syllabi.text
+    require_zstd()
+    return decompress_text_chunks(stream_syllabi("""SELECT s.id, z.dictionary_id, z.blob, case when z.id is null then s.text end
+                                                     from open_syllabi s left join syllabus_text_zstd z on z.id = s.id
+                                                     where s.grid_name=%s and s.year=%s and s.field_name=%s order by s.id""",
+                                                  (grid_name, year, field_name), chunk_size, cursor_name='stream_group_compressed_texts',
+                                                  columns=['id', 'dictionary_id', 'blob', 'text']))
+
+
+# In[ ]:
+
+
+# file backed mode: no database, the raw JSONL files (as imported by populateLitIndexDatabase.py)
+# or a Parquet snapshot are read in chunks, every chunk is filtered like the group query,
+# sorted by (grid_name, year, field_name, id) and written as a sorted run to the spill
+# directory, the runs are merged (heapq.merge) into one stream of groups in bounded
+# memory, and every group goes through the same pipeline with the pairs written to a
+# local CSV (or Parquet) file instead of similar_syllabi
+RAW_COLUMNS = ['id', 'grid_name', 'year', 'field_name', 'grid_country_code', 'text']
+FILE_SORT_CHUNK_SIZE = 100000
+
+
+def read_raw_chunks(paths, chunk_size=FILE_SORT_CHUNK_SIZE):
+    # DataFrames with RAW_COLUMNS from JSONL and Parquet files, and from snapshot
+    # directories of exportLitIndexParquet.py (hive partitioned by country and year)
+    for path in paths:
+        if os.path.isdir(path):
+            if pads is None:
+                raise RuntimeError('reading Parquet needs the pyarrow package')
+            dataset = pads.dataset(path, format='parquet', partitioning='hive')
+            columns = [column for column in RAW_COLUMNS if column in dataset.schema.names]
+            chunks = (batch.to_pandas() for batch in dataset.to_batches(columns=columns, batch_size=chunk_size))
+        elif path.endswith('.parquet'):
+            if pq is None:
+                raise RuntimeError('reading Parquet needs the pyarrow package')
+            parquet_file = pq.ParquetFile(path)
+            columns = [column for column in RAW_COLUMNS if column in parquet_file.schema_arrow.names]
+            chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunk_size, columns=columns))
+        else:
+            chunks = pd.read_json(path, lines=True, chunksize=chunk_size)
+        for chunk in chunks:
+            yield chunk.reindex(columns=RAW_COLUMNS)
+
+
+def filter_raw_chunk(chunk, all_countries=False):
+    # same records as fetch_all_grid_name__year__field_names(), as (grid_name, year, field_name, id, text)
+    keep = chunk['grid_name'].notnull() & (chunk['grid_name'] != 'NaN') & chunk['id'].notnull()
+    keep &= pd.to_numeric(chunk['year'], errors='coerce').fillna(0) > 0
+    if not all_countries:
+        keep &= chunk['grid_country_code'] == 'US'
+    chunk = chunk[keep].astype({'grid_name': object, 'field_name': object, 'text': object})
+    return pd.DataFrame({'grid_name': chunk['grid_name'].astype(str), 'year': chunk['year'].astype(np.int64),
+                         'field_name': chunk['field_name'].fillna('').astype(str), 'id': chunk['id'].astype(np.int64),
+                         'text': chunk['text'].fillna('').astype(str)})
+
+
+def write_sorted_runs(chunks, run_dir):
+    # one sorted run file (JSON lines) per chunk
+    run_paths = []
+    for chunk in chunks:
+        chunk = chunk.sort_values(['grid_name', 'year', 'field_name', 'id'])
+        run_path = os.path.join(run_dir, 'run_{}.jsonl'.format(len(run_paths)))
+        with open(run_path, 'w', encoding='utf-8') as run_file:
+            for record in zip(chunk['grid_name'], chunk['year'].tolist(), chunk['field_name'], chunk['id'].tolist(), chunk['text']):
+                run_file.write(json.dumps(record) + '\n')
+        run_paths.append(run_path)
+    return run_paths
+
+
+def read_sorted_run(run_path):
+    with open(run_path, encoding='utf-8') as run_file:
+        for line in run_file:
+            yield json.loads(line)
+
+
+def stream_file_groups(paths, all_countries=False, chunk_size=FILE_SORT_CHUNK_SIZE, spill_dir=None):
+    # yields (grid_name, year, field_name, DataFrame of id and text) of every group with more than one record
+    run_dir = tempfile.mkdtemp(prefix='litindex_runs_', dir=spill_dir)
+    try:
+        run_paths = write_sorted_runs((filter_raw_chunk(chunk, all_countries) for chunk in read_raw_chunks(paths, chunk_size)), run_dir)
+        merged = heapq.merge(*[read_sorted_run(run_path) for run_path in run_paths], key=lambda record: record[:4])
+        for key, records in itertools.groupby(merged, key=lambda record: tuple(record[:3])):
+            records = list(records)
+            if len(records) > 1:
+                yield key + (pd.DataFrame({'id': [record[3] for record in records], 'text': [record[4] for record in records]}),)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+class PairFileWriter(object):
+    # similar_syllabi rows to a CSV file, or to a Parquet file if the path ends with .parquet
+    def __init__(self, path, columns=SIMILAR_SYLLABI_COLUMNS):
+        self.path = path
+        self.columns = columns
+        self.parquet_writer = None
+        self.csv_file = None
+        if not path.endswith('.parquet'):
+            self.csv_file = open(path, 'w', encoding='utf-8', newline='')
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(columns)
+        elif pq is None:
+            raise RuntimeError('writing Parquet needs the pyarrow package')
+
+    def write(self, list_duplicate_pairs):
+        if not list_duplicate_pairs:
+            return
+        if self.csv_file is not None:
+            self.csv_writer.writerows(list_duplicate_pairs)
+            return
+        table = pa.Table.from_pandas(pd.DataFrame.from_records(list_duplicate_pairs, columns=self.columns).astype({'jaccard_score': 'float64'}),
+                                     preserve_index=False)
+        if self.parquet_writer is None:
+            self.parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        if self.csv_file is not None:
+            self.csv_file.close()
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def find_duplicate_syllabi_from_files(paths, output_path, all_countries=False, chunk_size=FILE_SORT_CHUNK_SIZE, spill_dir=None, **kwargs):
+    # kwargs are passed on to find_duplicate_pairs()
+    return find_duplicate_syllabi_to_file(stream_file_groups(paths, all_countries, chunk_size, spill_dir), output_path, **kwargs)
+
+
+def find_duplicate_syllabi_to_file(groups, output_path, idf_scope='group', idf_model_dir=IDF_MODEL_DIR, **kwargs):
+    # groups yields (grid_name, year, field_name, DataFrame of id and text), returns the number of pairs written;
+    # the IDF model of every group is loaded for its own key, as in the per-group loop of main()
+    writer = PairFileWriter(output_path)
+    num_pairs = 0
+    try:
+        for grid_name, year, field_name, group in groups:
+            print("PROCESSING GRID_NAME = ", grid_name, ", YEAR = ", str(year), ", FIELD_NAME = ", field_name)
+            documents = tokenize_group_documents([group])
+            print("\tNO OF RECORDS = {}".format(len(documents.ids)))
+            if idf_scope != 'group':
+                kwargs['idf_model'] = group_idf_model(idf_scope, grid_name, field_name, idf_model_dir)
+            tsl = retain_duplicate_pairs(find_duplicate_pairs(documents, grid_name, year, field_name, **kwargs))
+            writer.write(tsl)
+            num_pairs += len(tsl)
+    finally:
+        writer.close()
+    return num_pairs
+
+
+def low_score_sample_path(output_path):
+    # similar_syllabi.csv -> similar_syllabi.low_score_sample.csv (same for .parquet)
+    root, extension = os.path.splitext(output_path)
+    return root + '.low_score_sample' + extension
+
+
+def write_low_score_sample(reservoir, output_path):
+    # the file backed counterpart of store_low_score_sample(), a side file next to the pair file
+    sample_path = low_score_sample_path(output_path)
+    writer = PairFileWriter(sample_path)
+    try:
+        writer.write(reservoir.rows)
+    finally:
+        writer.close()
+    return sample_path
+
+
+# In[ ]:
+
+
+# group cache: the fetched records (id, text) of every group are kept in a local Feather
+# file, so repeated experiment runs (other seeds, bands, common word threshold, scorer)
+# do not re-run the same SELECTs; the index (index.json) holds the triplet, row count,
+# size and last use of every file, an entry is dropped when the row count of its group
+# (cnt of fetch_all_grid_name__year__field_names()) changed, and the least recently used
+# files are evicted while the cache is over its disk budget
+GROUP_CACHE_DIR = './group_cache'
+GROUP_CACHE_MB = 10240
+
+
+class GroupCache(object):
+    def __init__(self, cache_dir=GROUP_CACHE_DIR, budget_mb=GROUP_CACHE_MB):
+        if feather is None:
+            raise RuntimeError('the group cache needs the pyarrow package')
+        self.cache_dir = cache_dir
+        self.budget_bytes = budget_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding='utf-8') as index_file:
+                self.entries = json.load(index_file)
+
+    @staticmethod
+    def file_name(key):
+        return hashlib.sha1(json.dumps([key[0], int(key[1]), key[2]]).encode('utf-8')).hexdigest() + '.feather'
+
+    def save_index(self):
+        # replaced atomically, an interrupted run never leaves a broken index
+        with open(self.index_path + '.tmp', 'w', encoding='utf-8') as index_file:
+            json.dump(self.entries, index_file)
+        os.replace(self.index_path + '.tmp', self.index_path)
+
+    def remove(self, file_name):
+        del self.entries[file_name]
+        path = os.path.join(self.cache_dir, file_name)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def groups(self):
+        # (grid_name, year, field_name, row_count) of the cached groups
+        return [(entry['grid_name'], entry['year'], entry['field_name'], entry['row_count']) for entry in self.entries.values()]
+
+    def get(self, key, row_count=None):
+        # the cached DataFrame of the group, None if not cached or its row count changed
+        # (row_count None trusts the cached row count)
+        file_name = self.file_name(key)
+        entry = self.entries.get(file_name)
+        if entry is None:
+            return None
+        path = os.path.join(self.cache_dir, file_name)
+        if (row_count is not None and entry['row_count'] != int(row_count)) or not os.path.exists(path):
+            self.remove(file_name)
+            self.save_index()
+            return None
+        entry['last_used'] = time.time()
+        self.save_index()
+        return feather.read_table(path, memory_map=True).to_pandas()
+
+    def put(self, key, records):
+        file_name = self.file_name(key)
+        path = os.path.join(self.cache_dir, file_name)
+        feather.write_feather(records.reset_index(drop=True), path)
+        size = os.path.getsize(path)
+        if size > self.budget_bytes:
+            # a group larger than the whole budget is not kept, and does not evict the others
+            print("\tGROUP CACHE SKIPPED, {} BYTES EXCEED THE BUDGET".format(size))
+            if file_name in self.entries:
+                del self.entries[file_name]
+                self.save_index()
+            os.remove(path)
+            return
+        self.entries[file_name] = {'grid_name': key[0], 'year': int(key[1]), 'field_name': key[2], 'row_count': len(records),
+                                   'bytes': size, 'last_used': time.time()}
+        # least recently used first, the new group (most recently used) always fits
+        for evicted in sorted(self.entries, key=lambda name: self.entries[name]['last_used']):
+            if sum(entry['bytes'] for entry in self.entries.values()) <= self.budget_bytes:
+                break
+            self.remove(evicted)
+        self.save_index()
+
+    def fetch(self, key, row_count, chunks):
+        # [DataFrame] of the group from the cache, or from chunks (only consumed on a miss) which is then cached
+        records = self.get(key, row_count)
+        if records is not None:
+            print("\tGROUP CACHE HIT")
+            return [records]
+        chunks = list(chunks)
+        if not chunks:
+            # nothing to cache, e.g. --zstd-texts before the texts of the group were compressed
+            return chunks
+        records = pd.concat(chunks, ignore_index=True)
+        self.put(key, records)
+        return [records]
+
+
+# In[ ]:
+
+
+# parameter sweep: instead of a full rerun per (seeds, bands, char_ngram) guess, every sampled
+# group is fingerprinted once per char_ngram with a superset of the seeds, and every
+# (bands, rows per band) configuration bands the first bands * rows columns of that matrix;
+# the union of all candidates is scored once, so every score threshold is a lookup, and
+# the recall is measured against the exact shingle Jaccard of all pairs of the group
+SWEEP_BANDS = [5, 10, 20, 25, 50]
+SWEEP_ROWS_PER_BAND = [2, 4, 5, 10, 20]
+SWEEP_CHAR_NGRAMS = [LSH_CHAR_NGRAM]
+SWEEP_SCORE_THRESHOLDS = [80, 90, 97]
+SWEEP_MIN_JACCARD = 0.5
+SWEEP_GROUPS = 20
+SWEEP_MAX_RECORDS = 5000
+SWEEP_SEED = 20180601
+
+
+def exact_jaccard_pairs(texts, min_jaccard=SWEEP_MIN_JACCARD, char_ngram=LSH_CHAR_NGRAM):
+    # (rows1, rows2, scores) of all row pairs (row1 < row2) with shingle Jaccard >= min_jaccard,
+    # the shingle overlaps come from one sparse (documents x shingles) product instead of n^2 set operations
+    document_shingles = [hashed_shingles(texts[row], char_ngram=char_ngram) for row in range(len(texts))]
+    lengths = np.array([len(row_shingles) for row_shingles in document_shingles], dtype=np.int64)
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    _, columns = np.unique(np.concatenate(document_shingles), return_inverse=True)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    shingle_matrix = sparse.csr_matrix((np.ones(len(columns), dtype=np.int32), columns.ravel(), offsets),
+                                       shape=(len(texts), columns.max() + 1))
+    overlaps = sparse.triu(shingle_matrix @ shingle_matrix.T, k=1).tocoo()
+    rows1 = overlaps.row.astype(np.int64)
+    rows2 = overlaps.col.astype(np.int64)
+    scores = overlaps.data / (lengths[rows1] + lengths[rows2] - overlaps.data)
+    keep = scores >= min_jaccard
+    order = np.lexsort((rows2[keep], rows1[keep]))
+    return rows1[keep][order], rows2[keep][order], scores[keep][order]
+
+
+def sweep_configurations(bands_list=SWEEP_BANDS, rows_list=SWEEP_ROWS_PER_BAND, char_ngrams=SWEEP_CHAR_NGRAMS):
+    return [(char_ngram, bands, rows) for char_ngram in char_ngrams for bands in bands_list for rows in rows_list]
+
+
+def sweep_group(documents, configurations, score_thresholds=SWEEP_SCORE_THRESHOLDS, min_jaccard=SWEEP_MIN_JACCARD,
+                scorer='token_set_ratio', idf_model=None, feature_hashing=None):
+    # one result dict per configuration for a single group
+    num_docs = len(documents.ids)
+    word_counts = document_word_counts(documents)
+    texts = DocumentTexts(documents, common_word_ids(documents, word_counts))
+    superset_seeds = max(bands * rows for _, bands, rows in configurations)
+    true_codes = {}
+    candidate_codes = {}
+    results = []
+    for char_ngram in sorted(set(char_ngram for char_ngram, _, _ in configurations)):
+        true_rows1, true_rows2, _ = exact_jaccard_pairs(texts, min_jaccard, char_ngram)
+        true_codes[char_ngram] = true_rows1 * num_docs + true_rows2
+        started = time.time()
+        signature_matrix = fingerprint_matrix(texts, make_minhasher(seeds=superset_seeds, char_ngram=char_ngram))
+        fingerprint_seconds = time.time() - started
+        for _, bands, rows in [configuration for configuration in configurations if configuration[0] == char_ngram]:
+            started = time.time()
+            # the first bands * rows hash functions of the superset are a signature of that many seeds
+            rows1, rows2 = candidate_pairs_from_band_hashes(band_hashes(signature_matrix[:, :bands * rows], bands))
+            lsh_seconds = time.time() - started
+            candidate_codes[(char_ngram, bands, rows)] = rows1 * num_docs + rows2
+            results.append({'char_ngram': char_ngram, 'bands': bands, 'rows_per_band': rows, 'seeds': bands * rows,
+                            'fingerprint_seconds': fingerprint_seconds * bands * rows / superset_seeds, 'lsh_seconds': lsh_seconds})
+
+    # STEP 2 and 3 once over the union of the candidates of all configurations
+    union_codes = np.unique(np.concatenate(list(candidate_codes.values())))
+    started = time.time()
+    signatures = group_signatures(documents, word_counts, idf_model, feature_hashing)
+    union_scores = score_candidate_pairs(signatures, union_codes // num_docs, union_codes % num_docs, scorer=scorer)
+    scoring_seconds = (time.time() - started) / max(len(union_codes), 1)
+    for result in results:
+        codes = candidate_codes[(result['char_ngram'], result['bands'], result['rows_per_band'])]
+        is_true = np.isin(codes, true_codes[result['char_ngram']], assume_unique=True)
+        scores = union_scores[np.searchsorted(union_codes, codes)]
+        result.update(documents=num_docs, true_pairs=len(true_codes[result['char_ngram']]), candidates=len(codes),
+                      true_candidates=int(is_true.sum()), scoring_seconds=scoring_seconds * len(codes))
+        for threshold in score_thresholds:
+            result['retained_{}'.format(threshold)] = int((scores >= threshold).sum())
+            result['true_retained_{}'.format(threshold)] = int(((scores >= threshold) & is_true).sum())
+    return results
+
+
+def sample_sweep_groups(df_grid_name__year__field_name, num_groups=SWEEP_GROUPS, max_records=SWEEP_MAX_RECORDS, seed=SWEEP_SEED):
+    # groups small enough for the all pairs ground truth, sampled reproducibly
+    candidates = df_grid_name__year__field_name[df_grid_name__year__field_name['cnt'] <= max_records]
+    return candidates.sample(n=min(num_groups, len(candidates)), random_state=seed)
+
+
+def sweep_lsh_parameters(groups, configurations, score_thresholds=SWEEP_SCORE_THRESHOLDS, min_jaccard=SWEEP_MIN_JACCARD,
+                         idf_scope='group', idf_model_dir=IDF_MODEL_DIR, **kwargs):
+    # groups yields (grid_name, year, field_name, documents), kwargs are passed on to sweep_group();
+    # returns one row per configuration summed over the groups, recall against the exact Jaccard pairs
+    group_results = []
+    for grid_name, year, field_name, documents in groups:
+        print("SWEEPING GRID_NAME = ", grid_name, ", YEAR = ", str(year), ", FIELD_NAME = ", field_name)
+        if idf_scope != 'group':
+            kwargs['idf_model'] = group_idf_model(idf_scope, grid_name, field_name, idf_model_dir)
+        group_results.extend(sweep_group(documents, configurations, score_thresholds, min_jaccard, **kwargs))
+    report = pd.DataFrame(group_results).groupby(['char_ngram', 'bands', 'rows_per_band', 'seeds'], as_index=False).sum()
+    report['recall'] = report['true_candidates'] / report['true_pairs'].clip(lower=1)
+    for threshold in score_thresholds:
+        report['recall_{}'.format(threshold)] = report['true_retained_{}'.format(threshold)] / report['true_pairs'].clip(lower=1)
+    report['seconds'] = report['fingerprint_seconds'] + report['lsh_seconds'] + report['scoring_seconds']
+    return report.sort_values(['recall', 'candidates'], ascending=[False, True])
+
+
+# In[ ]:
+
+
+'''
+# sample test
+%%time
+row = {'grid_name':"University of Michigan–Ann Arbor", \
+      'year':2011, \
+      'field_name':"Social Work."}
+df = find_and_store_duplicate_syllabi(row['grid_name'], row['year'], row['field_name'])
+'''
+
+
+# In[12]:
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='find near duplicate syllabi per (grid_name, year, field_name)')
+    parser.add_argument('--scorer', default='token_set_ratio', choices=sorted(SIMILARITY_SCORERS),
+                        help='STEP 3 scorer used for the accuracy score of the candidate pairs')
+    parser.add_argument('--verify-jaccard', action='store_true',
+                        help='also store the exact 5-gram shingle Jaccard of every candidate pair in jaccard_score')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes used to shard a single oversized group')
+    parser.add_argument('--shard-threshold', type=int, default=20000,
+                        help='groups with at least this many records are sharded across --workers')
+    parser.add_argument('--memory-budget-mb', type=int, default=None,
+                        help='groups with a larger estimated footprint are processed out-of-core in chunks')
+    parser.add_argument('--chunk-size', type=int, default=OUT_OF_CORE_CHUNK_SIZE,
+                        help='records per chunk in the out-of-core mode')
+    parser.add_argument('--spill-dir', default=None,
+                        help='directory for the memory mapped spill files of the out-of-core mode')
+    parser.add_argument('--token-dictionary', default=TOKEN_DICTIONARY_PATH,
+                        help='file the process wide token dictionary is loaded from and saved to')
+    parser.add_argument('--idf-scope', default='group', choices=['group'] + sorted(IDF_SCOPE_COLUMNS),
+                        help='fit the idf per group (original behavior) or use the saved institution, field or global IDF model')
+    parser.add_argument('--idf-model-dir', default=IDF_MODEL_DIR,
+                        help='directory of the saved IDF models')
+    parser.add_argument('--fit-idf-models', action='store_true',
+                        help='only fit and save the IDF models of --idf-scope in one streaming pass')
+    parser.add_argument('--feature-hashing', type=int, default=None, metavar='N_FEATURES',
+                        help='hash the TF-IDF terms into N_FEATURES columns instead of building a vocabulary')
+    parser.add_argument('--signed-hashing', action='store_true',
+                        help='alternate the sign of the hashed features to cancel out collisions')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only dedup the records missing from the persistent LSH band index against the indexed records')
+    parser.add_argument('--watermark', action='store_true',
+                        help='skip the groups unchanged since the last run and only pair the records appended since then')
+    parser.add_argument('--cross-year', action='store_true',
+                        help='only find the pairs across years, one LSH pass per (grid_name, field_name) over all years')
+    parser.add_argument('--corpus', action='store_true',
+                        help='only find the pairs across institutions over the whole corpus (needs the global IDF model)')
+    parser.add_argument('--all-countries', action='store_true',
+                        help='the corpus-wide mode covers all records instead of the US records')
+    parser.add_argument('--partitions', type=int, default=CORPUS_PARTITIONS,
+                        help='disk partitions of the band and pair tables in the corpus-wide mode')
+    parser.add_argument('--max-bucket-size', type=int, default=CORPUS_MAX_BUCKET_SIZE,
+                        help='buckets with more records are skipped in the corpus-wide mode (all their pairs would be built at once)')
+    parser.add_argument('--normalized-storage', action='store_true',
+                        help='store every signature once in syllabus_signatures and the pairs in syllabus_pairs')
+    parser.add_argument('--migrate-storage', action='store_true',
+                        help='only move similar_syllabi to the normalized storage and replace it by a compatibility view')
+    parser.add_argument('--storage-report', action='store_true',
+                        help='only print the on-disk size of the wide and the normalized pair storage')
+    parser.add_argument('--min-score', type=int, default=None,
+                        help='only store the pairs of similar_syllabi with at least this accuracy score')
+    parser.add_argument('--low-score-sample', type=int, default=LOW_SCORE_SAMPLE_SIZE,
+                        help='size of the random sample of the pairs below --min-score kept for QA (0 for none)')
+    parser.add_argument('--compute-minhash', action='store_true',
+                        help='only compute and store the MinHash signatures and band hashes of the records not signed yet')
+    parser.add_argument('--db-candidates', action='store_true',
+                        help='STEP 1 from the stored band hashes (GROUP BY band_hash in the database) instead of fingerprinting')
+    parser.add_argument('--compute-tokens', action='store_true',
+                        help='only normalize the records not tokenized yet and store their token ids in syllabus_tokens')
+    parser.add_argument('--db-tokens', action='store_true',
+                        help='read the groups from the precomputed syllabus_tokens column instead of the raw text')
+    parser.add_argument('--compress-texts', default=None, choices=sorted(TEXT_SCOPE_COLUMNS),
+                        help='only compress the texts not compressed yet with a zstd dictionary trained per institution or field')
+    parser.add_argument('--zstd-texts', action='store_true',
+                        help='read the groups from the compressed text store instead of open_syllabi.text')
+    parser.add_argument('--input', nargs='+', default=None, metavar='PATH',
+                        help='file backed mode: raw JSONL (or .parquet) files or Parquet snapshot directories to dedup without the database')
+    parser.add_argument('--output', default='./similar_syllabi.csv',
+                        help='CSV (or .parquet) file the pairs of the file backed mode are written to')
+    parser.add_argument('--sort-chunk-size', type=int, default=FILE_SORT_CHUNK_SIZE,
+                        help='records per sorted run of the external sort in the file backed mode')
+    parser.add_argument('--group-cache', default=None, metavar='DIR',
+                        help='keep the fetched groups as Feather files in DIR, repeated runs read them instead of open_syllabi')
+    parser.add_argument('--group-cache-mb', type=int, default=GROUP_CACHE_MB,
+                        help='disk budget of the group cache, least recently used groups are evicted')
+    parser.add_argument('--cache-only', action='store_true',
+                        help='with --group-cache: dedup only the cached groups without the database, pairs written to --output')
+    parser.add_argument('--sweep', action='store_true',
+                        help='report candidates, runtime and recall of LSH configurations on sampled groups instead of deduping')
+    parser.add_argument('--sweep-bands', type=int, nargs='+', default=SWEEP_BANDS,
+                        help='bands of the swept configurations')
+    parser.add_argument('--sweep-rows', type=int, nargs='+', default=SWEEP_ROWS_PER_BAND,
+                        help='rows per band of the swept configurations')
+    parser.add_argument('--sweep-char-ngrams', type=int, nargs='+', default=SWEEP_CHAR_NGRAMS,
+                        help='shingle sizes of the swept configurations')
+    parser.add_argument('--sweep-thresholds', type=int, nargs='+', default=SWEEP_SCORE_THRESHOLDS,
+                        help='accuracy scores the retained pairs and their recall are reported for')
+    parser.add_argument('--sweep-min-jaccard', type=float, default=SWEEP_MIN_JACCARD,
+                        help='exact shingle Jaccard from which a pair counts as a true duplicate')
+    parser.add_argument('--sweep-groups', type=int, default=SWEEP_GROUPS,
+                        help='number of sampled groups')
+    parser.add_argument('--sweep-max-records', type=int, default=SWEEP_MAX_RECORDS,
+                        help='only groups with at most this many records are sampled (all pairs ground truth)')
+    parser.add_argument('--sweep-report', default=None,
+                        help='also write the sweep report to this CSV file')
+    parser.add_argument('--memory-benchmark', type=int, default=None, metavar='N',
+                        help='only compare the per-group memory peak of the DataFrame and document store representations on the N largest groups')
+    args = parser.parse_args(argv)
+    # combinations that would only fail when the first group reaches them, hours into a run
+    if args.scorer == 'cosine' and (args.memory_budget_mb or args.corpus):
+        parser.error('--scorer cosine needs the full TF-IDF matrix of a group, not available with --memory-budget-mb or --corpus')
+    if args.feature_hashing and args.idf_scope != 'group' and not args.fit_idf_models:
+        parser.error('--feature-hashing can not be used with the IDF models of --idf-scope {}'.format(args.idf_scope))
+    if args.feature_hashing and args.incremental:
+        parser.error('--incremental keeps the document frequencies of the terms, not of the hashed features of --feature-hashing')
+    return args
 
 
 # main program
 def main():
+    global normalized_pair_storage, min_accuracy_score, low_score_reservoir
+    args = parse_arguments()
     print("START")
+    normalized_pair_storage = args.normalized_storage
+    min_accuracy_score = args.min_score
+    if args.min_score is not None and args.low_score_sample > 0:
+        low_score_reservoir = PairReservoir(args.low_score_sample)
+    if args.migrate_storage or args.storage_report:
+        if args.migrate_storage:
+            migrate_to_normalized_storage()
+        storage_report()
+        print("END")
+        return
+    print("TOKEN DICTIONARY = {} words".format(load_token_dictionary(args.token_dictionary)))
+    if args.fit_idf_models:
+        if args.idf_scope == 'group':
+            raise ValueError('--fit-idf-models needs an --idf-scope of institution, field or global')
+        print("IDF MODELS SAVED = {}".format(fit_idf_models(args.idf_scope, args.idf_model_dir, args.chunk_size)))
+        save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
+    if args.input:
+        feature_hashing = FeatureHashing(args.feature_hashing, args.signed_hashing) if args.feature_hashing else None
+        num_pairs = find_duplicate_syllabi_from_files(args.input, args.output, all_countries=args.all_countries, chunk_size=args.sort_chunk_size,
+                                                      spill_dir=args.spill_dir, scorer=args.scorer, verify_jaccard=args.verify_jaccard,
+                                                      workers=args.workers, shard_threshold=args.shard_threshold, idf_scope=args.idf_scope,
+                                                      idf_model_dir=args.idf_model_dir, feature_hashing=feature_hashing)
+        print("PAIRS WRITTEN TO {} = {}".format(args.output, num_pairs))
+        if low_score_reservoir is not None:
+            print("LOW SCORE PAIRS = {}, SAMPLED = {}".format(low_score_reservoir.seen, len(low_score_reservoir.rows)))
+            print("LOW SCORE SAMPLE WRITTEN TO {}".format(write_low_score_sample(low_score_reservoir, args.output)))
+        save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
+    group_cache = GroupCache(args.group_cache, args.group_cache_mb) if args.group_cache else None
+    if args.cache_only:
+        if group_cache is None:
+            print("--cache-only NEEDS --group-cache")
+            sys.exit(1)
+        feature_hashing = FeatureHashing(args.feature_hashing, args.signed_hashing) if args.feature_hashing else None
+        groups = ((grid_name, year, field_name, group_cache.get((grid_name, year, field_name)))
+                  for grid_name, year, field_name, row_count in group_cache.groups())
+        num_pairs = find_duplicate_syllabi_to_file(groups, args.output, scorer=args.scorer, verify_jaccard=args.verify_jaccard,
+                                                   workers=args.workers, shard_threshold=args.shard_threshold, idf_scope=args.idf_scope,
+                                                   idf_model_dir=args.idf_model_dir, feature_hashing=feature_hashing)
+        print("PAIRS WRITTEN TO {} = {}".format(args.output, num_pairs))
+        if low_score_reservoir is not None:
+            print("LOW SCORE PAIRS = {}, SAMPLED = {}".format(low_score_reservoir.seen, len(low_score_reservoir.rows)))
+            print("LOW SCORE SAMPLE WRITTEN TO {}".format(write_low_score_sample(low_score_reservoir, args.output)))
+        save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
+    if args.compress_texts:
+        raw_bytes, compressed_bytes = compress_syllabus_texts(args.compress_texts, args.chunk_size)
+        print("COMPRESSED {} BYTES TO {}".format(raw_bytes, compressed_bytes))
+        print("END")
+        return
+    if args.compute_tokens:
+        print("TOKENIZED RECORDS = {}".format(compute_syllabus_tokens(args.token_dictionary, args.chunk_size)))
+        print("END")
+        return
+    if args.compute_minhash:
+        print("SIGNED RECORDS = {}".format(compute_minhash_signatures(args.chunk_size)))
+        save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
+    if args.corpus:
+        find_and_store_corpus_duplicate_syllabi(load_idf_model('global', idf_model_key('global', None, None), args.idf_model_dir), scorer=args.scorer,
+                                                verify_jaccard=args.verify_jaccard, all_countries=args.all_countries, chunk_size=args.chunk_size,
+                                                spill_dir=args.spill_dir, partitions=args.partitions, max_bucket_size=args.max_bucket_size)
+        save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
+    if args.cross_year:
+        df_grid_name__field_name = fetch_all_grid_name__field_names()
+        print("NO OF COMBOS = {}".format(len(df_grid_name__field_name)))
+        feature_hashing = FeatureHashing(args.feature_hashing, args.signed_hashing) if args.feature_hashing else None
+        for index, row in df_grid_name__field_name.iterrows():
+            print("PROCESSING GRID_NAME = ", row['grid_name'], ", FIELD_NAME = ", row['field_name'], ", YEARS = ", str(row['years']))
+            idf_model = None
+            if args.idf_scope != 'group':
+                idf_model = load_idf_model(args.idf_scope, idf_model_key(args.idf_scope, row['grid_name'], row['field_name']), args.idf_model_dir)
+            find_and_store_cross_year_duplicate_syllabi(row['grid_name'], row['field_name'], scorer=args.scorer, verify_jaccard=args.verify_jaccard,
+                                                        chunk_size=args.chunk_size, idf_model=idf_model, feature_hashing=feature_hashing)
+            save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
     # df_completed = pd.read_csv("./completed_triplets.csv", sep="\t")
     # iterate through database records
     df_grid_name__year__field_name = fetch_all_grid_name__year__field_names()
     print("NO OF COMBOS = {}", len(df_grid_name__year__field_name))
+    if args.sweep:
+        feature_hashing = FeatureHashing(args.feature_hashing, args.signed_hashing) if args.feature_hashing else None
+        df_sample = sample_sweep_groups(df_grid_name__year__field_name, args.sweep_groups, args.sweep_max_records)
+        groups = ((row['grid_name'], row['year'], row['field_name'],
+                   fetch_group_documents(row['grid_name'], row['year'], row['field_name'], group_cache=group_cache, row_count=row['cnt']))
+                  for index, row in df_sample.iterrows())
+        report = sweep_lsh_parameters(groups, sweep_configurations(args.sweep_bands, args.sweep_rows, args.sweep_char_ngrams),
+                                      args.sweep_thresholds, args.sweep_min_jaccard, idf_scope=args.idf_scope, idf_model_dir=args.idf_model_dir,
+                                      scorer=args.scorer, feature_hashing=feature_hashing)
+        print(report.to_string(index=False))
+        if args.sweep_report:
+            report.to_csv(args.sweep_report, index=False)
+        save_token_dictionary(args.token_dictionary)
+        print("END")
+        return
+    if args.memory_benchmark:
+        for index, row in df_grid_name__year__field_name.head(args.memory_benchmark).iterrows():
+            print("BENCHMARKING GRID_NAME = ", row['grid_name'], ", YEAR = ", str(row['year']), ", FIELD_NAME = ", row['field_name'])
+            benchmark_group_memory(row['grid_name'], row['year'], row['field_name'])
+        print("END")
+        return
+    watermarks = fetch_dedup_watermarks() if args.watermark else {}
     for index, row in df_grid_name__year__field_name.iterrows():
         # check if we already processed this
         '''
@@ -364,7 +3286,55 @@ def main():
         print("PROCESSING GRID_NAME = ", row['grid_name'], \
               ", YEAR = ", str(row['year']), \
               ", FIELD_NAME = ", row['field_name'])
-        find_and_store_duplicate_syllabi(row['grid_name'], row['year'], row['field_name'])
+        started = time.time()
+        new_after_id = None
+        group_complete = True
+        if args.watermark:
+            change, new_after_id = group_change(row, watermarks.get((row['grid_name'], row['year'], row['field_name'])))
+            if change == 'unchanged':
+                print("\tUNCHANGED since the last run")
+                continue
+            print("\tMEMBERSHIP {}".format(change.upper()))
+            if change == 'changed' and not args.incremental:
+                # recomputed from scratch, drop the pairs of the previous runs
+                delete_group_duplicate_pairs(row['grid_name'], row['year'], row['field_name'])
+            elif change == 'changed':
+                # records may have left the group, drop them from the band index
+                print("\tPURGED INDEXED RECORDS = {}".format(purge_lsh_band_index(row['grid_name'], row['year'], row['field_name'])))
+        feature_hashing = None
+        if args.feature_hashing:
+            feature_hashing = FeatureHashing(args.feature_hashing, args.signed_hashing)
+        idf_model = None
+        if args.idf_scope != 'group':
+            idf_model = load_idf_model(args.idf_scope, idf_model_key(args.idf_scope, row['grid_name'], row['field_name']), args.idf_model_dir)
+        if args.incremental:
+            find_and_store_new_duplicate_syllabi(row['grid_name'], row['year'], row['field_name'], scorer=args.scorer, verify_jaccard=args.verify_jaccard,
+                                                 chunk_size=args.chunk_size, idf_model=idf_model, feature_hashing=feature_hashing)
+        elif args.memory_budget_mb and estimate_group_footprint(row['cnt'], row['text_bytes'] or 0) > args.memory_budget_mb * 1024 * 1024:
+            print("\tOUT-OF-CORE, estimated footprint exceeds {} MB".format(args.memory_budget_mb))
+            group_complete = find_and_store_duplicate_syllabi_out_of_core(row['grid_name'], row['year'], row['field_name'], scorer=args.scorer,
+                                                                          verify_jaccard=args.verify_jaccard, chunk_size=args.chunk_size,
+                                                                          spill_dir=args.spill_dir, idf_model=idf_model, feature_hashing=feature_hashing,
+                                                                          new_after_id=new_after_id)
+            if not group_complete:
+                print("\tWATERMARK NOT SAVED, THE NEXT RUN PROCESSES THE GROUP AGAIN")
+        else:
+            documents = find_and_store_duplicate_syllabi(row['grid_name'], row['year'], row['field_name'], scorer=args.scorer, verify_jaccard=args.verify_jaccard,
+                                             workers=args.workers, shard_threshold=args.shard_threshold, idf_model=idf_model,
+                                             feature_hashing=feature_hashing, new_after_id=new_after_id, db_candidates=args.db_candidates,
+                                             db_tokens=args.db_tokens, zstd_texts=args.zstd_texts, group_cache=group_cache,
+                                             row_count=row['cnt'])
+            if len(documents.ids) != row['cnt']:
+                # the membership changed since the combos query, the next run has to look at the group again
+                print("\tFETCHED {} OF {} RECORDS, WATERMARK NOT SAVED".format(len(documents.ids), row['cnt']))
+                group_complete = False
+        save_token_dictionary(args.token_dictionary)
+        if args.watermark and group_complete:
+            save_dedup_watermark(row['grid_name'], row['year'], row['field_name'], int(row['max_id']), int(row['cnt']), int(row['id_sum']))
+        print("\tTEXT BYTES = {}, SECONDS = {:.1f}".format(row['text_bytes'], time.time() - started))
+    if low_score_reservoir is not None:
+        print("LOW SCORE PAIRS = {}, SAMPLED = {}".format(low_score_reservoir.seen, len(low_score_reservoir.rows)))
+        store_low_score_sample(low_score_reservoir)
     print("END")
 
 if __name__== "__main__":
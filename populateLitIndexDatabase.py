@@ -103,19 +103,184 @@ CREATE TABLE similar_syllabi (
     id2 BIGINT DEFAULT 0,
     id1_top_10_significant_words VARCHAR(4096) NOT NULL DEFAULT '',
     id2_top_10_significant_words VARCHAR(4096) NOT NULL DEFAULT '',
-    accuracy_score INT DEFAULT 0 
+    accuracy_score INT DEFAULT 0,
+    jaccard_score double precision DEFAULT NULL
 );
+-- existing databases: ALTER TABLE similar_syllabi ADD COLUMN jaccard_score double precision DEFAULT NULL;
 
 CREATE INDEX idxs1 ON similar_syllabi (grid_name, field_name, year);
 CREATE INDEX idxs2 ON similar_syllabi (grid_name, field_name);
 CREATE INDEX idxs3 ON similar_syllabi (grid_name, year);
 CREATE INDEX idxs4 ON similar_syllabi (field_name, year);
-CREATE INDEX idxs5 ON similar_syllabi (id1, id2);
+CREATE UNIQUE INDEX idxs5 ON similar_syllabi (id1, id2);
 CREATE INDEX idxs6 ON similar_syllabi (id1);
 CREATE INDEX idxs7 ON similar_syllabi (id2);
 CREATE INDEX idxs8 ON similar_syllabi (accuracy_score);
 CREATE INDEX idxs9 ON similar_syllabi (grid_name, field_name, year, accuracy_score);
 CREATE INDEX idxs10 ON similar_syllabi (grid_name, field_name, accuracy_score);
+-- existing databases: pairs in canonical order (id1 < id2), duplicates removed, then the unique key
+-- UPDATE similar_syllabi SET id1 = id2, id2 = id1, id1_top_10_significant_words = id2_top_10_significant_words,
+--     id2_top_10_significant_words = id1_top_10_significant_words WHERE id1 > id2;
+-- DELETE FROM similar_syllabi a USING similar_syllabi b WHERE a.id1 = b.id1 AND a.id2 = b.id2 AND a.ctid < b.ctid;
+-- DROP INDEX idxs5; CREATE UNIQUE INDEX idxs5 ON similar_syllabi (id1, id2);
+
+-- random sample of the pairs below --min-score, same columns as similar_syllabi
+CREATE TABLE similar_syllabi_low_score_sample (LIKE similar_syllabi INCLUDING DEFAULTS);
+CREATE UNIQUE INDEX idxr1 ON similar_syllabi_low_score_sample (id1, id2);
+
+-- every pair in both directions, for lookups by a single id: where id = ...
+CREATE VIEW similar_syllabi_symmetric AS
+    SELECT grid_name, field_name, year, id1 as id, id2 as other_id, id1_top_10_significant_words as top_10_significant_words,
+           id2_top_10_significant_words as other_top_10_significant_words, accuracy_score, jaccard_score from similar_syllabi
+    union all
+    SELECT grid_name, field_name, year, id2, id1, id2_top_10_significant_words, id1_top_10_significant_words, accuracy_score, jaccard_score
+    from similar_syllabi;
+
+CREATE TABLE similar_syllabi_cross_year (
+    grid_name VARCHAR(256) NOT NULL DEFAULT '',
+    field_name VARCHAR(256) NOT NULL DEFAULT '',
+    year1 INTEGER DEFAULT 0,
+    year2 INTEGER DEFAULT 0,
+    id1 BIGINT DEFAULT 0,
+    id2 BIGINT DEFAULT 0,
+    id1_top_10_significant_words VARCHAR(4096) NOT NULL DEFAULT '',
+    id2_top_10_significant_words VARCHAR(4096) NOT NULL DEFAULT '',
+    accuracy_score INT DEFAULT 0,
+    jaccard_score double precision DEFAULT NULL
+);
+
+CREATE INDEX idxc1 ON similar_syllabi_cross_year (grid_name, field_name);
+CREATE UNIQUE INDEX idxc2 ON similar_syllabi_cross_year (id1, id2);
+CREATE INDEX idxc3 ON similar_syllabi_cross_year (accuracy_score);
+
+CREATE TABLE similar_syllabi_corpus (
+    grid_name1 VARCHAR(256) NOT NULL DEFAULT '',
+    grid_name2 VARCHAR(256) NOT NULL DEFAULT '',
+    id1 BIGINT DEFAULT 0,
+    id2 BIGINT DEFAULT 0,
+    id1_top_10_significant_words VARCHAR(4096) NOT NULL DEFAULT '',
+    id2_top_10_significant_words VARCHAR(4096) NOT NULL DEFAULT '',
+    accuracy_score INT DEFAULT 0,
+    jaccard_score double precision DEFAULT NULL
+);
+
+CREATE UNIQUE INDEX idxg1 ON similar_syllabi_corpus (id1, id2);
+CREATE INDEX idxg2 ON similar_syllabi_corpus (grid_name1, grid_name2);
+CREATE INDEX idxg3 ON similar_syllabi_corpus (accuracy_score);
+
+CREATE TABLE syllabus_clusters (
+    id BIGINT PRIMARY KEY,
+    cluster_id BIGINT DEFAULT 0,
+    canonical_id BIGINT DEFAULT 0
+);
+
+CREATE INDEX idxk1 ON syllabus_clusters (cluster_id);
+CREATE INDEX idxk2 ON syllabus_clusters (canonical_id);
+
+-- normalized token streams as little endian int32 token ids (findAllDuplicatesInLitIndex2.py --compute-tokens)
+CREATE TABLE syllabus_tokens (
+    id BIGINT PRIMARY KEY,
+    token_ids BYTEA
+);
+
+-- zstd dictionary compressed texts (findAllDuplicatesInLitIndex2.py --compress-texts)
+CREATE TABLE text_dictionaries (
+    dictionary_id SERIAL PRIMARY KEY,
+    scope VARCHAR(32) NOT NULL DEFAULT '',
+    key VARCHAR(256) NOT NULL DEFAULT '',
+    dictionary BYTEA
+);
+
+CREATE UNIQUE INDEX idxz1 ON text_dictionaries (scope, key);
+
+CREATE TABLE syllabus_text_zstd (
+    id BIGINT PRIMARY KEY,
+    dictionary_id INTEGER DEFAULT NULL,
+    blob BYTEA
+);
+
+-- stored MinHash signatures (findAllDuplicatesInLitIndex2.py --compute-minhash)
+CREATE TABLE syllabus_minhash (
+    id BIGINT PRIMARY KEY,
+    signature BYTEA
+);
+
+CREATE TABLE syllabus_band_hashes (
+    id BIGINT DEFAULT 0,
+    band SMALLINT DEFAULT 0,
+    band_hash BIGINT DEFAULT 0
+);
+
+CREATE INDEX idxh1 ON syllabus_band_hashes (band, band_hash);
+CREATE INDEX idxh2 ON syllabus_band_hashes (id);
+
+-- normalized pair storage (findAllDuplicatesInLitIndex2.py --normalized-storage)
+CREATE TABLE syllabus_signatures (
+    id BIGINT PRIMARY KEY,
+    top_words VARCHAR(4096) NOT NULL DEFAULT ''
+);
+
+CREATE TABLE syllabus_pairs (
+    grid_name VARCHAR(256) NOT NULL DEFAULT '',
+    field_name VARCHAR(256) NOT NULL DEFAULT '',
+    year INTEGER DEFAULT 0,
+    id1 BIGINT DEFAULT 0,
+    id2 BIGINT DEFAULT 0,
+    accuracy_score INT DEFAULT 0,
+    jaccard_score double precision DEFAULT NULL
+);
+
+CREATE INDEX idxp1 ON syllabus_pairs (grid_name, field_name, year);
+CREATE UNIQUE INDEX idxp2 ON syllabus_pairs (id1, id2);
+CREATE INDEX idxp3 ON syllabus_pairs (id2);
+CREATE INDEX idxp4 ON syllabus_pairs (accuracy_score);
+
+CREATE TABLE lsh_band_index (
+    grid_name VARCHAR(256) NOT NULL DEFAULT '',
+    field_name VARCHAR(256) NOT NULL DEFAULT '',
+    year INTEGER DEFAULT 0,
+    band SMALLINT DEFAULT 0,
+    bucket_hash BIGINT DEFAULT 0,
+    id BIGINT DEFAULT 0
+);
+
+CREATE INDEX idxl1 ON lsh_band_index (grid_name, field_name, year, band, bucket_hash);
+CREATE INDEX idxl2 ON lsh_band_index (grid_name, field_name, year, band, id);
+
+CREATE TABLE lsh_index_scopes (
+    grid_name VARCHAR(256) NOT NULL DEFAULT '',
+    field_name VARCHAR(256) NOT NULL DEFAULT '',
+    year INTEGER DEFAULT 0,
+    common_words TEXT[],
+    num_docs BIGINT DEFAULT 0,
+    idf_terms TEXT[],
+    idf_document_counts INTEGER[]
+);
+
+CREATE UNIQUE INDEX idxl3 ON lsh_index_scopes (grid_name, field_name, year);
+
+CREATE TABLE dedup_watermarks (
+    grid_name VARCHAR(256) NOT NULL DEFAULT '',
+    field_name VARCHAR(256) NOT NULL DEFAULT '',
+    year INTEGER DEFAULT 0,
+    max_id BIGINT DEFAULT 0,
+    row_count BIGINT DEFAULT 0,
+    id_sum NUMERIC DEFAULT 0
+);
+
+CREATE UNIQUE INDEX idxw1 ON dedup_watermarks (grid_name, field_name, year);
+
+-- migration to the normalized pair storage, a separate step run by
+-- findAllDuplicatesInLitIndex2.py --migrate-storage (which also copies the similar_syllabi rows into
+-- syllabus_signatures and syllabus_pairs); --normalized-storage only writes syllabus_signatures and
+-- syllabus_pairs, similar_syllabi shows their pairs once it is replaced by this view:
+-- ALTER TABLE similar_syllabi RENAME TO similar_syllabi_wide;
+-- CREATE VIEW similar_syllabi AS
+--     SELECT p.grid_name, p.field_name, p.year, p.id1, p.id2,
+--            s1.top_words as id1_top_10_significant_words, s2.top_words as id2_top_10_significant_words,
+--            p.accuracy_score, p.jaccard_score
+--     from syllabus_pairs p join syllabus_signatures s1 on s1.id = p.id1 join syllabus_signatures s2 on s2.id = p.id2;
+-- (then CREATE OR REPLACE VIEW similar_syllabi_symmetric as above, it followed the renamed table)
 
 
 # backup and restore of database
@@ -124,6 +289,9 @@ tar czvf litindex.tgz litindex.sql
 
 tar xzvf litindex.tgz
 psql -d litindex -U litindex -f litindex.sql
+
+# columnar snapshot of open_syllabi (Parquet, partitioned by grid_country_code and year), see exportLitIndexParquet.py
+python exportLitIndexParquet.py --snapshot-dir ./litindex_snapshot
 '''
 
 import glob